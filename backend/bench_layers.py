@@ -0,0 +1,110 @@
+"""
+Latency benchmark for the channel layer modes.
+Run: python bench_layers.py [--members 5] [--messages 1000] [--redis redis://127.0.0.1:6379]
+
+Sends room broadcasts with group_send and times their arrival at every
+member, for the in-memory, Redis and hybrid layers. Each Redis mode runs
+twice: with every member on the sending node, where the hybrid layer
+doesn't touch Redis, and with one extra member on a second layer instance
+(another node), which it has to reach through Redis. The Redis modes are
+skipped if Redis isn't reachable.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import redis
+
+from realtime.layers import HybridChannelLayer, InMemoryChannelLayer, RedisChannelLayer
+
+GROUP = 'file_1'
+
+
+def redis_available(url):
+    try:
+        return redis.Redis.from_url(url, socket_connect_timeout=1).ping()
+    except redis.ConnectionError:
+        return False
+
+
+async def collect(layer, channel, count, latencies):
+    for _ in range(count):
+        message = await layer.receive(channel)
+        latencies.append(time.perf_counter() - message['sent'])
+
+
+async def run(layer, members, messages, remote=None):
+    """Broadcast ``messages`` times to ``members`` channels and time delivery."""
+    channels = [(layer, await layer.new_channel()) for _ in range(members)]
+    if remote is not None:
+        channels.append((remote, await remote.new_channel()))
+    for member_layer, channel in channels:
+        await member_layer.group_add(GROUP, channel)
+
+    latencies = []
+    receivers = [
+        asyncio.create_task(collect(member_layer, channel, messages, latencies))
+        for member_layer, channel in channels
+    ]
+    started = time.perf_counter()
+    for number in range(messages):
+        await layer.group_send(GROUP, {'type': 'broadcast', 'number': number, 'sent': time.perf_counter()})
+        # Let receivers keep up, as consumers do between client frames
+        await asyncio.sleep(0)
+    await asyncio.wait_for(asyncio.gather(*receivers), timeout=60)
+    elapsed = time.perf_counter() - started
+
+    for member_layer, channel in channels:
+        await member_layer.group_discard(GROUP, channel)
+    return latencies, elapsed
+
+
+def report(name, latencies, elapsed):
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+    print(f"   {name:<17} p50 {p50:8.3f} ms   p99 {p99:8.3f} ms   "
+          f"{len(latencies) / elapsed:10.0f} deliveries/s")
+
+
+async def benchmark(args):
+    # Capacity must hold a whole run, since all members share the process queue
+    capacity = args.messages * (args.members + 1)
+    modes = [('memory', lambda: InMemoryChannelLayer(capacity=capacity))]
+    if redis_available(args.redis):
+        for name, layer_class in (('redis', RedisChannelLayer), ('hybrid', HybridChannelLayer)):
+            modes.append((name, lambda cls=layer_class: cls(hosts=[args.redis], capacity=capacity)))
+    else:
+        print(f"⚠️  Redis is not reachable at {args.redis}, only benchmarking the in-memory layer")
+
+    print(f"Broadcasting {args.messages} messages to {args.members} members...")
+    for name, make_layer in modes:
+        # The in-memory layer can't reach other processes
+        for remote in (False, True) if name != 'memory' else (False,):
+            layer = make_layer()
+            other = make_layer() if remote else None
+            latencies, elapsed = await run(layer, args.members, args.messages, other)
+            report(f"{name} + 1 remote" if remote else f"{name} all local", latencies, elapsed)
+            for instance in (layer, other):
+                if instance is not None:
+                    await instance.flush()
+                if hasattr(instance, 'close_pools'):
+                    await instance.close_pools()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--members', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--redis', default='redis://127.0.0.1:6379')
+    args = parser.parse_args()
+    asyncio.run(benchmark(args))
+    return True
+
+
+if __name__ == "__main__":
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,366 @@
+"""
+Load test for the realtime WebSocket stack.
+Run: python bench_realtime.py [--rooms 10] [--clients 5] [--duration 10] [--server inprocess|daphne]
+
+Creates a throwaway SQLite database with one project and a file per room,
+then connects --clients WebSocket clients to every room (ws/file/<id>/).
+Each client sends full-content edits and cursor moves at the given rates
+for --duration seconds. Reports:
+
+* fan-out latency (p50/p99) from an edit being sent to it reaching the
+  other clients of the room, and the same for cursor moves, which includes
+  the server's cursor batching interval;
+* messages sent and frames delivered per second per server worker;
+* server memory per connection (Python allocations in-process, which
+  include the test clients' side, or RSS growth of the Daphne process).
+
+With --server daphne the app runs under a Daphne subprocess and clients
+connect over TCP; otherwise it is driven in-process through the ASGI
+interface. The channel layer is chosen with --layer (see CHANNEL_LAYER).
+Exits with 1 when --max-p99 is given and the edit p99 exceeds it.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def setup_database(rooms, content_size):
+    """Migrate the throwaway database and create the rooms' files and a token."""
+    from django.contrib.auth.models import User
+    from django.core.management import call_command
+    from rest_framework_simplejwt.tokens import AccessToken
+
+    from files.models import File
+    from projects.models import Project
+
+    call_command('migrate', verbosity=0)
+    user = User.objects.create_user('bench', password='bench-password')
+    project = Project.objects.create(name='Benchmark', owner=user)
+    content = 'x' * content_size
+    file_ids = [
+        File.objects.create(project=project, name=f'room_{room}.py', content=content).pk
+        for room in range(rooms)
+    ]
+    return file_ids, str(AccessToken.for_user(user))
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class InProcessClient:
+    """A WebSocket client driving the ASGI application directly."""
+
+    def __init__(self, application, path, codec):
+        from channels.testing import WebsocketCommunicator
+
+        subprotocols = [codec.name] if codec.binary else None
+        self.communicator = WebsocketCommunicator(application, path, subprotocols=subprotocols)
+
+    async def connect(self):
+        connected, code = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError(f'Connection rejected ({code})')
+
+    async def send(self, data):
+        if isinstance(data, bytes):
+            await self.communicator.send_to(bytes_data=data)
+        else:
+            await self.communicator.send_to(text_data=data)
+
+    async def receive(self):
+        # A timeout would cancel the application, so wait for as long as the run lasts
+        message = await self.communicator.receive_output(timeout=3600)
+        if message['type'] == 'websocket.close':
+            return None
+        return message.get('bytes') or message.get('text')
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class DaphneClient:
+    """A WebSocket client connected over TCP, using Daphne's autobahn dependency."""
+
+    def __init__(self, url, codec):
+        from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+
+        class Protocol(WebSocketClientProtocol):
+            def onOpen(protocol):
+                self.opened.set_result(True)
+
+            def onMessage(protocol, payload, is_binary):
+                self.messages.put_nowait(payload if is_binary else payload.decode('utf8'))
+
+            def onClose(protocol, was_clean, code, reason):
+                if not self.opened.done():
+                    self.opened.set_exception(RuntimeError(f'Connection rejected ({code})'))
+                self.messages.put_nowait(None)
+
+        self.factory = WebSocketClientFactory(url, protocols=[codec.name] if codec.binary else None)
+        self.factory.protocol = Protocol
+        self.url = url
+        self.protocol = None
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        self.opened = loop.create_future()
+        self.messages = asyncio.Queue()
+        _, self.protocol = await loop.create_connection(
+            self.factory, self.factory.host, self.factory.port
+        )
+        await self.opened
+
+    async def send(self, data):
+        if isinstance(data, bytes):
+            self.protocol.sendMessage(data, isBinary=True)
+        else:
+            self.protocol.sendMessage(data.encode('utf8'))
+
+    async def receive(self):
+        return await self.messages.get()
+
+    async def close(self):
+        self.protocol.sendClose()
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.edit_latencies = []
+        self.cursor_latencies = []
+
+
+async def run_client(client, number, codec, args, deadline, stats):
+    """Send edits and cursor moves until ``deadline`` while timing what arrives."""
+    from realtime import codecs
+
+    padding = 'x' * args.content_size
+
+    async def receive():
+        while True:
+            data = await client.receive()
+            if data is None:
+                return
+            now = time.perf_counter()
+            stats.delivered += 1
+            message = codecs.decode(*((None, data) if isinstance(data, bytes) else (data, None)))
+            if message.get('type') == 'file_update':
+                sent = message['content'].split('\n', 1)[0]
+                if sent.startswith('#'):
+                    stats.edit_latencies.append(now - float(sent[1:]))
+            elif message.get('type') == 'cursor_batch':
+                for cursor in message['cursors']:
+                    position = cursor.get('position') or {}
+                    if 'sent' in position:
+                        stats.cursor_latencies.append(now - position['sent'])
+
+    async def send_every(interval, make_payload):
+        # Stagger clients so they don't all send in the same tick
+        await asyncio.sleep(interval * (number % 10) / 10)
+        while time.perf_counter() < deadline:
+            await client.send(codec.encode(make_payload()))
+            stats.sent += 1
+            await asyncio.sleep(interval)
+
+    def edit():
+        return {'type': 'file_update', 'content': f'#{time.perf_counter()}\n{padding}'}
+
+    def cursor():
+        return {
+            'type': 'cursor_update',
+            'username': f'client{number}',
+            'position': {'lineNumber': 1, 'column': number, 'sent': time.perf_counter()},
+        }
+
+    receiver = asyncio.create_task(receive())
+    senders = []
+    if args.edit_rate > 0:
+        senders.append(send_every(1 / args.edit_rate, edit))
+    if args.cursor_rate > 0:
+        await client.send(codec.encode({'type': 'presence_join', 'username': f'client{number}'}))
+        senders.append(send_every(1 / args.cursor_rate, cursor))
+    await asyncio.gather(*senders)
+    # Give the last broadcasts time to arrive
+    await asyncio.sleep(0.5)
+    receiver.cancel()
+
+
+def process_rss(pid):
+    """Resident memory of a process in bytes (Linux only), or None."""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+async def benchmark(args, file_ids, token, make_client, server_memory):
+    from realtime import codecs
+
+    codec = codecs.CODECS[args.protocol]
+    clients = [
+        make_client(f'/ws/file/{file_id}/?token={token}', codec)
+        for file_id in file_ids
+        for _ in range(args.clients)
+    ]
+
+    memory_before = server_memory()
+    for client in clients:
+        await client.connect()
+        # The sync frame sent on join
+        await client.receive()
+    memory_after = server_memory()
+    # Allocation tracing slows everything down, so only measure connecting
+    tracemalloc.stop()
+
+    stats = Stats()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(
+        run_client(client, number, codec, args, deadline, stats)
+        for number, client in enumerate(clients)
+    ))
+    elapsed = time.perf_counter() - started
+    for client in clients:
+        await client.close()
+
+    per_connection = None
+    if memory_before is not None and memory_after is not None:
+        per_connection = (memory_after - memory_before) / len(clients)
+    return stats, elapsed, per_connection
+
+
+def report(args, stats, elapsed, per_connection):
+    ms = 1000
+    print(f"   Sent: {stats.sent} messages ({stats.sent / elapsed:.0f}/s)")
+    # Both server modes run a single worker process
+    print(f"   Delivered: {stats.delivered} frames ({stats.delivered / elapsed:.0f}/s per worker)")
+    print(f"   Edit fan-out latency:   p50 {percentile(stats.edit_latencies, 0.5) * ms:8.2f} ms   "
+          f"p99 {percentile(stats.edit_latencies, 0.99) * ms:8.2f} ms   ({len(stats.edit_latencies)} samples)")
+    print(f"   Cursor fan-out latency: p50 {percentile(stats.cursor_latencies, 0.5) * ms:8.2f} ms   "
+          f"p99 {percentile(stats.cursor_latencies, 0.99) * ms:8.2f} ms   ({len(stats.cursor_latencies)} samples)")
+    if per_connection is not None:
+        print(f"   Server memory per connection: {per_connection / 1024:.1f} KiB")
+
+    p99 = percentile(stats.edit_latencies, 0.99) * ms
+    if args.max_p99 is not None and not p99 <= args.max_p99:
+        print(f"❌ Edit p99 {p99:.2f} ms is over the {args.max_p99:.2f} ms budget")
+        return False
+    print("✅ Benchmark complete")
+    return True
+
+
+def run_inprocess(args):
+    import django
+    django.setup()
+    from config.asgi import application
+
+    file_ids, token = setup_database(args.rooms, args.content_size)
+
+    def server_memory():
+        return tracemalloc.get_traced_memory()[0]
+
+    tracemalloc.start()
+    stats, elapsed, per_connection = asyncio.run(benchmark(
+        args, file_ids, token,
+        lambda path, codec: InProcessClient(application, path, codec),
+        server_memory,
+    ))
+    return report(args, stats, elapsed, per_connection)
+
+
+def run_daphne(args):
+    # Django with Daphne installed pins autobahn to Twisted, so this process
+    # stays out of Django and the database is set up by a child process
+    setup = subprocess.run(
+        [sys.executable, __file__, '--setup-only',
+         '--rooms', str(args.rooms), '--content-size', str(args.content_size)],
+        capture_output=True, text=True, check=True,
+    )
+    file_ids, token = json.loads(setup.stdout.splitlines()[-1])
+
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'config.asgi:application'],
+        env=os.environ.copy(),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    print("❌ Daphne did not start")
+                    return False
+                time.sleep(0.1)
+
+        stats, elapsed, per_connection = asyncio.run(benchmark(
+            args, file_ids, token,
+            lambda path, codec: DaphneClient(f'ws://127.0.0.1:{port}{path}', codec),
+            lambda: process_rss(server.pid),
+        ))
+        return report(args, stats, elapsed, per_connection)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--clients', type=int, default=5, help='clients per room')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--edit-rate', type=float, default=2, help='edits per second per client')
+    parser.add_argument('--cursor-rate', type=float, default=10, help='cursor moves per second per client')
+    parser.add_argument('--content-size', type=int, default=2000, help='bytes per edit')
+    parser.add_argument('--protocol', choices=['json', 'msgpack'], default='json')
+    parser.add_argument('--server', choices=['inprocess', 'daphne'], default='inprocess')
+    parser.add_argument('--layer', choices=['memory', 'hybrid', 'redis'], default='memory')
+    parser.add_argument('--max-p99', type=float, help='fail if the edit p99 exceeds this (ms)')
+    parser.add_argument('--setup-only', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.setup_only:
+        import django
+        django.setup()
+        print(json.dumps(setup_database(args.rooms, args.content_size)))
+        return True
+
+    print(f"Benchmarking {args.rooms} rooms x {args.clients} clients for {args.duration:g}s "
+          f"({args.server}, {args.layer} layer, {args.protocol})...")
+    with tempfile.TemporaryDirectory() as workdir:
+        # Settings read these when Django starts, here and in child processes
+        os.environ['SQLITE_PATH'] = os.path.join(workdir, 'bench.sqlite3')
+        os.environ['CHANNEL_LAYER'] = args.layer
+        if args.server == 'daphne':
+            return run_daphne(args)
+        return run_inprocess(args)
+
+
+if __name__ == "__main__":
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    sys.exit(0 if main() else 1)
@@ -19,15 +19,24 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
 from django.core.asgi import get_asgi_application
 
+# Initialize Django before importing anything that touches models
+django_asgi_app = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
+from realtime.flow import FlowControlMiddleware
+from realtime.middleware import JWTAuthMiddleware
 from realtime.routing import websocket_urlpatterns
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
-        URLRouter(
-            websocket_urlpatterns
+    "http": django_asgi_app,
+    "websocket": FlowControlMiddleware(
+        AuthMiddlewareStack(
+            JWTAuthMiddleware(
+                URLRouter(
+                    websocket_urlpatterns
+                )
+            )
         )
     ),
 })
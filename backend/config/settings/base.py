@@ -6,6 +6,7 @@ Common settings shared between development and production.
 from pathlib import Path
 from decouple import config
 from datetime import timedelta
+from corsheaders.defaults import default_headers
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent.parent.parent
@@ -111,6 +112,10 @@ REST_FRAMEWORK = {
     ),
 }
 
+# CORS headers for conditional requests on file endpoints
+CORS_ALLOW_HEADERS = (*default_headers, 'if-match', 'if-none-match')
+CORS_EXPOSE_HEADERS = ['ETag']
+
 # JWT Settings
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=60),
@@ -122,14 +127,88 @@ SIMPLE_JWT = {
 REDIS_HOST = config('REDIS_HOST', default='127.0.0.1')
 REDIS_PORT = config('REDIS_PORT', default=6379, cast=int)
 
-# Channel Layers (Redis)
+# Redis shards for the channel layer, as comma-separated redis:// URLs.
+# Rooms are spread over them by consistent hashing (realtime.sharding).
+REDIS_SHARDS = config(
+    'REDIS_SHARDS',
+    default=f'redis://{REDIS_HOST}:{REDIS_PORT}',
+    cast=lambda v: [s.strip() for s in v.split(',') if s.strip()]
+)
+
+# While shards are added or removed: the REDIS_SHARDS list before the change.
+# Groups and leases that moved are still found on their old shard until
+# manage.py migrate_channel_groups has moved them
+REDIS_PREVIOUS_SHARDS = config(
+    'REDIS_PREVIOUS_SHARDS',
+    default='',
+    cast=lambda v: [s.strip() for s in v.split(',') if s.strip()]
+)
+
+# Channel Layers: 'hybrid' delivers to members on the same process in memory
+# and uses Redis for the rest, 'redis' always goes through Redis and 'memory'
+# runs without Redis (single process only, e.g. development and CI)
+CHANNEL_LAYER = config('CHANNEL_LAYER', default='hybrid')
+CHANNEL_LAYER_BACKENDS = {
+    'hybrid': "realtime.layers.HybridChannelLayer",
+    'redis': "realtime.layers.RedisChannelLayer",
+    'memory': "realtime.layers.InMemoryChannelLayer",
+}
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {
-            "hosts": [(REDIS_HOST, REDIS_PORT)],
+        "BACKEND": CHANNEL_LAYER_BACKENDS[CHANNEL_LAYER],
+        "CONFIG": {} if CHANNEL_LAYER == 'memory' else {
+            "hosts": REDIS_SHARDS,
+            **({"previous_hosts": REDIS_PREVIOUS_SHARDS} if REDIS_PREVIOUS_SHARDS else {}),
         },
     },
 }
 
-
+# Realtime collaboration
+# Number of accepted changes each room keeps for transforming late operations
+REALTIME_HISTORY_LIMIT = config('REALTIME_HISTORY_LIMIT', default=500, cast=int)
+# Seconds a process keeps ownership of a room without renewing it; another
+# process takes the room over once the owner stops renewing
+REALTIME_ROOM_LEASE = config('REALTIME_ROOM_LEASE', default=15.0, cast=float)
+# Write-behind of live room documents to File.content (seconds / change counts)
+REALTIME_FLUSH_INTERVAL = config('REALTIME_FLUSH_INTERVAL', default=1.0, cast=float)
+REALTIME_FLUSH_DEBOUNCE = config('REALTIME_FLUSH_DEBOUNCE', default=2.0, cast=float)
+REALTIME_FLUSH_MAX_DELAY = config('REALTIME_FLUSH_MAX_DELAY', default=10.0, cast=float)
+REALTIME_FLUSH_MAX_CHANGES = config('REALTIME_FLUSH_MAX_CHANGES', default=200, cast=int)
+# Cursor and presence updates are coalesced and broadcast this many times per second
+REALTIME_CURSOR_RATE = config('REALTIME_CURSOR_RATE', default=20.0, cast=float)
+# Outbound messages queued per connection before frames are dropped for a resync,
+# and how many resyncs within the window get a lagging client disconnected
+REALTIME_OUTBOX_LIMIT = config('REALTIME_OUTBOX_LIMIT', default=256, cast=int)
+REALTIME_OUTBOX_MAX_RESYNCS = config('REALTIME_OUTBOX_MAX_RESYNCS', default=3, cast=int)
+REALTIME_OUTBOX_RESYNC_WINDOW = config('REALTIME_OUTBOX_RESYNC_WINDOW', default=60.0, cast=float)
+
+# Version history storage: 'delta' keeps a full keyframe every
+# VERSION_KEYFRAME_INTERVAL versions and diffs against it in between,
+# 'full' stores every snapshot in full
+VERSION_STORAGE = config('VERSION_STORAGE', default='delta')
+VERSION_KEYFRAME_INTERVAL = config('VERSION_KEYFRAME_INTERVAL', default=10, cast=int)
+# Snapshots whose diff against the keyframe spans more lines than this, or
+# takes longer than this many seconds, are stored in full as a new keyframe
+VERSION_DELTA_MAX_LINES = config('VERSION_DELTA_MAX_LINES', default=100000, cast=int)
+VERSION_DELTA_TIMEOUT = config('VERSION_DELTA_TIMEOUT', default=0.5, cast=float)
+# Live edits are autosaved without a version per write: a snapshot of the
+# previous state is taken once this many characters changed or this many
+# seconds passed since the last one, and when an editing session ends
+VERSION_AUTOSAVE_DISTANCE = config('VERSION_AUTOSAVE_DISTANCE', default=1000, cast=int)
+VERSION_AUTOSAVE_INTERVAL = config('VERSION_AUTOSAVE_INTERVAL', default=600.0, cast=float)
+# Version diffs: computed diffs kept in memory per process, the combined line
+# count above which a diff response is streamed instead of built at once, and
+# the search steps a diff may take before falling back to a patience diff
+VERSION_DIFF_MAX_COST = config('VERSION_DIFF_MAX_COST', default=500000, cast=int)
+VERSION_DIFF_CACHE_SIZE = config('VERSION_DIFF_CACHE_SIZE', default=256, cast=int)
+VERSION_DIFF_STREAM_LINES = config('VERSION_DIFF_STREAM_LINES', default=20000, cast=int)
+# Retention of automatic snapshots (manage.py prune_versions): all are kept for
+# KEEP_ALL_HOURS, then the newest per hour until HOURLY_DAYS, then the newest
+# per day. Deletes run in batches of BATCH_SIZE, every INTERVAL seconds with --loop
+VERSION_RETENTION_KEEP_ALL_HOURS = config('VERSION_RETENTION_KEEP_ALL_HOURS', default=48, cast=int)
+VERSION_RETENTION_HOURLY_DAYS = config('VERSION_RETENTION_HOURLY_DAYS', default=14, cast=int)
+VERSION_RETENTION_BATCH_SIZE = config('VERSION_RETENTION_BATCH_SIZE', default=500, cast=int)
+VERSION_RETENTION_INTERVAL = config('VERSION_RETENTION_INTERVAL', default=3600.0, cast=float)
+
+# Seconds a cached ProjectStats row is served before being recomputed (0 disables)
+PROJECT_STATS_CACHE_TTL = config('PROJECT_STATS_CACHE_TTL', default=300, cast=int)
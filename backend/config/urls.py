@@ -23,4 +23,5 @@ urlpatterns = [
     path('api/projects/', include('projects.urls')),
     path('api/files/', include('files.urls')),
     path('api/versions/', include('versions.urls')),
+    path('api/realtime/', include('realtime.urls')),
 ]
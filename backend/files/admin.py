@@ -8,7 +8,7 @@ class FolderAdmin(admin.ModelAdmin):
     list_display = ('name', 'project', 'parent', 'full_path', 
                     'children_count', 'files_count', 'created_at')
     list_filter = ('project', 'created_at')
-    search_fields = ('name', 'project__name', 'full_path')
+    search_fields = ('name', 'project__name', 'path')
     readonly_fields = ('full_path', 'children_count', 'files_count', 
                       'created_at', 'updated_at')
     fieldsets = (
@@ -25,14 +25,18 @@ class FolderAdmin(admin.ModelAdmin):
         }),
     )
     
+    def get_queryset(self, request):
+        """Annotate counts so the changelist doesn't run two COUNTs per row."""
+        return super().get_queryset(request).with_counts()
+    
     def children_count(self, obj):
         """Display children count."""
-        return obj.children.count()
+        return obj.children_count
     children_count.short_description = 'Subfolders'
     
     def files_count(self, obj):
         """Display files count."""
-        return obj.files.count()
+        return obj.files_count
     files_count.short_description = 'Files'
 
 
@@ -43,7 +47,7 @@ class FileAdmin(admin.ModelAdmin):
                     'line_count', 'created_by', 'updated_at')
     list_filter = ('language', 'project', 'created_at', 'updated_at')
     search_fields = ('name', 'path', 'project__name', 'content')
-    readonly_fields = ('full_path', 'size', 'line_count', 'created_at', 'updated_at')
+    readonly_fields = ('full_path', 'size', 'line_count', 'content_hash', 'created_at', 'updated_at')
     fieldsets = (
         ('Basic Information', {
             'fields': ('name', 'project', 'folder', 'path', 'full_path')
@@ -52,7 +56,7 @@ class FileAdmin(admin.ModelAdmin):
             'fields': ('content', 'language', 'encoding')
         }),
         ('Metadata', {
-            'fields': ('size', 'line_count', 'created_by', 'updated_by'),
+            'fields': ('size', 'line_count', 'content_hash', 'created_by', 'updated_by'),
             'classes': ('collapse',)
         }),
         ('Timestamps', {
@@ -60,8 +64,3 @@ class FileAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
     )
-    
-    def line_count(self, obj):
-        """Display line count."""
-        return obj.line_count
-    line_count.short_description = 'Lines'
@@ -1,6 +1,11 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class FilesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'files'
+
+    def ready(self):
+        from . import search
+        post_migrate.connect(search.ensure_index, sender=self)
@@ -0,0 +1,299 @@
+"""
+Bulk move / rename / copy / delete of files.
+
+A batch is validated as a whole before anything is written: the files,
+target folders and target projects are loaded with one query each, and
+the resulting locations are checked for collisions against each other and
+against one query of the files already there. If every operation is
+valid, the batch is applied in a single transaction with one bulk delete, one
+``bulk_update`` and one ``bulk_create``; otherwise nothing is written and
+each operation reports its own result.
+"""
+from collections import Counter
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from projects.models import Project, ProjectStats
+from realtime import events
+from .models import File, Folder
+from .serializers import FileSerializer
+
+OPERATIONS = ('move', 'rename', 'copy', 'delete')
+MAX_OPERATIONS = 1000
+
+
+class BulkError(Exception):
+    """The request itself is malformed (as opposed to one of its operations)."""
+
+
+class BulkOperations:
+    """Validate and apply a list of file operations for ``user``."""
+
+    def __init__(self, user, operations):
+        if not isinstance(operations, list) or not operations:
+            raise BulkError('operations must be a non-empty list.')
+        if len(operations) > MAX_OPERATIONS:
+            raise BulkError(f'At most {MAX_OPERATIONS} operations per request.')
+        self.user = user
+        self.operations = operations
+        self.results = [
+            {
+                'index': index,
+                'op': op.get('op') if isinstance(op, dict) else None,
+                'id': op.get('id') if isinstance(op, dict) else None,
+                'status': 'ok',
+            }
+            for index, op in enumerate(operations)
+        ]
+
+    def fail(self, index, message):
+        result = self.results[index]
+        if result['status'] == 'ok':
+            result.update(status='error', error=message)
+
+    @property
+    def valid(self):
+        return all(result['status'] == 'ok' for result in self.results)
+
+    # -- Validation ---------------------------------------------------------
+
+    def parse(self):
+        """Check the shape of each operation and collect the ids it refers to."""
+        file_ids, folder_ids, project_ids = set(), set(), set()
+        for index, op in enumerate(self.operations):
+            if not isinstance(op, dict) or op.get('op') not in OPERATIONS:
+                self.fail(index, f'op must be one of {", ".join(OPERATIONS)}.')
+                continue
+            for key in ('id', 'folder_id', 'project_id'):
+                value = op.get(key)
+                if value is not None and (isinstance(value, bool) or not isinstance(value, int)):
+                    self.fail(index, f'{key} must be an integer.')
+            if op.get('id') is None:
+                self.fail(index, 'id is required.')
+            if op['op'] == 'rename' and not op.get('name'):
+                self.fail(index, 'name is required.')
+            if op['op'] == 'move' and 'folder_id' not in op:
+                self.fail(index, 'folder_id is required (null for the project root).')
+            if self.results[index]['status'] != 'ok':
+                continue
+
+            file_ids.add(op['id'])
+            if op.get('folder_id') is not None:
+                folder_ids.add(op['folder_id'])
+            if op['op'] == 'copy' and op.get('project_id') is not None:
+                project_ids.add(op['project_id'])
+        return file_ids, folder_ids, project_ids
+
+    def validate(self):
+        file_ids, folder_ids, project_ids = self.parse()
+        self.files = files = (
+            File.objects.filter(pk__in=file_ids, project__owner=self.user)
+            .select_related('folder').defer('content').in_bulk()
+        )
+        folders = Folder.objects.filter(pk__in=folder_ids, project__owner=self.user).in_bulk()
+        projects = Project.objects.filter(pk__in=project_ids, owner=self.user).in_bulk()
+
+        # Each file may only be touched once per batch
+        moved = Counter(
+            op['id'] for op, result in zip(self.operations, self.results)
+            if result['status'] == 'ok' and op['op'] != 'copy'
+        )
+
+        # index -> (file, project_id, folder, name) of the resulting file
+        self.targets = {}
+        self.reuses_locations = False
+        for index, op in enumerate(self.operations):
+            if self.results[index]['status'] != 'ok':
+                continue
+            file = files.get(op['id'])
+            if file is None:
+                self.fail(index, 'File not found.')
+                continue
+            if op['op'] != 'copy' and moved[op['id']] > 1:
+                self.fail(index, 'The file is changed by more than one operation.')
+                continue
+            if op['op'] == 'delete':
+                continue
+
+            project_id = file.project_id
+            if op['op'] == 'copy' and op.get('project_id') is not None:
+                if op['project_id'] not in projects:
+                    self.fail(index, 'Project not found.')
+                    continue
+                project_id = op['project_id']
+
+            folder = file.folder if op['op'] == 'rename' else None
+            if op['op'] in ('move', 'copy') and op.get('folder_id') is not None:
+                folder = folders.get(op['folder_id'])
+                if folder is None or folder.project_id != project_id:
+                    self.fail(index, 'Folder not found in the target project.')
+                    continue
+
+            name = file.name
+            if op.get('name'):
+                try:
+                    name = self.clean_name(op['name'])
+                except ValidationError as exc:
+                    self.fail(index, str(exc.detail[0]))
+                    continue
+            self.targets[index] = (file, project_id, folder, name)
+
+        self.check_collisions()
+        return self.valid
+
+    def clean_name(self, name):
+        """Validate a new file name the way FileSerializer does; returns it cleaned."""
+        serializer = FileSerializer()
+        return serializer.validate_name(serializer.fields['name'].run_validation(name))
+
+    def check_collisions(self):
+        """Reject operations whose resulting (project, path, name) is taken."""
+        keys = {
+            index: (project_id, folder.path if folder else '', name)
+            for index, (file, project_id, folder, name) in self.targets.items()
+        }
+
+        # Against each other
+        counts = Counter(keys.values())
+        for index, key in keys.items():
+            if counts[key] > 1:
+                self.fail(index, 'Another operation in this batch targets the same name.')
+
+        # Against files already there, unless the batch moves, renames or
+        # deletes them. One query covers every target location.
+        if not keys:
+            return
+        leaving = {
+            op['id'] for op, result in zip(self.operations, self.results)
+            if result['status'] == 'ok' and op['op'] != 'copy'
+        }
+        project_ids, paths, names = (set(column) for column in zip(*keys.values()))
+        # A superset of the target locations, matched exactly below
+        existing = {
+            (project_id, path, name): pk
+            for pk, project_id, path, name in File.objects.filter(
+                project_id__in=project_ids, path__in=paths, name__in=names
+            ).values_list('pk', 'project_id', 'path', 'name')
+        }
+        for index, key in keys.items():
+            pk = existing.get(key)
+            if pk is None:
+                continue
+            if pk not in leaving:
+                self.fail(index, 'A file with this name already exists in the target location.')
+            elif pk != self.targets[index][0].pk:
+                # Takes over the location of a file the batch moves away
+                self.reuses_locations = True
+
+    # -- Applying -----------------------------------------------------------
+
+    def apply(self):
+        """Apply a validated batch; returns False if the database rejected it."""
+        now = timezone.now()
+        deleted, updated, created = [], [], []
+        projects = set()
+
+        for index, op in enumerate(self.operations):
+            if op['op'] == 'delete':
+                deleted.append(self.files[op['id']])
+                projects.add(self.files[op['id']].project_id)
+                continue
+            file, project_id, folder, name = self.targets[index]
+            projects.update((file.project_id, project_id))
+            if op['op'] == 'copy':
+                created.append((index, file, project_id, folder, name))
+                continue
+
+            file.folder = folder
+            file.path = folder.path if folder else ''
+            file.name = name
+            detect_language(file)
+            file.updated_by = self.user
+            file.updated_at = now
+            updated.append((index, file))
+        copies = self.build_copies(created, now)
+
+        try:
+            with transaction.atomic():
+                File.objects.filter(pk__in=[file.pk for file in deleted]).delete()
+                files = [file for index, file in updated]
+                if self.reuses_locations:
+                    # The unique constraint is checked row by row, so park the
+                    # files on temporary names before names change hands
+                    names = [file.name for file in files]
+                    for file in files:
+                        file.name = f'.bulk-{file.pk}'
+                    File.objects.bulk_update(files, ['name'])
+                    for file, name in zip(files, names):
+                        file.name = name
+                File.objects.bulk_update(
+                    files, ['name', 'folder', 'path', 'language', 'updated_by', 'updated_at'],
+                )
+                File.objects.bulk_create([copy for index, copy in copies])
+                ProjectStats.invalidate(*projects)
+
+                # Sent once the transaction commits
+                for file in deleted:
+                    events.file_changed('deleted', file)
+                for index, file in updated:
+                    action = 'moved' if self.operations[index]['op'] == 'move' else 'renamed'
+                    events.file_changed(action, file)
+                for index, copy in copies:
+                    events.file_changed('created', copy)
+        except IntegrityError:
+            # A concurrent request took one of the locations
+            for index in range(len(self.operations)):
+                self.fail(index, 'The batch conflicts with a concurrent change; please retry.')
+            return False
+
+        for index, file in [*updated, *copies]:
+            self.results[index]['file'] = describe(file)
+        return True
+
+    def build_copies(self, created, now):
+        """Unsaved copies, with the source's content and metadata (bulk_create skips save())."""
+        if not created:
+            return []
+        contents = dict(
+            File.objects.filter(pk__in={file.pk for _, file, *_ in created}).values_list('pk', 'content')
+        )
+        copies = [
+            (index, File(
+                project_id=project_id,
+                folder=folder,
+                path=folder.path if folder else '',
+                name=name,
+                content=contents[file.pk],
+                language=file.language,
+                encoding=file.encoding,
+                size=file.size,
+                line_count=file.line_count,
+                content_hash=file.content_hash,
+                created_by=self.user,
+                updated_by=self.user,
+                created_at=now,
+                updated_at=now,
+            ))
+            for index, file, project_id, folder, name in created
+        ]
+        for index, copy in copies:
+            detect_language(copy)
+        return copies
+
+
+def detect_language(file):
+    """Detect the language from the name unless one was set, as ``File.save()`` does."""
+    if not file.language or file.language == 'javascript':
+        file.language = file._detect_language()
+
+
+def describe(file):
+    return {
+        'id': file.pk,
+        'name': file.name,
+        'folder': file.folder_id,
+        'full_path': file.full_path,
+        'project': file.project_id,
+    }
@@ -0,0 +1,118 @@
+"""
+Copying folder subtrees and whole projects.
+
+Folders are inserted one depth level per ``bulk_create``, parents before
+children, so each level can point at the new parent rows and take its
+materialized path from them. Files follow in primary key order, CHUNK_SIZE
+rows at a time: each chunk's content is read and inserted with one
+``bulk_create``, so memory stays bounded however large the tree is. It all
+runs in one transaction.
+
+Copies carry the source's size, line count and content hash over as they
+are. The content itself is still duplicated: ``File.content`` is stored
+inline (and indexed for search), so rows have no blob to share.
+"""
+from django.db import transaction
+from django.utils import timezone
+
+from projects.models import Project, ProjectStats
+from .models import File, Folder
+
+CHUNK_SIZE = 500
+
+FILE_FIELDS = ('pk', 'folder_id', 'name', 'content', 'language', 'encoding',
+               'size', 'line_count', 'content_hash')
+
+
+def copy_folders(folders, folder_map, project):
+    """Insert copies of ``folders`` into ``project``, level by level.
+
+    ``folder_map`` maps source folder ids (and None for the root) to their
+    copies and is extended with the new folders. Levels are found by
+    following parent links down from the folders whose parent is already
+    mapped, not from paths, which a name containing ``/`` would throw off.
+    """
+    now = timezone.now()
+    children = {}
+    for folder in folders:
+        children.setdefault(folder.parent_id, []).append(folder)
+
+    level = [folder for parent_id in list(folder_map) for folder in children.get(parent_id, ())]
+    while level:
+        copies = []
+        for folder in level:
+            copy = Folder(project=project, parent=folder_map[folder.parent_id], name=folder.name,
+                          created_at=now, updated_at=now)
+            copy.path = copy.build_path()
+            copies.append(copy)
+        Folder.objects.bulk_create(copies)
+        folder_map.update(zip((folder.pk for folder in level), copies))
+        level = [child for folder in level for child in children.get(folder.pk, ())]
+
+
+def copy_files(files, folder_map, project, user):
+    """Insert copies of ``files`` into ``project`` in chunks; returns the number copied."""
+    now = timezone.now()
+    files = files.order_by('pk').values(*FILE_FIELDS)
+    copied = last = 0
+    while True:
+        rows = list(files.filter(pk__gt=last)[:CHUNK_SIZE])
+        if not rows:
+            return copied
+        copies = []
+        for row in rows:
+            folder = folder_map[row['folder_id']]
+            copies.append(File(
+                project=project,
+                folder=folder,
+                path=folder.path if folder else '',
+                name=row['name'],
+                content=row['content'],
+                language=row['language'],
+                encoding=row['encoding'],
+                size=row['size'],
+                line_count=row['line_count'],
+                content_hash=row['content_hash'],
+                created_by=user,
+                updated_by=user,
+                created_at=now,
+                updated_at=now,
+            ))
+        File.objects.bulk_create(copies)
+        copied += len(copies)
+        last = rows[-1]['pk']
+
+
+@transaction.atomic
+def copy_folder(folder, user, project, parent=None, name=None):
+    """Copy ``folder`` with everything beneath it under ``parent`` in ``project``."""
+    # Read before anything is inserted, in case the copy lands inside the source
+    folders = list(Folder.objects.filter(pk__in=folder.descendant_ids()).only('id', 'parent_id', 'name', 'path'))
+
+    root = Folder(project=project, parent=parent, name=name or folder.name)
+    root.save()
+    folder_map = {folder.pk: root}
+    copy_folders(folders, folder_map, project)
+    copy_files(
+        File.objects.filter(folder_id__in=[folder.pk, *(f.pk for f in folders)]),
+        folder_map, project, user,
+    )
+    ProjectStats.invalidate(project.pk)
+    return root
+
+
+@transaction.atomic
+def clone_project(project, user, name=None):
+    """Create a copy of ``project`` with all its folders and files, owned by ``user``."""
+    clone = Project.objects.create(
+        name=name or f'{project.name} (copy)',
+        description=project.description,
+        owner=user,
+        visibility=project.visibility,
+        default_language=project.default_language,
+    )
+    folders = list(Folder.objects.filter(project=project).only('id', 'parent_id', 'name', 'path'))
+    folder_map = {None: None}
+    copy_folders(folders, folder_map, clone)
+    copy_files(File.objects.filter(project=project), folder_map, clone, user)
+    return clone
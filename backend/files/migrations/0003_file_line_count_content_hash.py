@@ -0,0 +1,62 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:14
+
+import codecs
+import hashlib
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Metadata as of this migration (see files.models.content_metadata for the live copy)
+def content_metadata(content, encoding):
+    data = content.encode('utf-8')
+    if codecs.lookup(encoding).name == 'utf-8':
+        size = len(data)
+    else:
+        size = len(content.encode(encoding))
+    return {
+        'size': size,
+        'line_count': len(content.splitlines()),
+        'content_hash': hashlib.sha256(data).hexdigest(),
+    }
+
+
+def backfill_content_metadata(apps, schema_editor):
+    File = apps.get_model('files', 'File')
+    batch = []
+    for file in File.objects.only('id', 'content', 'encoding').iterator(chunk_size=500):
+        for field, value in content_metadata(file.content, file.encoding).items():
+            setattr(file, field, value)
+        batch.append(file)
+        if len(batch) >= 500:
+            File.objects.bulk_update(batch, ['size', 'line_count', 'content_hash'])
+            batch = []
+    if batch:
+        File.objects.bulk_update(batch, ['size', 'line_count', 'content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0002_alter_file_options_alter_file_unique_together_and_more'),
+        ('projects', '0002_alter_project_options_project_default_language_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='content_hash',
+            field=models.CharField(blank=True, default='e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855', help_text='SHA-256 of the content', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='line_count',
+            field=models.IntegerField(default=0, help_text='Number of lines in file'),
+        ),
+        migrations.RunPython(backfill_content_metadata, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['project', 'content_hash'], name='file_project_2c3d86_idx'),
+        ),
+    ]
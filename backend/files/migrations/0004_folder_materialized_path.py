@@ -0,0 +1,52 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:16
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_folder_paths(apps, schema_editor):
+    Folder = apps.get_model('files', 'Folder')
+    folders = {
+        folder.pk: folder
+        for folder in Folder.objects.only('id', 'name', 'parent_id', 'path')
+    }
+
+    def resolve(folder):
+        if not folder.path:
+            parent = folders.get(folder.parent_id)
+            folder.path = f"{resolve(parent)}/{folder.name}" if parent else folder.name
+        return folder.path
+
+    for folder in folders.values():
+        resolve(folder)
+    Folder.objects.bulk_update(folders.values(), ['path'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0003_file_line_count_content_hash'),
+        ('projects', '0002_alter_project_options_project_default_language_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='folder',
+            name='path',
+            field=models.CharField(blank=True, editable=False, help_text='Materialized full path, maintained on save', max_length=1000),
+        ),
+        migrations.RunPython(backfill_folder_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['path'], name='file_path_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(fields=['project', 'path'], name='folder_project_697c1d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='folder',
+            index=models.Index(fields=['path'], name='folder_path_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
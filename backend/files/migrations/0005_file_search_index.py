@@ -0,0 +1,72 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+# The search index as of this migration (files.search.ensure_index restores
+# the SQLite triggers from its own copy after later migrations rebuild ``file``)
+FTS_TABLE = 'file_search'
+TRIGRAM_INDEXES = {
+    'file_content_trgm_idx': 'content',
+    'file_name_trgm_idx': 'name',
+    'file_path_trgm_idx': 'path',
+}
+SQLITE_TRIGGERS = {
+    'file_search_ai': f"""
+        CREATE TRIGGER IF NOT EXISTS file_search_ai AFTER INSERT ON file BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+        END""",
+    'file_search_ad': f"""
+        CREATE TRIGGER IF NOT EXISTS file_search_ad AFTER DELETE ON file BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        END""",
+    'file_search_au': f"""
+        CREATE TRIGGER IF NOT EXISTS file_search_au AFTER UPDATE OF content ON file BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+        END""",
+}
+
+
+def install_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for name, column in TRIGRAM_INDEXES.items():
+                cursor.execute(
+                    f'CREATE INDEX IF NOT EXISTS {name} ON file USING gin ({column} gin_trgm_ops)'
+                )
+        elif connection.vendor == 'sqlite':
+            try:
+                cursor.execute(
+                    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+                    f"content, content='file', content_rowid='id', tokenize='trigram')"
+                )
+            except OperationalError:
+                # SQLite built without FTS5 / trigram: search falls back to LIKE scans
+                return
+            for sql in SQLITE_TRIGGERS.values():
+                cursor.execute(sql)
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def uninstall_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            for name in TRIGRAM_INDEXES:
+                cursor.execute(f'DROP INDEX IF EXISTS {name}')
+        elif connection.vendor == 'sqlite':
+            for name in SQLITE_TRIGGERS:
+                cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+            cursor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0004_folder_materialized_path'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.0.6 on 2026-10-18 18:01
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0005_file_search_index'),
+        ('projects', '0003_project_stats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='file',
+            index=models.Index(fields=['project', 'line_count'], name='file_project_9b9a3c_idx'),
+        ),
+    ]
@@ -1,7 +1,61 @@
+import codecs
+import hashlib
 import os
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Concat, Substr
 from django.core.validators import RegexValidator
-from projects.models import Project
+from django.utils import timezone
+from projects.models import Project, ProjectStats
+
+
+EMPTY_CONTENT_HASH = hashlib.sha256(b'').hexdigest()
+
+
+def content_metadata(content, encoding='utf-8'):
+    """Compute the stored metadata for a file body in a single pass.
+
+    Returns a dict with ``size`` (bytes in the file's encoding), ``line_count``
+    and ``content_hash`` (hex SHA-256 of the UTF-8 text).
+    """
+    if not content:
+        return {'size': 0, 'line_count': 0, 'content_hash': EMPTY_CONTENT_HASH}
+
+    data = content.encode('utf-8')
+    if codecs.lookup(encoding).name == 'utf-8':
+        size = len(data)
+    else:
+        size = len(content.encode(encoding))
+    return {
+        'size': size,
+        'line_count': len(content.splitlines()),
+        'content_hash': hashlib.sha256(data).hexdigest(),
+    }
+
+
+def count_subquery(model, fk_name):
+    """Correlated COUNT of ``model`` rows whose ``fk_name`` points at the outer row.
+
+    Subqueries keep several counts in one SELECT without the row
+    multiplication that joining multiple reverse relations would cause.
+    """
+    counts = (
+        model.objects.filter(**{fk_name: OuterRef('pk')})
+        .order_by()
+        .values(fk_name)
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    return Coalesce(Subquery(counts, output_field=models.IntegerField()), 0)
+
+
+class FolderQuerySet(models.QuerySet):
+    def with_counts(self):
+        """Annotate ``children_count`` and ``files_count`` in the same query."""
+        return self.annotate(
+            children_count=count_subquery(Folder, 'parent'),
+            files_count=count_subquery(File, 'folder'),
+        )
 
 
 class Folder(models.Model):
@@ -9,8 +63,12 @@ class Folder(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='folders')
     name = models.CharField(max_length=255)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='children')
+    path = models.CharField(max_length=1000, blank=True, editable=False,
+                            help_text='Materialized full path, maintained on save')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    objects = FolderQuerySet.as_manager()
     
     class Meta:
         db_table = 'folder'
@@ -18,20 +76,88 @@ class Folder(models.Model):
         ordering = ['name']
         indexes = [
             models.Index(fields=['project', 'parent']),
+            models.Index(fields=['project', 'path']),
+            # Lets PostgreSQL use the index for path__startswith subtree lookups
+            models.Index(fields=['path'], name='folder_path_prefix_idx',
+                         opclasses=['varchar_pattern_ops']),
         ]
     
     def __str__(self):
-        if self.parent:
-            return f"{self.parent}/{self.name}"
-        return self.name
+        return self.full_path
     
     @property
     def full_path(self):
         """Get full path of folder."""
+        return self.path or self.name
+
+    def build_path(self):
+        """Compute the path from the parent's stored path (one level, no recursion)."""
         if self.parent:
-            return f"{self.parent.full_path}/{self.name}"
+            return f"{self.parent.path}/{self.name}"
         return self.name
 
+    def save(self, *args, **kwargs):
+        """Override save to keep the materialized paths of the subtree in sync."""
+        self.path = self.build_path()
+        old_path = None
+        if self.pk:
+            old_path = Folder.objects.filter(pk=self.pk).values_list('path', flat=True).first()
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if old_path and old_path != self.path:
+                self.rewrite_subtree_paths(old_path)
+            if old_path is None:
+                ProjectStats.invalidate(self.project_id)
+
+    def delete(self, *args, **kwargs):
+        """Override delete to drop cached project stats (files go with the folder)."""
+        result = super().delete(*args, **kwargs)
+        ProjectStats.invalidate(self.project_id)
+        return result
+
+    def descendant_ids(self):
+        """Ids of every folder beneath this one, found by following parent links.
+
+        One query per depth level. Paths can't select the subtree: a name may
+        itself contain ``/``, so an unrelated folder named ``a/b`` shares the
+        ``a/`` prefix with the children of ``a``.
+        """
+        ids, level = [], [self.pk]
+        while level:
+            level = list(Folder.objects.filter(parent_id__in=level).values_list('pk', flat=True))
+            ids.extend(level)
+        return ids
+
+    def rewrite_subtree_paths(self, old_path):
+        """Move every descendant folder and file from ``old_path`` to ``self.path``.
+
+        One UPDATE for folders and one for files, whatever the depth of the tree.
+        """
+        now = timezone.now()
+        new_path = Concat(
+            Value(self.path), Substr('path', len(old_path) + 1),
+            output_field=models.CharField(),
+        )
+        descendants = self.descendant_ids()
+        Folder.objects.filter(pk__in=descendants).update(path=new_path, updated_at=now)
+        File.objects.filter(folder_id__in=[self.pk, *descendants]).update(path=new_path, updated_at=now)
+
+    def is_descendant_of(self, folder):
+        """Whether this folder is ``folder`` or lies somewhere beneath it."""
+        if self.project_id != folder.project_id:
+            return False
+        # Every descendant's path starts with the ancestor's, but a name holding
+        # '/' can fake the prefix, so matches are confirmed through parent links
+        if self.path != folder.path and not self.path.startswith(f'{folder.path}/'):
+            return False
+        node = self
+        while node is not None:
+            if node.pk == folder.pk:
+                return True
+            node = node.parent
+        return False
+
 
 class File(models.Model):
     """File model for storing code files."""
@@ -49,6 +175,9 @@ class File(models.Model):
     language = models.CharField(max_length=50, default='javascript', help_text='Programming language')
     encoding = models.CharField(max_length=20, default='utf-8')
     size = models.IntegerField(default=0, help_text='File size in bytes')
+    line_count = models.IntegerField(default=0, help_text='Number of lines in file')
+    content_hash = models.CharField(max_length=64, blank=True, default=EMPTY_CONTENT_HASH,
+                                    help_text='SHA-256 of the content')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey('auth.User', on_delete=models.SET_NULL, null=True, related_name='created_files')
@@ -62,6 +191,10 @@ class File(models.Model):
             models.Index(fields=['project', 'folder']),
             models.Index(fields=['project', 'language']),
             models.Index(fields=['project', '-updated_at']),
+            models.Index(fields=['project', 'content_hash']),
+            models.Index(fields=['project', 'line_count']),
+            models.Index(fields=['path'], name='file_path_prefix_idx',
+                         opclasses=['varchar_pattern_ops']),
         ]
     
     def __str__(self):
@@ -69,25 +202,64 @@ class File(models.Model):
             return f"{self.project.name}/{self.path}/{self.name}"
         return f"{self.project.name}/{self.name}"
     
+    # Fields content_metadata() depends on
+    METADATA_SOURCES = ('content', 'encoding')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stored_sources = instance.metadata_sources()
+        return instance
+
+    def metadata_sources(self):
+        """The loaded values of ``METADATA_SOURCES`` (deferred ones are left out)."""
+        return {field: self.__dict__[field] for field in self.METADATA_SOURCES if field in self.__dict__}
+
+    def metadata_changed(self):
+        """Whether content or encoding changed since the row was loaded or saved."""
+        stored = getattr(self, '_stored_sources', None)
+        if self._state.adding or stored is None:
+            return True
+        return any(stored.get(field, value) != value for field, value in self.metadata_sources().items())
+
     def save(self, *args, **kwargs):
-        """Override save to update path and size."""
+        """Override save to update path and content metadata."""
         # Update path based on folder
         if self.folder:
-            self.path = self.folder.full_path
+            self.path = self.folder.path
         else:
             self.path = ''
         
-        # Update size based on content
-        if self.content:
-            self.size = len(self.content.encode(self.encoding))
+        # Update size, line count and hash only when the content is written
+        # and may have changed, not on renames and moves
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None:
+            recompute = self.metadata_changed()
         else:
-            self.size = 0
+            recompute = not {*self.METADATA_SOURCES}.isdisjoint(update_fields)
+        if recompute:
+            metadata = content_metadata(self.content, self.encoding)
+            for field, value in metadata.items():
+                setattr(self, field, value)
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, *metadata}
         
         # Detect language from file extension if not set
         if not self.language or self.language == 'javascript':
             self.language = self._detect_language()
         
         super().save(*args, **kwargs)
+        written = self.metadata_sources()
+        if update_fields is not None:
+            written = {field: value for field, value in written.items() if field in update_fields}
+        self._stored_sources = {**getattr(self, '_stored_sources', {}), **written}
+        ProjectStats.invalidate(self.project_id)
+
+    def delete(self, *args, **kwargs):
+        """Override delete to drop cached project stats."""
+        result = super().delete(*args, **kwargs)
+        ProjectStats.invalidate(self.project_id)
+        return result
     
     def _detect_language(self):
         """Detect programming language from file extension."""
@@ -138,8 +310,7 @@ class File(models.Model):
         return self.name
     
     @property
-    def line_count(self):
-        """Get number of lines in file."""
-        if self.content:
-            return len(self.content.splitlines())
-        return 0
+    def etag(self):
+        """Strong validator for the file's current state (content and metadata)."""
+        version = int(self.updated_at.timestamp() * 1_000_000) if self.updated_at else 0
+        return f'"{self.content_hash[:32]}.{version}"'
@@ -0,0 +1,6 @@
+from config.pagination import KeysetPagination
+
+
+class FileCursorPagination(KeysetPagination):
+    """Keyset pagination over the file listing order (path, name, id)."""
+    ordering = ('path', 'name', 'id')
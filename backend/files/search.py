@@ -0,0 +1,374 @@
+"""
+Content search across project files.
+
+The database narrows the candidate files with an index and only those are
+scanned in Python to report line numbers and snippets:
+
+* PostgreSQL: pg_trgm GIN indexes on ``file.content``, ``name`` and ``path``,
+  which ``LIKE``/``ILIKE`` and ``~``/``~*`` (regex) lookups use directly.
+  Django's ``icontains`` compiles to ``UPPER(column) LIKE UPPER(...)``, which
+  they can't serve, so case-insensitive searches use ``trigram_icontains``.
+  Regexes are rewritten from Python's syntax into PostgreSQL's.
+* SQLite (development): an FTS5 table using the trigram tokenizer, kept in
+  sync with ``file.content`` by triggers. Regex searches aren't narrowed:
+  SQLite's ``REGEXP`` runs Python's ``re`` on every row anyway.
+
+Both indexes are created by migration ``0005_file_search_index`` and
+maintained by the database on every write, including bulk updates, so there
+is nothing to re-index by hand.
+"""
+import re
+
+from django.db import connections
+from django.db.models import CharField, TextField
+from django.db.models.expressions import RawSQL
+from django.db.models.lookups import IContains
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+FTS_TABLE = 'file_search'
+SQLITE_TRIGGERS = {
+    'file_search_ai': f"""
+        CREATE TRIGGER IF NOT EXISTS file_search_ai AFTER INSERT ON file BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+        END""",
+    'file_search_ad': f"""
+        CREATE TRIGGER IF NOT EXISTS file_search_ad AFTER DELETE ON file BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        END""",
+    'file_search_au': f"""
+        CREATE TRIGGER IF NOT EXISTS file_search_au AFTER UPDATE OF content ON file BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+            INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+        END""",
+}
+
+MAX_QUERY_LENGTH = 256
+# Trigram indexes can't help with shorter substrings
+MIN_INDEXED_LENGTH = 3
+# Characters of context kept on each side of a match in snippets
+SNIPPET_CONTEXT = 80
+# Largest {m,n} bound PostgreSQL accepts in a regex
+MAX_REGEX_REPEAT = 255
+
+
+class SearchError(ValueError):
+    """Raised for queries that can't be run (empty, too long, bad regex)."""
+
+
+@CharField.register_lookup
+@TextField.register_lookup
+class TrigramIContains(IContains):
+    """``icontains`` compiled to ``ILIKE`` on PostgreSQL, where trigram indexes serve it."""
+
+    lookup_name = 'trigram_icontains'
+
+    def as_sql(self, compiler, connection):
+        return IContains(self.lhs, self.rhs).as_sql(compiler, connection)
+
+    def as_postgresql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} ILIKE {rhs}', (*lhs_params, *rhs_params)
+
+
+def ensure_index(using='default', **kwargs):
+    """Restore the SQLite sync triggers if a migration dropped them.
+
+    SQLite migrations that alter ``file`` rebuild the table, which silently
+    drops its triggers. Connected to ``post_migrate``.
+    """
+    connection = connections[using]
+    if connection.vendor != 'sqlite' or not _has_fts_table(connection):
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'file'"
+        )
+        if set(SQLITE_TRIGGERS) <= {row[0] for row in cursor.fetchall()}:
+            return
+        _install_sqlite_triggers(cursor)
+
+
+def _install_sqlite_triggers(cursor):
+    for sql in SQLITE_TRIGGERS.values():
+        cursor.execute(sql)
+    cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def _has_fts_table(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE]
+        )
+        return cursor.fetchone() is not None
+
+
+def compile_pattern(query, regex=False, case_sensitive=False):
+    """Compile the search query into the pattern used to locate matches."""
+    if not query:
+        raise SearchError('Search query cannot be empty.')
+    if len(query) > MAX_QUERY_LENGTH:
+        raise SearchError(f'Search query cannot be longer than {MAX_QUERY_LENGTH} characters.')
+
+    flags = re.MULTILINE
+    if not case_sensitive:
+        flags |= re.IGNORECASE
+    if not regex:
+        return re.compile(re.escape(query), flags)
+    try:
+        pattern = re.compile(query, flags)
+    except re.error as exc:
+        raise SearchError(f'Invalid regular expression: {exc}')
+    _check_repeats(sre_parse.parse(query, flags))
+    return pattern
+
+
+def _check_repeats(items, repeated=False):
+    """Reject unbounded repeats nested in unbounded repeats, like ``(a+)+``.
+
+    ``find_matches`` runs the pattern with Python's backtracking engine,
+    which takes exponential time on those when a line almost matches.
+    """
+    for op, av in items:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            unbounded = av[1] == sre_constants.MAXREPEAT
+            if unbounded and repeated:
+                raise SearchError('Regular expressions cannot nest unbounded repeats like (a+)+.')
+            _check_repeats(av[2], repeated or unbounded)
+        elif op == sre_constants.SUBPATTERN:
+            _check_repeats(av[3], repeated)
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                _check_repeats(branch, repeated)
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            _check_repeats(av[1], repeated)
+
+
+def postgres_regex(query, case_sensitive=False):
+    """Rewrite a Python regex as a PostgreSQL one, as ``(options, pattern)``.
+
+    The pattern is built from Python's parse of ``query``, so whatever
+    Python's syntax allows is either spelled the way PostgreSQL expects or
+    rejected with a ``SearchError``. It only has to find every file the
+    Python pattern matches in: ``options`` makes ``^`` and ``$`` match at
+    line boundaries, as in ``compile_pattern``, but lets ``.`` match
+    newlines, so that ``[^...]`` does too as it does in Python.
+    """
+    flags = re.MULTILINE if case_sensitive else re.MULTILINE | re.IGNORECASE
+    parsed = sre_parse.parse(query, flags)
+    options = 'wi' if parsed.state.flags & re.IGNORECASE else 'w'
+    return options, _postgres_sequence(parsed)
+
+
+def _postgres_char(code):
+    char = chr(code)
+    if char.isprintable() and char not in _POSTGRES_SPECIAL:
+        return char
+    return rf'\u{code:04x}' if code <= 0xffff else rf'\U{code:08x}'
+
+
+# Characters spelled as \u escapes, which are literal inside and outside [...]
+_POSTGRES_SPECIAL = set('\\^$.|?*+()[]{}-')
+
+_POSTGRES_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: (r'\d', '[:digit:]'),
+    sre_constants.CATEGORY_NOT_DIGIT: (r'\D', None),
+    sre_constants.CATEGORY_SPACE: (r'\s', '[:space:]'),
+    sre_constants.CATEGORY_NOT_SPACE: (r'\S', None),
+    sre_constants.CATEGORY_WORD: (r'\w', '[:alnum:]_'),
+    sre_constants.CATEGORY_NOT_WORD: (r'\W', None),
+}
+
+_POSTGRES_ANCHORS = {
+    sre_constants.AT_BEGINNING: '^',
+    sre_constants.AT_END: '$',
+    sre_constants.AT_BEGINNING_STRING: r'\A',
+    sre_constants.AT_END_STRING: r'\Z',
+    sre_constants.AT_BOUNDARY: r'\y',
+    sre_constants.AT_NON_BOUNDARY: r'\Y',
+}
+
+# Python constructs PostgreSQL has no equivalent for
+_UNSUPPORTED = {
+    'ATOMIC_GROUP': 'atomic groups (?>...)',
+    'POSSESSIVE_REPEAT': 'possessive repeats like a*+',
+    'GROUPREF_EXISTS': 'conditional groups like (?(1)...)',
+    'GROUPREF': 'more than 9 backreferences',
+}
+
+_SINGLE_ITEMS = (
+    sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY,
+    sre_constants.IN, sre_constants.SUBPATTERN, sre_constants.GROUPREF,
+)
+
+
+def _postgres_sequence(items):
+    return ''.join(_postgres_item(op, av) for op, av in items)
+
+
+def _postgres_item(op, av):
+    if op == sre_constants.LITERAL:
+        return _postgres_char(av)
+    if op == sre_constants.NOT_LITERAL:
+        return f'[^{_postgres_char(av)}]'
+    if op == sre_constants.ANY:
+        return '.'
+    if op == sre_constants.IN:
+        return _postgres_set(av)
+    if op == sre_constants.AT:
+        return _POSTGRES_ANCHORS[av]
+    if op == sre_constants.BRANCH:
+        return '(?:{})'.format('|'.join(_postgres_sequence(branch) for branch in av[1]))
+    if op == sre_constants.SUBPATTERN:
+        group, add_flags, del_flags, items = av
+        if add_flags or del_flags:
+            raise SearchError('Regular expressions cannot set flags on a group, like (?i:...).')
+        return f'({_postgres_sequence(items)})' if group else f'(?:{_postgres_sequence(items)})'
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+        return _postgres_repeat(op, *av)
+    if op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        direction, items = av
+        body = _postgres_sequence(items)
+        if re.search(r'\\[1-9]', body):
+            raise SearchError('Regular expressions cannot use backreferences in lookarounds.')
+        kind = '=' if op == sre_constants.ASSERT else '!'
+        return f'(?{"<" if direction < 0 else ""}{kind}{body})'
+    if op == sre_constants.GROUPREF and av < 10:
+        return rf'\{av}'
+    raise SearchError(f'Regular expressions cannot use {_UNSUPPORTED.get(str(op), str(op))}.')
+
+
+def _postgres_set(items):
+    if len(items) == 1 and items[0][0] == sre_constants.CATEGORY:
+        return _POSTGRES_CATEGORIES[items[0][1]][0]
+    parts = []
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            parts.insert(0, '^')
+        elif op == sre_constants.LITERAL:
+            parts.append(_postgres_char(av))
+        elif op == sre_constants.RANGE:
+            parts.append(f'{_postgres_char(av[0])}-{_postgres_char(av[1])}')
+        elif op == sre_constants.CATEGORY and _POSTGRES_CATEGORIES[av][1]:
+            parts.append(_POSTGRES_CATEGORIES[av][1])
+        else:
+            raise SearchError(r'Regular expressions cannot use \D, \S or \W inside [...].')
+    return f'[{"".join(parts)}]'
+
+
+def _postgres_repeat(op, low, high, items):
+    if low > MAX_REGEX_REPEAT or (high != sre_constants.MAXREPEAT and high > MAX_REGEX_REPEAT):
+        raise SearchError(f'Regular expression repeats cannot be larger than {MAX_REGEX_REPEAT}.')
+    body = _postgres_sequence(items)
+    if len(items) != 1 or items[0][0] not in _SINGLE_ITEMS:
+        body = f'(?:{body})'
+    if high == sre_constants.MAXREPEAT:
+        quantifier = {0: '*', 1: '+'}.get(low, f'{{{low},}}')
+    elif (low, high) == (0, 1):
+        quantifier = '?'
+    elif low == high:
+        quantifier = f'{{{low}}}'
+    else:
+        quantifier = f'{{{low},{high}}}'
+    return body + quantifier + ('?' if op == sre_constants.MIN_REPEAT else '')
+
+
+def filter_candidates(queryset, query, regex=False, case_sensitive=False):
+    """Narrow ``queryset`` to files whose content may match, using the index."""
+    connection = connections[queryset.db]
+    if regex:
+        if connection.vendor != 'postgresql':
+            return queryset
+        options, pattern = postgres_regex(query, case_sensitive=case_sensitive)
+        return queryset.filter(content__regex=f'(?{options}){pattern}')
+
+    if (
+        connection.vendor == 'sqlite'
+        and len(query) >= MIN_INDEXED_LENGTH
+        and _has_fts_table(connection)
+    ):
+        # The trigram tokenizer matches a quoted phrase as a case-insensitive substring
+        phrase = '"{}"'.format(query.replace('"', '""'))
+        return queryset.filter(
+            pk__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [phrase])
+        )
+
+    lookup = 'content__contains' if case_sensitive else 'content__trigram_icontains'
+    return queryset.filter(**{lookup: query})
+
+
+def find_matches(content, pattern, limit):
+    """Return up to ``limit`` matches of ``pattern`` in ``content``.
+
+    Each match has its 1-based ``line`` and ``column``, and a ``snippet`` of
+    the line with the ``highlight`` offsets of the match inside it. Returns
+    ``(matches, truncated)``.
+    """
+    matches = []
+    line = 1
+    scanned_to = 0
+    for match in pattern.finditer(content):
+        start, end = match.span()
+        if start == end:
+            continue
+        if len(matches) >= limit:
+            return matches, True
+
+        line += content.count('\n', scanned_to, start)
+        scanned_to = start
+        line_start = content.rfind('\n', 0, start) + 1
+        line_end = content.find('\n', start)
+        if line_end == -1:
+            line_end = len(content)
+        # Matches spanning lines are reported on the line they start on
+        end = min(end, line_end)
+
+        snippet_start = max(line_start, start - SNIPPET_CONTEXT)
+        snippet_end = min(line_end, end + SNIPPET_CONTEXT)
+        matches.append({
+            'line': line,
+            'column': start - line_start + 1,
+            'snippet': content[snippet_start:snippet_end].rstrip('\r'),
+            'highlight': [start - snippet_start, end - snippet_start],
+        })
+    return matches, False
+
+
+def search_files(queryset, query, regex=False, case_sensitive=False,
+                 limit=50, matches_per_file=20):
+    """Search the content of the files in ``queryset``.
+
+    Returns ``(results, truncated)`` where ``results`` lists up to ``limit``
+    matching files, in path order, with their matches.
+    """
+    pattern = compile_pattern(query, regex=regex, case_sensitive=case_sensitive)
+    candidates = (
+        filter_candidates(queryset, query, regex=regex, case_sensitive=case_sensitive)
+        .select_related(None)
+        .only('id', 'project_id', 'name', 'path', 'language', 'content')
+        .order_by('path', 'name', 'id')
+    )
+
+    results = []
+    for file in candidates.iterator(chunk_size=100):
+        matches, more = find_matches(file.content, pattern, matches_per_file)
+        if not matches:
+            # The index only narrows candidates; the pattern decides
+            continue
+        if len(results) >= limit:
+            return results, True
+        results.append({
+            'id': file.id,
+            'project': file.project_id,
+            'name': file.name,
+            'full_path': file.full_path,
+            'language': file.language,
+            'matches': matches,
+            'truncated': more,
+        })
+    return results, False
@@ -2,6 +2,16 @@ from rest_framework import serializers
 from .models import File, Folder
 
 
+class SparseFieldsetMixin:
+    """Let callers restrict the serialized fields with ``fields=[...]``."""
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
 class FolderSerializer(serializers.ModelSerializer):
     """Serializer for Folder model."""
     full_path = serializers.CharField(read_only=True)
@@ -15,19 +25,30 @@ class FolderSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'created_at', 'updated_at', 'full_path',
                           'children_count', 'files_count')
     
+    def validate(self, attrs):
+        """Prevent moving a folder into itself or one of its descendants."""
+        parent = attrs.get('parent')
+        if self.instance and parent and parent.is_descendant_of(self.instance):
+            raise serializers.ValidationError({'parent': 'A folder cannot be moved into itself.'})
+        return attrs
+    
     def get_children_count(self, obj):
-        """Get number of child folders."""
-        return obj.children.count()
+        """Get number of child folders (annotated by the viewset's queryset)."""
+        count = getattr(obj, 'children_count', None)
+        return obj.children.count() if count is None else count
     
     def get_files_count(self, obj):
-        """Get number of files in folder."""
-        return obj.files.count()
+        """Get number of files in folder (annotated by the viewset's queryset)."""
+        count = getattr(obj, 'files_count', None)
+        return obj.files.count() if count is None else count
 
 
-class FileListSerializer(serializers.ModelSerializer):
+class FileListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Serializer for listing files with basic info."""
+    # Fields dropped by the lean listing mode; content is loaded per file instead
+    LEAN_EXCLUDED_FIELDS = ('content',)
+
     full_path = serializers.CharField(read_only=True)
-    line_count = serializers.IntegerField(read_only=True)
     created_by_username = serializers.CharField(source='created_by.username', read_only=True)
     updated_by_username = serializers.CharField(source='updated_by.username', read_only=True)
     
@@ -35,16 +56,15 @@ class FileListSerializer(serializers.ModelSerializer):
         model = File
         # Include content so the frontend gets the latest saved text when listing files
         fields = ('id', 'name', 'path', 'full_path', 'language', 'size',
-                  'content', 'line_count', 'created_by_username', 'updated_by_username',
-                  'created_at', 'updated_at')
+                  'content', 'line_count', 'content_hash', 'created_by_username',
+                  'updated_by_username', 'created_at', 'updated_at')
         read_only_fields = ('id', 'created_at', 'updated_at', 'full_path', 
-                          'line_count', 'size')
+                          'line_count', 'content_hash', 'size')
 
 
-class FileSerializer(serializers.ModelSerializer):
+class FileSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Full serializer for file details."""
     full_path = serializers.CharField(read_only=True)
-    line_count = serializers.IntegerField(read_only=True)
     created_by_username = serializers.CharField(source='created_by.username', read_only=True)
     updated_by_username = serializers.CharField(source='updated_by.username', read_only=True)
     folder_name = serializers.CharField(source='folder.name', read_only=True)
@@ -52,10 +72,10 @@ class FileSerializer(serializers.ModelSerializer):
     class Meta:
         model = File
         fields = ('id', 'name', 'path', 'full_path', 'folder', 'folder_name', 'project',
-                  'content', 'language', 'encoding', 'size', 'line_count',
+                  'content', 'language', 'encoding', 'size', 'line_count', 'content_hash',
                   'created_by', 'created_by_username', 'updated_by', 'updated_by_username',
                   'created_at', 'updated_at')
-        read_only_fields = ('id', 'path', 'full_path', 'size', 'line_count',
+        read_only_fields = ('id', 'path', 'full_path', 'size', 'line_count', 'content_hash',
                           'created_at', 'updated_at', 'created_by_username', 'updated_by_username')
     
     def __init__(self, *args, **kwargs):
@@ -1,3 +1,347 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
+
+from projects.models import Project
+from . import search
+from .models import File, Folder, content_metadata
+from .serializers import FileSerializer
+
+MEMORY_LAYER = {'default': {'BACKEND': 'realtime.layers.InMemoryChannelLayer'}}
+
+
+class PostgresRegexTests(SimpleTestCase):
+    def assertTranslates(self, query, pattern, options='wi'):
+        self.assertEqual(search.postgres_regex(query), (options, pattern))
+
+    def test_rewrites_python_syntax(self):
+        self.assertTranslates(r'(?P<name>\w+)=(?P=name)', r'(\w+)=\1')
+        self.assertTranslates(r'\bdef\B', r'\ydef\Y')
+        self.assertTranslates(r'[^a-z\d-]+$', r'[^a-z[:digit:]\u002d]+$')
+        self.assertTranslates('foo|bar', '(?:foo|bar)')
+        self.assertTranslates(r'a\.b\\', r'a\u002eb\u005c')
+        self.assertTranslates('(?:ab)*?x{2,}', '(?:ab)*?x{2,}')
+
+    def test_inline_flags_become_options(self):
+        self.assertEqual(search.postgres_regex('Foo', case_sensitive=True), ('w', 'Foo'))
+        self.assertEqual(search.postgres_regex('(?i)Foo', case_sensitive=True), ('wi', 'Foo'))
+        self.assertTranslates('(?x) a b # comment', 'ab')
+
+    def test_rejects_what_postgres_cannot_run(self):
+        for query in ['(?i:a)', '(?>a)', 'a{300}', r'(a)(?=\1)', r'(a)?(?(1)b|c)', r'[\Wx]']:
+            with self.subTest(query=query), self.assertRaises(search.SearchError):
+                search.postgres_regex(query)
+
+    def test_rejects_nested_unbounded_repeats(self):
+        for query in ['(a+)+', r'(\w+\s?)*$', '(?:a|b*)+']:
+            with self.subTest(query=query), self.assertRaises(search.SearchError):
+                search.compile_pattern(query, regex=True)
+        search.compile_pattern('(ab{1,3})+', regex=True)
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER)
+class ContentMetadataTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.client.force_authenticate(self.user)
+        self.project = Project.objects.create(name='p', owner=self.user)
+        self.file = File.objects.create(project=self.project, name='a.py', content='a\nb\n',
+                                        created_by=self.user)
+
+    def test_metadata_is_only_recomputed_when_content_is_written(self):
+        url = f'/api/files/{self.file.pk}/'
+        with mock.patch('files.models.content_metadata', wraps=content_metadata) as compute:
+            self.assertEqual(self.client.patch(url, {'name': 'b.py'}).status_code, 200)
+            file = File.objects.get(pk=self.file.pk)
+            file.name = 'c.py'
+            file.save()
+            self.assertFalse(compute.called)
+
+            self.client.patch(url, {'content': 'a\nb\nc'})
+            self.assertEqual(compute.call_count, 1)
+            file.refresh_from_db()
+            file.save(update_fields=['content'])
+            self.assertEqual(compute.call_count, 2)
+
+        file = File.objects.get(pk=self.file.pk)
+        self.assertEqual(file.name, 'c.py')
+        self.assertEqual(
+            {field: getattr(file, field) for field in ('size', 'line_count', 'content_hash')},
+            content_metadata('a\nb\nc'),
+        )
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER)
+class SearchEndpointTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.client.force_authenticate(self.user)
+        self.project = Project.objects.create(name='p', owner=self.user)
+        self.file = File.objects.create(
+            project=self.project, name='app.py', created_by=self.user,
+            content='import os\n\ndef Handler(request):\n    return request\n',
+        )
+        File.objects.create(project=self.project, name='notes.txt', content='nothing here\n', created_by=self.user)
+
+    def search(self, **params):
+        return self.client.get('/api/files/search/', params)
+
+    def test_substring_search_reports_lines(self):
+        response = self.search(q='handler')
+        self.assertEqual(response.status_code, 200)
+        [result] = response.data['results']
+        self.assertEqual(result['name'], 'app.py')
+        self.assertEqual(result['matches'][0]['line'], 3)
+        self.assertEqual(result['matches'][0]['snippet'], 'def Handler(request):')
+
+        self.assertEqual(self.search(q='handler', case_sensitive='true').data['results'], [])
+
+    def test_index_follows_updates(self):
+        self.file.content = 'changed\n'
+        self.file.save()
+        self.assertEqual(self.search(q='handler').data['results'], [])
+        self.assertEqual(len(self.search(q='changed').data['results']), 1)
+
+    def test_regex_search(self):
+        response = self.search(q=r'^def (?P<name>\w+)', regex='true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['matches'][0]['line'], 3)
+
+    def test_regex_inline_flags(self):
+        response = self.search(q='(?i)^HANDLER|^def handler', regex='true', case_sensitive='true')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_bad_regex_is_rejected(self):
+        for query in ['(', '(a+)+b', 'x' * 300]:
+            with self.subTest(query=query):
+                self.assertEqual(self.search(q=query, regex='true').status_code, 400)
+
+    def test_name_filter_is_case_insensitive(self):
+        response = self.client.get('/api/files/', {'search': 'APP'})
+        self.assertEqual([file['name'] for file in response.data], ['app.py'])
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER)
+class ConditionalRequestTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.client.force_authenticate(self.user)
+        self.project = Project.objects.create(name='p', owner=self.user)
+        self.files = [
+            File.objects.create(project=self.project, name=f'{name}.py', content=name, created_by=self.user)
+            for name in ('a', 'b', 'c')
+        ]
+
+    def list(self, etag=None, **params):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return self.client.get('/api/files/', {'project': self.project.pk, **params}, **headers)
+
+    def test_list_answers_not_modified_from_an_aggregate(self):
+        etag = self.list()['ETag']
+        with self.assertNumQueries(1):
+            response = self.list(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_list_etag_changes_with_the_files(self):
+        etag = self.list()['ETag']
+        self.client.patch(f'/api/files/{self.files[1].pk}/', {'content': 'changed'})
+        updated = self.list(etag)
+        self.assertEqual(updated.status_code, 200)
+        self.assertNotEqual(updated['ETag'], etag)
+
+        File.objects.filter(pk=self.files[0].pk).delete()
+        self.assertNotEqual(self.list()['ETag'], updated['ETag'])
+
+    def test_page_etag_covers_its_rows_and_cursor(self):
+        first = self.list(page_size=2)
+        self.assertEqual([file['name'] for file in first.data['results']], ['a.py', 'b.py'])
+        self.assertEqual(self.list(first['ETag'], page_size=2).status_code, 304)
+
+        second = self.client.get(first.data['next'])
+        self.assertEqual([file['name'] for file in second.data['results']], ['c.py'])
+        self.assertNotEqual(second['ETag'], first['ETag'])
+
+        # Changes after the page don't invalidate it; changes on it do
+        self.client.patch(f'/api/files/{self.files[2].pk}/', {'content': 'changed'})
+        self.assertEqual(self.list(first['ETag'], page_size=2).status_code, 304)
+        self.client.patch(f'/api/files/{self.files[0].pk}/', {'content': 'changed'})
+        self.assertEqual(self.list(first['ETag'], page_size=2).status_code, 200)
+
+    def test_retrieve_and_update_preconditions(self):
+        url = f'/api/files/{self.files[0].pk}/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        response = self.client.patch(url, {'content': 'new'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        stale = self.client.patch(url, {'content': 'newer'}, HTTP_IF_MATCH=etag)
+        self.assertEqual(stale.status_code, 412)
+        self.assertEqual(stale['ETag'], response['ETag'])
+        self.files[0].refresh_from_db()
+        self.assertEqual(self.files[0].content, 'new')
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER)
+class FolderTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.client.force_authenticate(self.user)
+        self.project = Project.objects.create(name='p', owner=self.user)
+        self.src = Folder.objects.create(project=self.project, name='src')
+        self.lib = Folder.objects.create(project=self.project, name='lib', parent=self.src)
+        self.deep = Folder.objects.create(project=self.project, name='deep', parent=self.lib)
+        self.file = File.objects.create(project=self.project, folder=self.deep, name='a.py',
+                                        content='a\n', created_by=self.user)
+
+    def test_rename_rewrites_descendant_paths(self):
+        response = self.client.patch(f'/api/files/folders/{self.src.pk}/', {'name': 'source'})
+        self.assertEqual(response.status_code, 200)
+        self.deep.refresh_from_db()
+        self.file.refresh_from_db()
+        self.assertEqual(self.deep.path, 'source/lib/deep')
+        self.assertEqual(self.file.path, 'source/lib/deep')
+
+    def test_rename_leaves_a_sibling_sharing_the_prefix(self):
+        # A root folder named 'src/lib' looks like a child of 'src' by path alone
+        sibling = Folder.objects.create(project=self.project, name='src/lib')
+        other = File.objects.create(project=self.project, folder=sibling, name='b.py',
+                                    created_by=self.user)
+        response = self.client.patch(f'/api/files/folders/{self.src.pk}/', {'name': 'source'})
+        self.assertEqual(response.status_code, 200)
+        sibling.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((sibling.path, other.path), ('src/lib', 'src/lib'))
+        self.assertFalse(sibling.is_descendant_of(self.src))
+        self.deep.refresh_from_db()
+        self.assertEqual(self.deep.path, 'source/lib/deep')
+
+    def test_list_counts_in_a_constant_number_of_queries(self):
+        def add_folders(count):
+            for _ in range(count):
+                folder = Folder.objects.create(project=self.project, name=f'f{Folder.objects.count()}')
+                Folder.objects.create(project=self.project, name='child', parent=folder)
+                File.objects.create(project=self.project, folder=folder, name='x.py', created_by=self.user)
+
+        url = f'/api/files/folders/?project={self.project.pk}'
+        add_folders(3)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(len(response.data), 9)
+
+        add_folders(3)
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(url)
+        counts = {row['name']: (row['children_count'], row['files_count']) for row in response.data}
+        self.assertEqual(len(response.data), 15)
+        self.assertEqual(counts['f3'], (1, 1))
+        self.assertEqual((counts['src'], counts['deep']), ((1, 0), (0, 1)))
+
+    def test_move_into_itself_is_rejected(self):
+        for parent in (self.src, self.deep):
+            with self.subTest(parent=parent.name):
+                response = self.client.patch(f'/api/files/folders/{self.src.pk}/', {'parent': parent.pk})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('parent', response.data)
+
+    def test_copy_keeps_the_tree(self):
+        response = self.client.post(f'/api/files/folders/{self.src.pk}/copy/',
+                                    {'name': 'src2', 'parent_id': self.src.pk})
+        self.assertEqual(response.status_code, 201)
+        copy = File.objects.exclude(pk=self.file.pk).get(name='a.py')
+        self.assertEqual(copy.path, 'src/src2/lib/deep')
+        self.assertEqual((copy.content, copy.content_hash), (self.file.content, self.file.content_hash))
+        self.assertEqual(copy.folder.parent.parent.pk, response.data['id'])
+
+    def test_copy_levels_do_not_depend_on_names(self):
+        # A name containing '/' must not change which level a folder is copied at
+        Folder.objects.filter(pk=self.lib.pk).update(name='l/i/b')
+        self.lib.refresh_from_db()
+        self.lib.save()
+        response = self.client.post(f'/api/files/folders/{self.src.pk}/copy/', {'name': 'copy'})
+        self.assertEqual(response.status_code, 201)
+        deep = Folder.objects.get(name='deep', parent__parent_id=response.data['id'])
+        self.assertEqual(deep.parent.name, 'l/i/b')
+
+    def test_copy_skips_a_sibling_sharing_the_prefix(self):
+        sibling = Folder.objects.create(project=self.project, name='src/lib')
+        File.objects.create(project=self.project, folder=sibling, name='b.py', created_by=self.user)
+        response = self.client.post(f'/api/files/folders/{self.src.pk}/copy/', {'name': 'copy'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Folder.objects.filter(path__startswith='copy').count(), 3)
+        self.assertEqual(list(File.objects.filter(path__startswith='copy').values_list('name', flat=True)),
+                         ['a.py'])
+
+    def test_copy_validates_the_name(self):
+        for name in ('', ' ', 'x' * 256):
+            with self.subTest(name=name):
+                response = self.client.post(f'/api/files/folders/{self.src.pk}/copy/', {'name': name})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('name', response.data)
+        self.assertEqual(Folder.objects.count(), 3)
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER)
+class BulkOperationTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.client.force_authenticate(self.user)
+        self.project = Project.objects.create(name='p', owner=self.user)
+        self.folder = Folder.objects.create(project=self.project, name='src')
+        self.a = File.objects.create(project=self.project, name='a.py', content='a\n', created_by=self.user)
+        self.b = File.objects.create(project=self.project, name='b.py', content='b\n', created_by=self.user)
+
+    def bulk(self, *operations):
+        return self.client.post('/api/files/bulk/', {'operations': list(operations)}, format='json')
+
+    def test_rename_uses_the_serializer_name_rules(self):
+        for name in ('bad?.py', '   '):
+            with self.subTest(name=name):
+                serializer = FileSerializer(data={'name': name})
+                serializer.is_valid()
+                response = self.bulk({'op': 'rename', 'id': self.a.pk, 'name': name})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.data['results'][0]['error'], serializer.errors['name'][0])
+
+        response = self.bulk({'op': 'rename', 'id': self.a.pk, 'name': '  c.py '})
+        self.assertEqual(response.status_code, 200)
+        self.a.refresh_from_db()
+        self.assertEqual(self.a.name, 'c.py')
+
+    def test_batch_is_all_or_nothing(self):
+        response = self.bulk(
+            {'op': 'move', 'id': self.a.pk, 'folder_id': self.folder.pk},
+            {'op': 'rename', 'id': self.b.pk, 'name': 'x' * 256},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.data['applied'])
+        self.assertEqual([r['status'] for r in response.data['results']], ['ok', 'error'])
+        self.a.refresh_from_db()
+        self.assertIsNone(self.a.folder_id)
+
+    def test_names_can_change_hands_within_a_batch(self):
+        response = self.bulk(
+            {'op': 'rename', 'id': self.a.pk, 'name': 'b.py'},
+            {'op': 'rename', 'id': self.b.pk, 'name': 'a.py'},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.a.refresh_from_db()
+        self.b.refresh_from_db()
+        self.assertEqual((self.a.name, self.b.name), ('b.py', 'a.py'))
+
+    def test_collisions_are_rejected(self):
+        response = self.bulk({'op': 'copy', 'id': self.a.pk, 'name': 'b.py'})
+        self.assertEqual(response.status_code, 400)
+        response = self.bulk(
+            {'op': 'copy', 'id': self.a.pk, 'folder_id': self.folder.pk},
+            {'op': 'delete', 'id': self.b.pk},
+        )
+        self.assertEqual(response.status_code, 200)
+        copy = File.objects.get(folder=self.folder)
+        self.assertEqual((copy.path, copy.content), ('src', 'a\n'))
+        self.assertFalse(File.objects.filter(pk=self.b.pk).exists())
@@ -10,7 +10,8 @@ file_router.register(r'', FileViewSet, basename='file')
 folder_router = DefaultRouter()
 folder_router.register(r'', FolderViewSet, basename='folder')
 
+# Folders first: the file router's detail route would take 'folders/' as a file id
 urlpatterns = [
-    path('', include(file_router.urls)),
     path('folders/', include(folder_router.urls)),
+    path('', include(file_router.urls)),
 ]
@@ -1,12 +1,36 @@
+import hashlib
+
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Count, Max, Q
 from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags
 from .models import File, Folder
 from versions.models import Version
+from . import search as content_search
+from .bulk import BulkError, BulkOperations
+from .copying import copy_folder
+from .pagination import FileCursorPagination
 from .serializers import FileSerializer, FileListSerializer, FolderSerializer
 from projects.models import Project
+from realtime import events
+
+
+def etag_matches(header, etag, weak=False):
+    """Check an If-Match / If-None-Match header value against an ETag.
+
+    If-None-Match uses weak comparison (``weak=True``), If-Match strong.
+    """
+    etags = parse_etags(header)
+    if etags == ['*']:
+        return True
+    if weak:
+        etag = etag.removeprefix('W/')
+        return etag in (value.removeprefix('W/') for value in etags)
+    return etag in etags
 
 
 class FolderViewSet(viewsets.ModelViewSet):
@@ -16,24 +40,71 @@ class FolderViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         """Get folders for user's projects."""
+        queryset = Folder.objects.filter(project__owner=self.request.user)
         project_id = self.request.query_params.get('project', None)
         if project_id:
-            return Folder.objects.filter(
-                project_id=project_id,
-                project__owner=self.request.user
-            )
-        return Folder.objects.filter(project__owner=self.request.user)
+            queryset = queryset.filter(project_id=project_id)
+        return queryset.with_counts()
 
     def perform_create(self, serializer):
         """Validate project ownership before creating folder."""
         project_id = serializer.validated_data.get('project').id
         project = get_object_or_404(Project, id=project_id, owner=self.request.user)
-        serializer.save()
+        folder = serializer.save()
+        events.folder_changed('created', folder)
+
+    def perform_update(self, serializer):
+        """Notify project sockets when a folder is renamed or moved."""
+        old_name, old_parent_id = serializer.instance.name, serializer.instance.parent_id
+        folder = serializer.save()
+        if folder.parent_id != old_parent_id:
+            events.folder_changed('moved', folder)
+        elif folder.name != old_name:
+            events.folder_changed('renamed', folder)
+
+    def perform_destroy(self, instance):
+        events.folder_changed('deleted', instance)
+        instance.delete()
+
+    @action(detail=True, methods=['post'])
+    def copy(self, request, pk=None):
+        """Copy a folder with its subfolders and files to a different location or project."""
+        folder = self.get_object()
+        # Same rules as creating or renaming a folder
+        name_field = self.get_serializer().fields['name']
+        try:
+            new_name = name_field.run_validation(request.data.get('name', folder.name))
+        except ValidationError as exc:
+            raise ValidationError({'name': exc.detail})
+        parent_id = request.data.get('parent_id')
+        project_id = request.data.get('project_id', folder.project_id)
+
+        # Validate project ownership
+        project = get_object_or_404(Project, id=project_id, owner=request.user)
+
+        # Get parent folder if provided
+        parent = None
+        if parent_id:
+            parent = get_object_or_404(Folder, id=parent_id, project=project)
+
+        # Check if name already exists
+        if Folder.objects.filter(project=project, parent=parent, name=new_name).exists():
+            return Response(
+                {'error': 'A folder with this name already exists in the target location'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        new_folder = copy_folder(folder, request.user, project, parent=parent, name=new_name)
+        events.folder_changed('created', new_folder)
+
+        serializer = self.get_serializer(new_folder)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
 class FileViewSet(viewsets.ModelViewSet):
     """ViewSet for File CRUD operations."""
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = FileCursorPagination
 
     def get_queryset(self):
         """Get files for user's projects with filtering."""
@@ -60,9 +131,23 @@ class FileViewSet(viewsets.ModelViewSet):
         search = self.request.query_params.get('search', None)
         if search:
             queryset = queryset.filter(
-                Q(name__icontains=search) | Q(path__icontains=search)
+                Q(name__trigram_icontains=search) | Q(path__trigram_icontains=search)
             )
         
+        # Don't read file bodies from the database when they won't be serialized.
+        # A conditional retrieve only needs the ETag columns until it misses.
+        fields = self.get_requested_fields()
+        if (
+            self.action == 'stats'
+            or (fields is not None and 'content' not in fields)
+            or (self.action == 'retrieve' and 'If-None-Match' in self.request.headers)
+        ):
+            queryset = queryset.defer('content')
+
+        # Writes check If-Match against a locked row
+        if self.action in ('update', 'partial_update'):
+            queryset = queryset.select_for_update(of=('self',))
+
         return queryset.select_related('project', 'folder', 'created_by', 'updated_by')
 
     def get_serializer_class(self):
@@ -71,28 +156,158 @@ class FileViewSet(viewsets.ModelViewSet):
             return FileListSerializer
         return FileSerializer
 
+    def get_requested_fields(self):
+        """Resolve the ``fields`` and ``lean`` query parameters for list/retrieve.
+
+        ``fields=id,name,...`` selects a sparse fieldset; ``lean=true`` lists
+        files without their content. Returns None when all fields are wanted.
+        """
+        if self.action not in ('list', 'retrieve'):
+            return None
+
+        fields = self.request.query_params.get('fields')
+        if fields:
+            return [name.strip() for name in fields.split(',') if name.strip()]
+
+        lean = self.request.query_params.get('lean', '')
+        if self.action == 'list' and lean.lower() in ('1', 'true', 'yes'):
+            return [name for name in FileListSerializer.Meta.fields
+                    if name not in FileListSerializer.LEAN_EXCLUDED_FIELDS]
+        return None
+
+    def get_serializer(self, *args, **kwargs):
+        """Apply the requested sparse fieldset to list/retrieve responses."""
+        if self.request.method == 'GET':
+            kwargs.setdefault('fields', self.get_requested_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def get_representation_etag(self, etag):
+        """Tag an ETag with the requested fieldset so sparse responses differ."""
+        fields = self.get_requested_fields()
+        if fields is None:
+            return etag
+        variant = hashlib.sha1(','.join(fields).encode()).hexdigest()[:8]
+        return f'{etag[:-1]}-{variant}"'
+
+    def get_list_etag(self, queryset, page=None):
+        """Validator for a listing that doesn't read more rows than it lists.
+
+        A page is identified by its rows and whether another one follows,
+        the full listing by its size and latest change: every write to a
+        file, path rewrites included, moves its ``updated_at``.
+        """
+        digest = hashlib.sha256(self.request.get_full_path().encode())
+        if page is not None:
+            for file in page:
+                digest.update(f'{file.pk}:{file.content_hash}:{file.updated_at.isoformat()};'.encode())
+            digest.update(f'next:{self.paginator.has_next}'.encode())
+        else:
+            summary = queryset.order_by().aggregate(count=Count('pk'), latest=Max('updated_at'))
+            latest = summary['latest'].isoformat() if summary['latest'] else ''
+            digest.update(f'{summary["count"]}:{latest}'.encode())
+        return f'"{digest.hexdigest()[:40]}"'
+
+    def not_modified(self, etag):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        response['ETag'] = etag
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        """Make browsers revalidate cached file responses with their ETag."""
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if response.has_header('ETag'):
+            response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def list(self, request, *args, **kwargs):
+        """List files, answering 304 if the listing hasn't changed."""
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        etag = self.get_list_etag(queryset, page)
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and etag_matches(if_none_match, etag, weak=True):
+            return self.not_modified(etag)
+
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            response = self.get_paginated_response(serializer.data)
+        else:
+            serializer = self.get_serializer(queryset, many=True)
+            response = Response(serializer.data)
+        response['ETag'] = etag
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        """Return a file, answering 304 if the client's copy is current."""
+        instance = self.get_object()
+        etag = self.get_representation_etag(instance.etag)
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and etag_matches(if_none_match, etag, weak=True):
+            return self.not_modified(etag)
+
+        serializer = self.get_serializer(instance)
+        response = Response(serializer.data)
+        response['ETag'] = etag
+        return response
+
+    def update(self, request, *args, **kwargs):
+        """Update a file, rejecting writes based on a stale ETag with 412."""
+        partial = kwargs.pop('partial', False)
+        with transaction.atomic():
+            instance = self.get_object()
+            if_match = request.headers.get('If-Match')
+            if if_match and not etag_matches(if_match, instance.etag):
+                response = Response(
+                    {'error': 'File has been modified since it was fetched'},
+                    status=status.HTTP_412_PRECONDITION_FAILED
+                )
+                response['ETag'] = instance.etag
+                return response
+
+            serializer = self.get_serializer(instance, data=request.data, partial=partial)
+            serializer.is_valid(raise_exception=True)
+            self.perform_update(serializer)
+
+        response = Response(serializer.data)
+        response['ETag'] = serializer.instance.etag
+        return response
+
     def perform_create(self, serializer):
         """Set created_by and updated_by when creating file."""
         # Project ownership is validated by the serializer's queryset
         # created_by and updated_by are set in the serializer's create method
-        serializer.save()
+        file_obj = serializer.save()
+        events.file_changed('created', file_obj)
 
     def perform_update(self, serializer):
         """Set updated_by when updating file and create a snapshot if content changed."""
-        instance = self.get_object()
+        instance = serializer.instance
         old_content = instance.content
+        old_hash = instance.content_hash
+        old_name, old_folder_id = instance.name, instance.folder_id
 
         # Let DRF validate and update the instance
         file_obj = serializer.save(updated_by=self.request.user)
 
         # If content was part of the update and actually changed, create a Version snapshot
-        if 'content' in serializer.validated_data and old_content != file_obj.content:
-            Version.objects.create(
+        if 'content' in serializer.validated_data and old_hash != file_obj.content_hash:
+            Version.objects.create_snapshot(
                 file=file_obj,
                 content=old_content,
                 created_by=self.request.user,
-                description="Auto-snapshot before save"
+                description="Auto-snapshot before save",
+                kind=Version.KIND_AUTO,
             )
+            transaction.on_commit(lambda: events.file_saved(file_obj))
+
+        if file_obj.folder_id != old_folder_id:
+            events.file_changed('moved', file_obj)
+        elif file_obj.name != old_name:
+            events.file_changed('renamed', file_obj)
+
+    def perform_destroy(self, instance):
+        events.file_changed('deleted', instance)
+        instance.delete()
 
     @action(detail=True, methods=['post'])
     def rename(self, request, pk=None):
@@ -120,6 +335,7 @@ class FileViewSet(viewsets.ModelViewSet):
         file.name = new_name
         file.updated_by = request.user
         file.save()
+        events.file_changed('renamed', file)
         
         serializer = self.get_serializer(file)
         return Response(serializer.data)
@@ -154,6 +370,7 @@ class FileViewSet(viewsets.ModelViewSet):
         
         file.updated_by = request.user
         file.save()
+        events.file_changed('moved', file)
         
         serializer = self.get_serializer(file)
         return Response(serializer.data)
@@ -196,10 +413,69 @@ class FileViewSet(viewsets.ModelViewSet):
             created_by=request.user,
             updated_by=request.user
         )
+        events.file_changed('created', new_file)
         
         serializer = self.get_serializer(new_file)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """Move, rename, copy and delete many files in one request.
+
+        Body: ``{"operations": [{"op": "move", "id": 1, "folder_id": 2}, ...]}``
+        with ``op`` one of move (``folder_id``, null for the root), rename
+        (``name``), copy (optional ``name``, ``folder_id``, ``project_id``)
+        and delete. Either the whole batch is applied or nothing is; each
+        operation gets its own entry in ``results``.
+        """
+        operations = request.data.get('operations') if isinstance(request.data, dict) else None
+        try:
+            batch = BulkOperations(request.user, operations)
+        except BulkError as exc:
+            raise ValidationError({'operations': str(exc)})
+
+        if not batch.validate() or not batch.apply():
+            return Response(
+                {'applied': False, 'results': batch.results},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response({'applied': True, 'results': batch.results})
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """Search file contents.
+
+        Query parameters: ``q`` (required), ``regex`` and ``case_sensitive``
+        flags, ``limit`` (files, default 50) and ``matches`` (per file,
+        default 20). The usual ``project``/``folder``/``language`` filters
+        restrict which files are searched.
+        """
+        params = request.query_params
+        try:
+            limit = min(max(int(params.get('limit', 50)), 1), 200)
+            matches = min(max(int(params.get('matches', 20)), 1), 100)
+        except ValueError:
+            raise ValidationError({'limit': 'limit and matches must be integers.'})
+
+        query = params.get('q', '')
+        try:
+            results, truncated = content_search.search_files(
+                self.get_queryset(),
+                query,
+                regex=params.get('regex', '').lower() in ('1', 'true', 'yes'),
+                case_sensitive=params.get('case_sensitive', '').lower() in ('1', 'true', 'yes'),
+                limit=limit,
+                matches_per_file=matches,
+            )
+        except content_search.SearchError as exc:
+            raise ValidationError({'q': str(exc)})
+
+        return Response({
+            'query': query,
+            'results': results,
+            'truncated': truncated,
+        })
+
     @action(detail=True, methods=['get'])
     def stats(self, request, pk=None):
         """Get file statistics."""
@@ -27,6 +27,10 @@ class ProjectAdmin(admin.ModelAdmin):
         }),
     )
     
+    def get_queryset(self, request):
+        """Annotate counts so the changelist doesn't run two COUNTs per row."""
+        return super().get_queryset(request).with_counts()
+    
     def file_count(self, obj):
         """Display file count."""
         return obj.file_count
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0002_alter_project_options_project_default_language_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProjectStats',
+            fields=[
+                ('project', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='cached_stats', serialize=False, to='projects.project')),
+                ('data', models.JSONField()),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Project stats',
+                'db_table': 'project_stats',
+            },
+        ),
+    ]
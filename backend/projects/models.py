@@ -1,5 +1,19 @@
+from datetime import timedelta
+from django.conf import settings
 from django.db import models
+from django.db.models import Count, Sum
 from django.contrib.auth.models import User
+from django.utils import timezone
+
+
+class ProjectQuerySet(models.QuerySet):
+    def with_counts(self):
+        """Annotate file and folder counts in the same query."""
+        from files.models import File, Folder, count_subquery
+        return self.annotate(
+            annotated_file_count=count_subquery(File, 'project'),
+            annotated_folder_count=count_subquery(Folder, 'project'),
+        )
 
 
 class Project(models.Model):
@@ -17,6 +31,8 @@ class Project(models.Model):
     default_language = models.CharField(max_length=50, default='javascript', help_text='Default language for new files')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ProjectQuerySet.as_manager()
     
     class Meta:
         db_table = 'project'
@@ -32,9 +48,83 @@ class Project(models.Model):
     @property
     def file_count(self):
         """Get total number of files in project."""
+        if hasattr(self, 'annotated_file_count'):
+            return self.annotated_file_count
         return self.files.count()
     
     @property
     def folder_count(self):
         """Get total number of folders in project."""
+        if hasattr(self, 'annotated_folder_count'):
+            return self.annotated_folder_count
         return self.folders.count()
+
+    def compute_stats(self):
+        """Aggregate file statistics in the database.
+
+        A single grouped query returns per-language file counts, bytes and
+        lines; the project totals are summed from those rows so file content
+        is never loaded.
+        """
+        breakdown = list(
+            self.files.order_by()
+            .values('language')
+            .annotate(files=Count('id'), size=Sum('size'), lines=Sum('line_count'))
+            .order_by('-size', 'language')
+        )
+        return {
+            'file_count': sum(row['files'] for row in breakdown),
+            'folder_count': self.folder_count,
+            'total_size': sum(row['size'] or 0 for row in breakdown),
+            'total_lines': sum(row['lines'] or 0 for row in breakdown),
+            'languages': [row['language'] for row in breakdown],
+            'language_breakdown': breakdown,
+        }
+
+    def get_stats(self, refresh=False):
+        """Return project statistics, served from ``ProjectStats`` when fresh.
+
+        Caching is disabled with ``PROJECT_STATS_CACHE_TTL = 0``.
+        """
+        ttl = settings.PROJECT_STATS_CACHE_TTL
+        if ttl <= 0:
+            return self.compute_stats()
+
+        if not refresh:
+            cached = ProjectStats.objects.filter(
+                project=self, computed_at__gte=timezone.now() - timedelta(seconds=ttl)
+            ).values_list('data', flat=True).first()
+            if cached is not None:
+                return cached
+
+        stats = self.compute_stats()
+        ProjectStats.objects.bulk_create(
+            [ProjectStats(project=self, data=stats)],
+            update_conflicts=True, unique_fields=['project'], update_fields=['data', 'computed_at'],
+        )
+        return stats
+
+
+class ProjectStats(models.Model):
+    """Cached result of ``Project.compute_stats()``.
+
+    Rows are deleted whenever a file or folder of the project is written, so
+    a present row is current up to ``PROJECT_STATS_CACHE_TTL`` seconds, which
+    bounds staleness from writes that bypass ``invalidate()``.
+    """
+    project = models.OneToOneField(Project, on_delete=models.CASCADE, primary_key=True,
+                                   related_name='cached_stats')
+    data = models.JSONField()
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'project_stats'
+        verbose_name_plural = 'Project stats'
+
+    def __str__(self):
+        return f"Stats for project {self.project_id}"
+
+    @classmethod
+    def invalidate(cls, *project_ids):
+        """Drop cached stats for the given projects."""
+        cls.objects.filter(project_id__in=project_ids).delete()
@@ -1,3 +1,131 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APITestCase
 
-# Create your tests here.
+from files.models import File, Folder
+from .models import Project, ProjectStats
+
+MEMORY_LAYER = {'default': {'BACKEND': 'realtime.layers.InMemoryChannelLayer'}}
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER)
+class ProjectListTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.client.force_authenticate(self.user)
+
+    def add_projects(self, count):
+        for _ in range(count):
+            project = Project.objects.create(name='p', owner=self.user)
+            folder = Folder.objects.create(project=project, name='src')
+            File.objects.create(project=project, name='a.py', created_by=self.user)
+            File.objects.create(project=project, folder=folder, name='b.py', created_by=self.user)
+
+    def test_counts_are_annotated_in_a_constant_number_of_queries(self):
+        self.add_projects(3)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/projects/')
+        self.assertEqual(len(response.data), 3)
+
+        self.add_projects(3)
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get('/api/projects/')
+        self.assertEqual(len(response.data), 6)
+        self.assertEqual({(row['file_count'], row['folder_count']) for row in response.data}, {(2, 1)})
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER, PROJECT_STATS_CACHE_TTL=300)
+class ProjectStatsTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.client.force_authenticate(self.user)
+        self.project = Project.objects.create(name='p', owner=self.user)
+        self.folder = Folder.objects.create(project=self.project, name='src')
+        File.objects.create(project=self.project, name='a.py', content='a\nb\n', created_by=self.user)
+        File.objects.create(project=self.project, folder=self.folder, name='b.js', content='x\n',
+                            created_by=self.user)
+        self.url = f'/api/projects/{self.project.pk}/stats/'
+
+    def test_stats_are_aggregated(self):
+        stats = self.client.get(self.url).data
+        self.assertEqual((stats['file_count'], stats['folder_count']), (2, 1))
+        self.assertEqual((stats['total_size'], stats['total_lines']), (6, 3))
+        self.assertEqual(stats['languages'], ['python', 'javascript'])
+
+    def test_stats_are_cached_until_a_write(self):
+        first = self.client.get(self.url).data
+        self.assertTrue(ProjectStats.objects.filter(project=self.project).exists())
+        with self.assertNumQueries(2):
+            # The project lookup, then the cached row
+            self.assertEqual(self.client.get(self.url).data, first)
+
+        File.objects.create(project=self.project, name='c.py', content='c\n', created_by=self.user)
+        self.assertFalse(ProjectStats.objects.filter(project=self.project).exists())
+        self.assertEqual(self.client.get(self.url).data['file_count'], 3)
+
+        self.client.get(self.url)
+        File.objects.get(name='c.py').delete()
+        self.assertEqual(self.client.get(self.url).data['file_count'], 2)
+
+    def test_refresh_and_disabled_cache(self):
+        self.client.get(self.url)
+        # A write that bypasses invalidate() shows up on refresh
+        File.objects.filter(name='a.py').update(line_count=10)
+        self.assertEqual(self.client.get(self.url).data['total_lines'], 3)
+        self.assertEqual(self.client.get(self.url, {'refresh': 'true'}).data['total_lines'], 11)
+
+        with self.settings(PROJECT_STATS_CACHE_TTL=0):
+            File.objects.filter(name='a.py').update(line_count=20)
+            self.assertEqual(self.client.get(self.url).data['total_lines'], 21)
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER)
+class ProjectCloneTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.client.force_authenticate(self.user)
+        self.project = Project.objects.create(name='p', owner=self.user, description='d')
+        src = Folder.objects.create(project=self.project, name='src')
+        lib = Folder.objects.create(project=self.project, name='lib', parent=src)
+        File.objects.create(project=self.project, name='README', content='hi\n', created_by=self.user)
+        File.objects.create(project=self.project, folder=lib, name='a.py', content='a\n', created_by=self.user)
+
+    def test_clone_copies_the_tree(self):
+        response = self.client.post(f'/api/projects/{self.project.pk}/clone/', {'name': ' copy '})
+        self.assertEqual(response.status_code, 201)
+        clone = Project.objects.get(pk=response.data['id'])
+        self.assertEqual((clone.name, clone.description, clone.owner), ('copy', 'd', self.user))
+        self.assertEqual(
+            sorted(clone.folders.values_list('path', flat=True)), ['src', 'src/lib'],
+        )
+        files = {(f.path, f.name): f for f in clone.files.select_related('folder')}
+        self.assertEqual(sorted(files), [('', 'README'), ('src/lib', 'a.py')])
+        self.assertEqual(files['src/lib', 'a.py'].folder.project, clone)
+        self.assertEqual(files['src/lib', 'a.py'].content, 'a\n')
+        # The source is untouched
+        self.assertEqual(self.project.files.count(), 2)
+
+    def test_clone_name_defaults_to_a_copy(self):
+        response = self.client.post(f'/api/projects/{self.project.pk}/clone/')
+        self.assertEqual(response.data['name'], 'p (copy)')
+
+    def test_clone_validates_the_name(self):
+        url = f'/api/projects/{self.project.pk}/clone/'
+        for name in (['a'], {'a': 1}, None, '', ' ', 'x' * 256):
+            with self.subTest(name=name):
+                response = self.client.post(url, {'name': name}, format='json')
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('name', response.data)
+        self.assertEqual(Project.objects.count(), 1)
+
+        # Numbers are coerced like any CharField input
+        response = self.client.post(url, {'name': 5}, format='json')
+        self.assertEqual((response.status_code, response.data['name']), (201, '5'))
+
+    def test_only_the_owner_can_clone(self):
+        other = User.objects.create_user('bob', password='pw12345678')
+        self.client.force_authenticate(other)
+        response = self.client.post(f'/api/projects/{self.project.pk}/clone/')
+        self.assertEqual(response.status_code, 404)
@@ -1,7 +1,9 @@
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from django.db.models import Q
+from files.copying import clone_project
 from .models import Project
 from .serializers import ProjectSerializer, ProjectListSerializer
 
@@ -31,7 +33,7 @@ class ProjectViewSet(viewsets.ModelViewSet):
         if language:
             queryset = queryset.filter(default_language=language)
         
-        return queryset.select_related('owner').prefetch_related('files')
+        return queryset.select_related('owner').with_counts()
 
     def get_serializer_class(self):
         """Use different serializers for list vs detail."""
@@ -43,13 +45,25 @@ class ProjectViewSet(viewsets.ModelViewSet):
         """Set owner when creating project."""
         serializer.save(owner=self.request.user)
     
+    @action(detail=True, methods=['post'])
+    def clone(self, request, pk=None):
+        """Clone a project with all its folders and files."""
+        project = self.get_object()
+        name = None
+        if 'name' in request.data:
+            # Same rules as creating or renaming a project
+            serializer = self.get_serializer()
+            try:
+                name = serializer.validate_name(serializer.fields['name'].run_validation(request.data['name']))
+            except ValidationError as exc:
+                raise ValidationError({'name': exc.detail})
+        clone = clone_project(project, request.user, name=name)
+        serializer = ProjectSerializer(clone, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     @action(detail=True, methods=['get'])
     def stats(self, request, pk=None):
         """Get project statistics."""
         project = self.get_object()
-        return Response({
-            'file_count': project.file_count,
-            'folder_count': project.folder_count,
-            'total_size': sum(f.size for f in project.files.all()),
-            'languages': list(project.files.values_list('language', flat=True).distinct()),
-        })
+        refresh = request.query_params.get('refresh', '').lower() in ('1', 'true', 'yes')
+        return Response(project.get_stats(refresh=refresh))
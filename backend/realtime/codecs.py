@@ -0,0 +1,113 @@
+"""
+Wire encodings for the realtime WebSocket protocol.
+
+Clients pick an encoding when they connect, either by offering it as a
+WebSocket subprotocol (``Sec-WebSocket-Protocol: msgpack``) or with a
+``?protocol=msgpack`` query parameter. JSON text frames are the default;
+MessagePack sends the same messages as binary frames, which are smaller and
+cheaper to parse for high-frequency traffic such as ops and cursor batches.
+
+Broadcast frames are encoded once, with the default codec, by the sender
+(``encode_broadcast``). Receivers on that codec send the bytes as they are;
+the others re-encode them (``frame_for``), once per process and frame
+thanks to a small cache, so no codec nobody uses is paid for.
+"""
+import json
+from collections import OrderedDict
+from urllib.parse import parse_qs
+
+import msgpack
+
+
+class CodecError(ValueError):
+    """Raised when an incoming frame can't be decoded."""
+
+
+class JsonCodec:
+    name = 'json'
+    binary = False
+
+    def encode(self, payload):
+        return json.dumps(payload, separators=(',', ':'))
+
+    def decode(self, data):
+        try:
+            return json.loads(data)
+        except ValueError as exc:
+            raise CodecError(str(exc))
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    binary = True
+
+    def encode(self, payload):
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except (ValueError, msgpack.UnpackException) as exc:
+            raise CodecError(str(exc))
+
+
+DEFAULT = JsonCodec()
+CODECS = {codec.name: codec for codec in (DEFAULT, MsgpackCodec())}
+
+
+def negotiate(scope):
+    """Pick the codec for a connection.
+
+    Returns ``(codec, subprotocol)``, where ``subprotocol`` is the offered
+    subprotocol to accept, or None if the client didn't offer one we know.
+    """
+    for subprotocol in scope.get('subprotocols') or ():
+        if subprotocol in CODECS:
+            return CODECS[subprotocol], subprotocol
+
+    query = parse_qs(scope.get('query_string', b'').decode())
+    name = query.get('protocol', [DEFAULT.name])[0]
+    return CODECS.get(name, DEFAULT), None
+
+
+# Bytes of re-encoded broadcast frames kept per process
+TRANSCODE_CACHE_SIZE = 4 * 1024 * 1024
+
+# (codec name, default frame) -> frame in that codec, least recently used first
+_transcoded = OrderedDict()
+_transcoded_size = 0
+
+
+def encode_broadcast(payload):
+    """Encode a group message's ``frames``, keyed by codec name."""
+    return {DEFAULT.name: DEFAULT.encode(payload)}
+
+
+def frame_for(frames, codec):
+    """Pick a broadcast frame for ``codec``, re-encoding and caching it if needed."""
+    frame = frames.get(codec.name)
+    if frame is not None:
+        return frame
+
+    global _transcoded_size
+    source = frames[DEFAULT.name]
+    key = (codec.name, source)
+    frame = _transcoded.get(key)
+    if frame is not None:
+        _transcoded.move_to_end(key)
+        return frame
+
+    frame = codec.encode(DEFAULT.decode(source))
+    _transcoded[key] = frame
+    _transcoded_size += len(source) + len(frame)
+    while _transcoded_size > TRANSCODE_CACHE_SIZE and len(_transcoded) > 1:
+        (_, evicted_source), evicted = _transcoded.popitem(last=False)
+        _transcoded_size -= len(evicted_source) + len(evicted)
+    return frame
+
+
+def decode(text_data=None, bytes_data=None):
+    """Decode an incoming frame; binary frames are MessagePack, text is JSON."""
+    if bytes_data is not None:
+        return CODECS['msgpack'].decode(bytes_data)
+    return DEFAULT.decode(text_data)
@@ -1,114 +1,283 @@
-import json
+import secrets
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from files.models import File
+from projects.models import Project
+from . import codecs, hosting, outbox
 
-class FileConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.file_id = self.scope['url_route']['kwargs']['file_id']
-        self.room_group_name = f'file_{self.file_id}'
 
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+@database_sync_to_async
+def can_edit_file(user, file_id, project_id=None):
+    """Only project owners may join a file's editing room."""
+    if not user or not user.is_authenticated:
+        return False
+    files = File.objects.filter(pk=file_id, project__owner=user)
+    if project_id is not None:
+        files = files.filter(project_id=project_id)
+    return files.exists()
+
+
+@database_sync_to_async
+def can_access_project(user, project_id):
+    if not user or not user.is_authenticated:
+        return False
+    return Project.objects.filter(pk=project_id, owner=user).exists()
+
+
+class FileSession:
+    """One connection's membership in a file's editing room.
+
+    The room lives in the process that owns it (see ``realtime.hosting``).
+    If that is this one, the session works on the room directly; otherwise
+    it forwards the connection's room messages to the owner, which answers
+    through the connection's channel. Outbound room frames carry the
+    ``file`` id so that a connection holding several sessions can tell them
+    apart.
+    """
 
-        await self.accept()
+    def __init__(self, consumer, file_id):
+        self.consumer = consumer
+        self.file_id = file_id
+        self.group_name = f'file_{file_id}'
+        self.member = hosting.Member(consumer.channel_name, consumer.connection_id, consumer.user_id)
+        self.node = None
+        # The room while this process owns it, else the owner's node channel
+        self.room = None
+        self.owner = None
+
+    async def join(self):
+        """Join the room; the owner answers with a sync."""
+        consumer = self.consumer
+        await consumer.channel_layer.group_add(self.group_name, consumer.channel_name)
+        await self.attach()
+
+    async def attach(self):
+        """Join the room at its owner, taking the room over if it has none."""
+        self.node = await hosting.get_node()
+        self.node.unfollow(self)
+        self.owner = await self.node.claim(self.file_id)
+        if self.owner == self.node.channel:
+            self.room = await hosting.join(self.file_id, self.member, self.reply)
+        else:
+            self.room = None
+            self.node.follow(self, self.owner)
+            await self.node.forward(self.owner, self.file_id, 'join', self.member)
+
+    async def leave(self):
+        consumer = self.consumer
+        if self.room is not None:
+            await hosting.leave(self.room, self.member)
+        elif self.node is not None:
+            self.node.unfollow(self)
+            await self.node.forward(self.owner, self.file_id, 'leave', self.member)
+        await consumer.channel_layer.group_discard(self.group_name, consumer.channel_name)
+
+    async def sync(self):
+        """Queue a sync frame, which supersedes updates still queued for the file."""
+        if self.room is not None:
+            await self.reply(hosting.sync_payload(self.room, self.member), kind=outbox.CONTENT)
+        else:
+            await self.node.forward(self.owner, self.file_id, 'sync', self.member)
+
+    async def handle(self, message_type, data):
+        """Handle a client message addressed to this file."""
+        if message_type not in hosting.ROOM_MESSAGES:
+            return
+        if self.room is not None:
+            await hosting.handle(self.room, self.member, message_type, data, self.reply)
+        else:
+            await self.node.forward(
+                self.owner, self.file_id, 'message', self.member, message_type=message_type, data=data,
+            )
+
+    async def reply(self, payload, kind=None):
+        await self.consumer.send_payload(payload, kind=kind, file=self.file_id)
+
+
+class RoomConsumer(AsyncWebsocketConsumer):
+    """Plumbing shared by consumers whose connections join file rooms."""
+
+    async def connect(self):
+        # File id -> FileSession for every room this connection is in
+        self.sessions = {}
+        self.outbox = None
+
+    async def accept_connection(self, user):
+        self.user_id = user.pk
+        # Opaque id clients use to recognise their own entries in cursor batches
+        self.connection_id = secrets.token_urlsafe(6)
+        self.codec, subprotocol = codecs.negotiate(self.scope)
+        await self.accept(subprotocol=subprotocol)
+        # Everything sent from here on is queued and written by the outbox task
+        self.outbox = outbox.Outbox(self)
+        self.outbox.start()
 
     async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
+        if self.outbox is not None:
+            await self.outbox.close()
+        for session in list(self.sessions.values()):
+            await session.leave()
+        self.sessions.clear()
+
+    async def send_payload(self, payload, kind=None, file=None):
+        """Encode a message with the connection's codec and queue it."""
+        self.outbox.put(self.codec.encode(payload), kind=kind, file=file)
+
+    async def send_encoded(self, data):
+        if self.codec.binary:
+            await self.send(bytes_data=data)
+        else:
+            await self.send(text_data=data)
 
     # Receive message from WebSocket
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        message_type = data.get('type')
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = codecs.decode(text_data, bytes_data)
+        except codecs.CodecError:
+            return
+        if isinstance(data, dict):
+            await self.receive_payload(data)
 
-        if message_type == 'file_update':
-            content = data.get('content')
-            # Broadcast file content changes to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'file_message',
-                    'content': content,
-                    'sender_channel_name': self.channel_name
-                }
-            )
+    async def receive_payload(self, data):
+        raise NotImplementedError
 
-        elif message_type == 'cursor_update':
-            # Broadcast cursor position for presence-style cursor tracking
-            username = data.get('username') or 'Guest'
-            position = data.get('position')
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'cursor_message',
-                    'username': username,
-                    'position': position,
-                    'sender_channel_name': self.channel_name,
-                }
-            )
+    async def resync(self, files, tree):
+        """Called by the outbox, in order, after it dropped frames for these files."""
+        for file_id in files:
+            session = self.sessions.get(file_id)
+            if session is not None:
+                await session.sync()
 
-        elif message_type == 'presence_join':
-            username = data.get('username') or 'Guest'
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'presence_message',
-                    'action': 'join',
-                    'username': username,
-                    'sender_channel_name': self.channel_name,
-                }
+    # Receive a pre-encoded frame from a group and queue it in our codec
+    async def broadcast(self, event):
+        # Only reached by excluded channels on layers that can't filter them
+        if self.channel_name not in event.get('exclude', ()):
+            self.outbox.put(
+                codecs.frame_for(event['frames'], self.codec), kind=event.get('kind'), file=event.get('file')
             )
 
-        elif message_type == 'presence_leave':
-            username = data.get('username') or 'Guest'
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'presence_message',
-                    'action': 'leave',
-                    'username': username,
-                    'sender_channel_name': self.channel_name,
-                }
+    # Answer from the owner of a room held by another process
+    async def room_reply(self, event):
+        if event['file'] in self.sessions:
+            await self.send_payload(event['payload'], kind=event.get('kind'), file=event['file'])
+
+    # The room's owner changed; join it again at the new one
+    async def room_moved(self, event):
+        session = self.sessions.get(event['file'])
+        if session is not None:
+            await session.attach()
+
+    # Receive transformed operations from room group
+    async def ops_message(self, event):
+        # The sender already has the ops applied locally, so it only needs the ack
+        if self.channel_name == event['sender_channel_name']:
+            self.outbox.put(codecs.frame_for(event['ack_frames'], self.codec), file=event['file'])
+        else:
+            self.outbox.put(
+                codecs.frame_for(event['frames'], self.codec), kind=outbox.OPS, file=event['file']
             )
 
-    # Receive file update from room group
-    async def file_message(self, event):
-        content = event['content']
-        sender_channel_name = event['sender_channel_name']
 
-        # Do not send back to the sender
-        if self.channel_name != sender_channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'file_update',
-                'content': content
-            }))
+class FileConsumer(RoomConsumer):
+    """A connection to a single file's editing room (``ws/file/<id>/``)."""
 
-    # Receive cursor update from room group
-    async def cursor_message(self, event):
-        sender_channel_name = event['sender_channel_name']
+    async def connect(self):
+        await super().connect()
+        self.file_id = int(self.scope['url_route']['kwargs']['file_id'])
 
-        # Do not send back to the sender
-        if self.channel_name != sender_channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'cursor_update',
-                'username': event['username'],
-                'position': event['position'],
-            }))
+        # The room's document is persisted, so only authorized users may edit it
+        user = self.scope.get('user')
+        if not await can_edit_file(user, self.file_id):
+            await self.close(code=4403)
+            return
+
+        await self.accept_connection(user)
+        session = self.sessions[self.file_id] = FileSession(self, self.file_id)
+        await session.join()
+
+    async def receive_payload(self, data):
+        session = self.sessions.get(self.file_id)
+        if session is not None:
+            await session.handle(data.get('type'), data)
+
+
+class ProjectConsumer(RoomConsumer):
+    """One connection per project (``ws/project/<id>/``).
+
+    Clients ``subscribe``/``unsubscribe`` to files of the project and address
+    file messages with a ``file`` id; every room frame they receive carries
+    it too. The connection also receives ``tree`` events when files or
+    folders of the project are created, renamed, moved or deleted.
+    """
+    max_subscriptions = 50
+
+    async def connect(self):
+        await super().connect()
+        self.project_id = int(self.scope['url_route']['kwargs']['project_id'])
+        self.project_group_name = f'project_{self.project_id}'
+        self.joined_project = False
+
+        user = self.scope.get('user')
+        if not await can_access_project(user, self.project_id):
+            await self.close(code=4403)
+            return
+        self.user = user
+
+        await self.channel_layer.group_add(self.project_group_name, self.channel_name)
+        self.joined_project = True
+        await self.accept_connection(user)
+        await self.send_payload({
+            'type': 'connected',
+            'project': self.project_id,
+            'connection': self.connection_id,
+        })
+
+    async def disconnect(self, close_code):
+        await super().disconnect(close_code)
+        if self.joined_project:
+            await self.channel_layer.group_discard(self.project_group_name, self.channel_name)
+
+    async def receive_payload(self, data):
+        message_type = data.get('type')
+        file_id = data.get('file')
+        if not isinstance(file_id, int):
+            return
+
+        if message_type == 'subscribe':
+            await self.subscribe(file_id)
+        elif message_type == 'unsubscribe':
+            session = self.sessions.pop(file_id, None)
+            if session is not None:
+                await session.leave()
+        else:
+            session = self.sessions.get(file_id)
+            if session is not None:
+                await session.handle(message_type, data)
 
-    # Receive presence event from room group
-    async def presence_message(self, event):
-        sender_channel_name = event['sender_channel_name']
+    async def subscribe(self, file_id):
+        session = self.sessions.get(file_id)
+        if session is None:
+            if len(self.sessions) >= self.max_subscriptions:
+                error = 'Too many subscriptions'
+            elif not await can_edit_file(self.user, file_id, self.project_id):
+                error = 'File not found'
+            else:
+                error = None
+            if error:
+                await self.send_payload({'type': 'subscribe_error', 'file': file_id, 'error': error})
+                return
+            session = self.sessions[file_id] = FileSession(self, file_id)
+            await session.join()
+        else:
+            await session.sync()
 
-        # Do not send back to the sender
-        if self.channel_name != sender_channel_name:
-            await self.send(text_data=json.dumps({
-                'type': 'presence',
-                'action': event['action'],
-                'username': event['username'],
+    async def resync(self, files, tree):
+        await super().resync(files, tree)
+        if tree:
+            # Clients reload the tree on any tree event
+            await self.send_encoded(self.codec.encode({
+                'type': 'tree',
+                'action': 'resync',
+                'project': self.project_id,
             }))
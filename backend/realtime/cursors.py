@@ -0,0 +1,70 @@
+"""
+Coalesced fan-out of cursor and presence updates.
+
+Consumers record cursor moves and presence changes on their room instead of
+broadcasting each one. A single background task per event loop wakes up
+``REALTIME_CURSOR_RATE`` times per second and sends every room with pending
+updates one ``cursor_batch`` group message holding the presence events and
+the latest cursor per user. Fan-out per room is therefore bounded by the
+rate, however fast clients emit.
+
+Each batch is encoded once per codec and delivered verbatim to every
+member. Entries carry the id of the connection they came from (sent to each
+client when it connects), so clients skip their own updates.
+
+Batches are incremental, so a connection that falls behind merges the ones
+still queued for it rather than dropping any (see ``realtime.outbox``).
+"""
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import codecs, outbox, rooms
+
+logger = logging.getLogger(__name__)
+
+_loop = None
+_task = None
+
+
+def schedule():
+    """Make sure the batching task is running on the current event loop."""
+    global _loop, _task
+    loop = asyncio.get_running_loop()
+    if _task is None or _task.done() or _loop is not loop:
+        _loop = loop
+        _task = loop.create_task(_run())
+
+
+async def _run():
+    interval = 1 / settings.REALTIME_CURSOR_RATE
+    while True:
+        await asyncio.sleep(interval)
+        pending = [room for room in rooms.all_rooms() if room.has_pending_updates]
+        if not pending:
+            break
+        await flush(pending)
+
+
+async def flush(room_list):
+    """Broadcast the queued updates of the given rooms."""
+    channel_layer = get_channel_layer()
+    sends = []
+    for room in room_list:
+        presence, cursors = room.take_updates()
+        sends.append(channel_layer.group_send(f'file_{room.file_id}', {
+            'type': 'broadcast',
+            'frames': codecs.encode_broadcast({
+                'type': 'cursor_batch',
+                'file': room.file_id,
+                'presence': presence,
+                'cursors': cursors,
+            }),
+            'kind': outbox.CURSORS,
+            'file': room.file_id,
+        }))
+    for result in await asyncio.gather(*sends, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.warning('Failed to broadcast cursor batch', exc_info=result)
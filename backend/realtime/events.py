@@ -0,0 +1,76 @@
+"""
+Helpers for notifying realtime rooms from synchronous code (REST views).
+"""
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from . import codecs, outbox, rooms
+
+logger = logging.getLogger(__name__)
+
+
+def _group_send(group, message):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(group, message)
+    except Exception:
+        # Realtime is best-effort; a missing channel layer must not fail the request
+        logger.warning('Could not notify realtime group %s', group, exc_info=True)
+
+
+def file_saved(file, force=False):
+    """Tell an open editing room that ``file.content`` was written outside it.
+
+    Rooms keep their own copy of the document, so without this a REST save
+    or revert would be overwritten by the next write-behind flush. ``force``
+    makes the room discard unsaved live edits in favour of the saved content.
+    Only the process that owns the room receives it.
+    """
+    _group_send(rooms.owner_group(file.pk), {
+        'type': 'file_saved',
+        'file': file.pk,
+        'content': file.content,
+        'force': force,
+    })
+
+
+def file_changed(action, file):
+    """Tell project sockets that a file was created, renamed, moved or deleted.
+
+    The event is built immediately (so it can describe a file that is about
+    to be deleted) and sent once the current transaction commits.
+    """
+    _tree_changed(file.project_id, action, 'file', {
+        'id': file.pk,
+        'name': file.name,
+        'folder': file.folder_id,
+        'full_path': file.full_path,
+        'language': file.language,
+    })
+
+
+def folder_changed(action, folder):
+    """Tell project sockets that a folder was created, renamed, moved or deleted."""
+    _tree_changed(folder.project_id, action, 'folder', {
+        'id': folder.pk,
+        'name': folder.name,
+        'parent': folder.parent_id,
+        'full_path': folder.full_path,
+    })
+
+
+def _tree_changed(project_id, action, kind, data):
+    frames = codecs.encode_broadcast({
+        'type': 'tree',
+        'action': action,
+        'kind': kind,
+        'data': data,
+    })
+    transaction.on_commit(
+        lambda: _group_send(f'project_{project_id}', {'type': 'broadcast', 'frames': frames, 'kind': outbox.TREE})
+    )
@@ -0,0 +1,83 @@
+"""
+Write backpressure for WebSocket connections served by Daphne.
+
+The outbox (``realtime.outbox``) relies on ``send`` taking as long as the
+client takes to read: while it waits, frames queue up in the outbox where
+they are coalesced and bounded. Daphne's ``send`` doesn't wait. It hands the
+frame to Twisted, which appends it to the transport's write buffer however
+large that has grown, so a client that stops reading never holds up the
+writer and frames pile up in Twisted instead, unbounded.
+
+What Twisted does signal is the state of that buffer: past ``bufferSize``
+(64 KiB) it pauses the transport's streaming producer, and it resumes it
+once the buffer drained. ``FlowControlMiddleware`` registers a
+``TransportFlow`` as that producer and puts it in the scope as
+``flow_control``; the outbox waits on it after each frame. Under servers
+whose ``send`` waits for the socket the key is absent and nothing changes.
+"""
+import asyncio
+import functools
+
+
+class TransportFlow:
+    """Streaming producer recording whether a Twisted transport takes more writes."""
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.writable = asyncio.Event()
+        if not getattr(transport, 'producerPaused', False):
+            self.writable.set()
+        # Daphne leaves the HTTP channel that took the upgrade registered;
+        # it keeps getting the calls it got before
+        self.previous = transport.producer
+        if self.previous is not None:
+            transport.unregisterProducer()
+        transport.registerProducer(self, True)
+
+    @property
+    def paused(self):
+        return not self.writable.is_set()
+
+    async def wait(self):
+        """Wait until the transport's write buffer is below its limit."""
+        await self.writable.wait()
+
+    def pauseProducing(self):
+        self.writable.clear()
+        if self.previous is not None:
+            self.previous.pauseProducing()
+
+    def resumeProducing(self):
+        self.writable.set()
+        if self.previous is not None:
+            self.previous.resumeProducing()
+
+    def stopProducing(self):
+        # The connection is gone; nothing is left to wait for
+        self.writable.set()
+        if self.previous is not None:
+            self.previous.stopProducing()
+
+
+def server_transport(send):
+    """The Twisted transport behind Daphne's ``send`` callable, if it is one."""
+    # Daphne passes ``partial(server.handle_reply, protocol)``
+    if not isinstance(send, functools.partial) or not send.args:
+        return None
+    transport = getattr(send.args[0], 'transport', None)
+    if transport is None or not hasattr(transport, 'registerProducer'):
+        return None
+    return transport
+
+
+class FlowControlMiddleware:
+    """Puts a ``TransportFlow`` in WebSocket scopes served by Daphne."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        transport = server_transport(send)
+        if scope['type'] == 'websocket' and transport is not None:
+            scope = dict(scope, flow_control=TransportFlow(transport))
+        return await self.inner(scope, receive, send)
@@ -0,0 +1,360 @@
+"""
+Single ownership of editing rooms across server processes.
+
+Every open room lives in exactly one process, its owner, so that edits are
+ordered by one revision counter and written back by one flusher however
+many processes serve the room's connections. Ownership is a channel layer
+lease (``rooms.lease_name``) held by the owner's node channel: one channel
+per process and event loop, served by a ``Node``. Whoever first joins a
+room without an owner claims it.
+
+Sessions on the owner's process use the room directly. Sessions on other
+processes forward their room messages to the owner's node channel as
+``room.request`` messages; the owner answers them through the member's own
+channel (``room_reply``), and broadcasts reach every member through the
+room group as before. REST saves are sent to ``rooms.owner_group``, which
+only holds the owner.
+
+Owners renew their leases every third of ``REALTIME_ROOM_LEASE`` seconds.
+If an owner stops renewing (it crashed or stalled), the lease runs out and
+the room's members are told to rejoin (``room_moved``): the first one
+claims the room and loads it from the database, so edits the old owner had
+not flushed yet are lost, at most ``REALTIME_FLUSH_MAX_DELAY`` seconds of
+them. An owner that finds its lease taken drops the room without flushing.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from files.models import File
+from . import codecs, cursors, ot, outbox, persistence, rooms
+
+logger = logging.getLogger(__name__)
+
+# Client messages handled by the room's owner
+ROOM_MESSAGES = ('file_update', 'file_ops', 'cursor_update', 'presence_join', 'presence_leave', 'save')
+
+
+@database_sync_to_async
+def load_file_content(file_id):
+    return File.objects.filter(pk=file_id).values_list('content', flat=True).first() or ''
+
+
+class Member:
+    """A connection in a room, as the room's owner sees it."""
+
+    def __init__(self, channel, connection, user_id):
+        self.channel = channel
+        self.connection = connection
+        self.user_id = user_id
+
+    def as_message(self):
+        return {'channel': self.channel, 'connection': self.connection, 'user_id': self.user_id}
+
+
+# -- Owner side ---------------------------------------------------------------
+#
+# ``reply(payload, kind=None)`` sends a message to the one member it was
+# made for, wherever that member is connected.
+
+async def join(file_id, member, reply):
+    """Add a member to the room, loading it if needed, and send it a sync."""
+    room = rooms.join(file_id, member.channel)
+    await room.load(lambda: load_file_content(file_id))
+    await reply(sync_payload(room, member), kind=outbox.CONTENT)
+    return room
+
+
+async def leave(room, member):
+    rooms.leave(room.file_id, member.channel)
+    if room.leave_presence(member.connection):
+        cursors.schedule()
+    if not room.members:
+        # Last editor left: persist unsaved edits and end the session's
+        # history with a version before dropping the buffer
+        await persistence.flush([room], checkpoint=True)
+        if rooms.discard(room):
+            node = await get_node()
+            await node.release(room.file_id)
+    elif room.dirty:
+        # Don't leave the departing editor's changes waiting on the debounce
+        await persistence.flush([room])
+
+
+def sync_payload(room, member):
+    """The live document (including unsaved edits), its revision and who is here."""
+    return {
+        'type': 'sync',
+        'file': room.file_id,
+        'content': room.content,
+        'revision': room.revision,
+        'connection': member.connection,
+        'users': room.present_users(),
+    }
+
+
+async def handle(room, member, message_type, data, reply):
+    """Handle a client message addressed to the room."""
+    channel_layer = get_channel_layer()
+    group_name = f'file_{room.file_id}'
+
+    if message_type == 'file_update':
+        content = data.get('content')
+        if not isinstance(content, str):
+            return
+        room.replace_content(content, editor_id=member.user_id)
+        persistence.schedule()
+
+        # Broadcast file content changes to the rest of the room group
+        await channel_layer.group_send(
+            group_name,
+            {
+                'type': 'broadcast',
+                'frames': codecs.encode_broadcast({
+                    'type': 'file_update',
+                    'file': room.file_id,
+                    'content': content,
+                    'revision': room.revision,
+                }),
+                'kind': outbox.CONTENT,
+                'file': room.file_id,
+                'exclude': [member.channel],
+            }
+        )
+
+    elif message_type == 'file_ops':
+        try:
+            ops = ot.normalize(data.get('ops'))
+            ops = room.apply_ops(ops, data.get('revision'), editor_id=member.user_id)
+            revision = room.revision
+        except ot.OperationError as exc:
+            await reply({
+                'type': 'file_ops_error',
+                'file': room.file_id,
+                'error': str(exc),
+                'revision': room.revision,
+            })
+            return
+        persistence.schedule()
+
+        # Broadcast only the transformed ops; the sender gets its ack through
+        # the group as well so it arrives in revision order with peer ops
+        await channel_layer.group_send(
+            group_name,
+            {
+                'type': 'ops_message',
+                'frames': codecs.encode_broadcast({
+                    'type': 'file_ops',
+                    'file': room.file_id,
+                    'ops': ops,
+                    'revision': revision,
+                }),
+                'ack_frames': codecs.encode_broadcast({
+                    'type': 'file_ops_ack',
+                    'file': room.file_id,
+                    'revision': revision,
+                }),
+                'file': room.file_id,
+                'sender_channel_name': member.channel,
+            }
+        )
+
+    elif message_type == 'cursor_update':
+        # Coalesced with other moves and broadcast in the next cursor batch
+        username = data.get('username') or 'Guest'
+        room.move_cursor(member.connection, username, data.get('position'))
+        cursors.schedule()
+
+    elif message_type == 'presence_join':
+        username = data.get('username') or 'Guest'
+        room.join_presence(member.connection, username)
+        cursors.schedule()
+
+    elif message_type == 'presence_leave':
+        if room.leave_presence(member.connection):
+            cursors.schedule()
+
+    elif message_type == 'save':
+        # Persist now and record a version, instead of a REST save of the content
+        if await persistence.flush([room], checkpoint=True):
+            await reply({
+                'type': 'saved',
+                'file': room.file_id,
+                'revision': room.revision,
+            })
+        else:
+            await reply({
+                'type': 'save_error',
+                'file': room.file_id,
+                'error': 'The file could not be saved, retrying',
+            })
+
+
+async def adopt_saved(room, content, force=False):
+    """Take on content saved through the REST API while the room was open."""
+    if room.adopt_saved(content, force=force):
+        await get_channel_layer().group_send(
+            f'file_{room.file_id}',
+            {
+                'type': 'broadcast',
+                'frames': codecs.encode_broadcast({
+                    'type': 'file_update',
+                    'file': room.file_id,
+                    'content': room.content,
+                    'revision': room.revision,
+                }),
+                'kind': outbox.CONTENT,
+                'file': room.file_id,
+            }
+        )
+
+
+# -- Node ---------------------------------------------------------------------
+
+class Node:
+    """This process's node channel: serves forwarded requests and keeps leases."""
+
+    def __init__(self, channel_layer, channel):
+        self.channel_layer = channel_layer
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        # File id -> sessions of this process in rooms owned elsewhere, with
+        # the owner they joined
+        self.followers = defaultdict(dict)
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [self.loop.create_task(self._serve()), self.loop.create_task(self._maintain())]
+
+    async def claim(self, file_id):
+        """Return the node channel of the room's owner, claiming the room if it has none."""
+        owner = await self.channel_layer.claim_lease(
+            rooms.lease_name(file_id), self.channel, settings.REALTIME_ROOM_LEASE,
+        )
+        if owner == self.channel:
+            await self.channel_layer.group_add(rooms.owner_group(file_id), self.channel)
+        return owner
+
+    async def release(self, file_id):
+        await self.channel_layer.group_discard(rooms.owner_group(file_id), self.channel)
+        await self.channel_layer.release_lease(rooms.lease_name(file_id), self.channel)
+
+    def follow(self, session, owner):
+        self.followers[session.file_id][session] = owner
+
+    def unfollow(self, session):
+        sessions = self.followers.get(session.file_id)
+        if sessions is not None:
+            sessions.pop(session, None)
+            if not sessions:
+                del self.followers[session.file_id]
+
+    async def forward(self, owner, file_id, action, member, **fields):
+        """Send a request about a room to the node channel of its owner."""
+        await self._send(owner, {
+            'type': 'room.request',
+            'file': file_id,
+            'action': action,
+            'member': member.as_message(),
+            **fields,
+        })
+
+    async def _send(self, channel, message):
+        try:
+            await self.channel_layer.send(channel, message)
+        except ChannelFull:
+            logger.warning('Dropped room message for %s: channel full', channel)
+
+    def replier(self, file_id, member):
+        """``reply`` for a member on another process."""
+        async def reply(payload, kind=None):
+            await self._send(member.channel, {
+                'type': 'room_reply', 'file': file_id, 'payload': payload, 'kind': kind,
+            })
+        return reply
+
+    async def _serve(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel)
+            try:
+                await self.dispatch(message)
+            except Exception:
+                logger.exception('Failed to handle %s for room %s', message.get('type'), message.get('file'))
+
+    async def dispatch(self, message):
+        file_id = message['file']
+        room = rooms.get(file_id)
+        if message['type'] == 'file_saved':
+            if room is not None:
+                await adopt_saved(room, message['content'], force=message.get('force', False))
+            return
+
+        member = Member(**message['member'])
+        action = message['action']
+        if room is None:
+            # Not ours (any more): the member has to look the owner up again
+            if action != 'leave':
+                await self._send(member.channel, {'type': 'room_moved', 'file': file_id})
+            return
+
+        reply = self.replier(file_id, member)
+        if action == 'join':
+            await join(file_id, member, reply)
+        elif action == 'leave':
+            await leave(room, member)
+        elif action == 'sync':
+            await reply(sync_payload(room, member), kind=outbox.CONTENT)
+        elif action == 'message':
+            await handle(room, member, message['message_type'], message['data'], reply)
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(settings.REALTIME_ROOM_LEASE / 3)
+            try:
+                await self.renew()
+                await self.check_followed()
+            except Exception:
+                logger.exception('Failed to maintain room leases')
+
+    async def renew(self):
+        """Renew the leases of our rooms, dropping the ones another process took over."""
+        for room in rooms.all_rooms():
+            renewed = await self.channel_layer.renew_lease(
+                rooms.lease_name(room.file_id), self.channel, settings.REALTIME_ROOM_LEASE,
+            )
+            if not renewed:
+                logger.warning('Lost the lease of room %s, dropping it', room.file_id)
+                rooms.drop(room)
+                await self.channel_layer.group_discard(rooms.owner_group(room.file_id), self.channel)
+                for channel in room.members:
+                    await self._send(channel, {'type': 'room_moved', 'file': room.file_id})
+
+    async def check_followed(self):
+        """Tell sessions whose room's owner went away to rejoin it."""
+        for file_id, sessions in list(self.followers.items()):
+            holder = await self.channel_layer.lease_holder(rooms.lease_name(file_id))
+            for session, owner in list(sessions.items()):
+                if owner != holder:
+                    await self._send(session.member.channel, {'type': 'room_moved', 'file': file_id})
+
+
+_node = None
+
+
+async def get_node():
+    """The node of the current event loop, started on first use."""
+    global _node
+    loop = asyncio.get_running_loop()
+    if _node is None or _node.loop is not loop:
+        channel_layer = get_channel_layer()
+        node = Node(channel_layer, await channel_layer.new_channel('rooms'))
+        # Another coroutine may have started one while we awaited the channel
+        if _node is None or _node.loop is not loop:
+            _node = node
+            _node.start()
+    return _node
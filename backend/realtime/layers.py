@@ -0,0 +1,505 @@
+"""
+Channel layers used by the realtime app.
+
+A ``group_send`` message may carry an ``exclude`` list of channel names.
+Those channels are dropped before the message is queued for them, so the
+origin of a broadcast never receives or decodes its own echo. Consumers
+still check ``exclude`` themselves, which keeps them correct on the stock
+layers.
+
+The Redis layer also spreads groups and channels over its hosts with a
+consistent hash ring (see ``realtime.sharding``), so Redis shards can be
+added without remapping most rooms. The groups and leases that do move are
+found through ``previous_hosts``, the host list before the change: while it
+is configured, a group or lease whose key lived on another shard under the
+previous ring is read from there as well and moved over on first use, and
+``migrate_groups()`` (``manage.py migrate_channel_groups``) moves the rest.
+Messages for a process's channels are written to both of their shards, so
+processes not yet restarted with the new list, which read the old one,
+still get them. The other way round is not covered: messages sent by those
+processes to a channel that moved are lost until they restart.
+
+Both layers also keep leases: a key held by one owner until it stops
+renewing it, which ``realtime.hosting`` uses to give every room a single
+owning process. On Redis a lease is a key with a TTL on the shard of its
+name.
+
+``HybridChannelLayer`` is the Redis layer with a fast path for channels of
+its own process: messages for them go straight into their receive buffer,
+and only members on other nodes are reached through Redis. It also keeps
+track of the members other nodes have in the groups it sends to, so a group
+whose members are all local is served without Redis at all. The in-memory
+layer has no Redis at all, for single-node deployments and tests.
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer as BaseInMemoryChannelLayer
+from channels_redis.core import RedisChannelLayer as BaseRedisChannelLayer
+from channels_redis.utils import decode_hosts
+
+from .sharding import HashRing, shard_name
+
+EXCLUDE_KEY = 'exclude'
+
+# Message type of membership changes sent to nodes tracking a group
+MEMBERSHIP_TYPE = 'layer.membership'
+
+# Seconds after which a node re-reads the members of a group it tracks
+TRACKING_REFRESH = 60
+
+# Take the lease if nobody holds it; returns the holder
+CLAIM_SCRIPT = """
+local holder = redis.call('get', KEYS[1])
+if holder then
+    return holder
+end
+redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return ARGV[1]
+"""
+
+# Extend the lease if we hold it, or take it back if it lapsed unclaimed
+RENEW_SCRIPT = """
+local holder = redis.call('get', KEYS[1])
+if holder and holder ~= ARGV[1] then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2])
+return 1
+"""
+
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def shard_key(value):
+    """The part of a group or channel name that picks its shard.
+
+    channels_redis hashes the full name of a process-specific channel when
+    sending to it but only its non-local part (up to ``!``) when receiving,
+    which only agree with a single shard.
+    """
+    if '!' in value:
+        return value[:value.index('!') + 1]
+    return value
+
+
+class RedisChannelLayer(BaseRedisChannelLayer):
+    def __init__(self, *args, previous_hosts=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        names = [shard_name(host) for host in self.hosts]
+        self.ring = HashRing(names)
+
+        # Shards of the previous ring that are no longer in use get connection
+        # indexes after the current ones
+        self.previous_ring = None
+        self.previous_indexes = []
+        if previous_hosts:
+            previous_hosts = decode_hosts(previous_hosts)
+            for host in previous_hosts:
+                name = shard_name(host)
+                if name not in names:
+                    names.append(name)
+                    self.hosts.append(host)
+                self.previous_indexes.append(names.index(name))
+            self.previous_ring = HashRing([shard_name(host) for host in previous_hosts])
+            self.ring_size = len(self.hosts)
+
+    def consistent_hash(self, value):
+        return self.ring.index_for(shard_key(value))
+
+    def previous_hash(self, value):
+        """Connection index of ``value`` under the previous ring, if that differs."""
+        if self.previous_ring is None:
+            return None
+        index = self.previous_indexes[self.previous_ring.index_for(shard_key(value))]
+        return index if index != self.consistent_hash(value) else None
+
+    async def send(self, channel, message):
+        await super().send(channel, message)
+        previous = self.previous_hash(channel) if '!' in channel else None
+        if previous is not None:
+            # A process still on the previous ring reads it from there
+            key = self.prefix + self.non_local_name(channel)
+            connection = self.connection(previous)
+            await connection.zadd(key, {self.serialize({**message, '__asgi_channel__': channel}): time.time()})
+            await connection.expire(key, int(self.expiry))
+
+    # Groups
+
+    async def group_add(self, group, channel):
+        await self.migrate_group(group)
+        await super().group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        previous = self.previous_hash(group)
+        if previous is not None:
+            await self.connection(previous).zrem(self._group_key(group), channel)
+
+    async def group_send(self, group, message):
+        await self.migrate_group(group)
+        await super().group_send(group, message)
+
+    async def migrate_group(self, group):
+        """Move a group's members from its shard under the previous ring, if any."""
+        previous = self.previous_hash(group)
+        if previous is None:
+            return
+        key = self._group_key(group)
+        old = self.connection(previous)
+        members = await old.zrange(key, 0, -1, withscores=True)
+        if not members:
+            return
+        connection = self.connection(self.consistent_hash(group))
+        # Keep the newer timestamp of channels that joined on both shards
+        await connection.zadd(key, dict(members), gt=True)
+        await connection.expire(key, self.group_expiry)
+        await old.zrem(key, *(member for member, _ in members))
+
+    async def migrate_groups(self):
+        """Move every group stored on a shard it no longer maps to; returns how many moved."""
+        if self.previous_ring is None:
+            return 0
+        prefix = self._group_key('')
+        moved = 0
+        for index in sorted(set(self.previous_indexes)):
+            connection = self.connection(index)
+            keys = [key async for key in connection.scan_iter(match=prefix + b'*', count=1000)]
+            for key in keys:
+                group = key[len(prefix):].decode('utf8')
+                if self.consistent_hash(group) != index:
+                    await self.migrate_group(group)
+                    moved += 1
+        return moved
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        exclude = message.get(EXCLUDE_KEY)
+        if exclude:
+            channel_names = [name for name in channel_names if name not in exclude]
+        connection_keys, messages, capacities = super()._map_channel_keys_to_connection(channel_names, message)
+        if self.previous_ring is not None:
+            # Like send(), also write to the shards processes on the previous ring read
+            for keys in list(connection_keys.values()):
+                for key in keys:
+                    previous = self.previous_hash(key[len(self.prefix):])
+                    if previous is not None:
+                        connection_keys[previous].append(key)
+        return connection_keys, messages, capacities
+
+    # Leases
+
+    def _lease(self, name):
+        return f'{self.prefix}:lease:{name}', self.connection(self.consistent_hash(name))
+
+    async def _previous_lease_holder(self, name):
+        """Holder of a lease still kept on its shard under the previous ring."""
+        previous = self.previous_hash(name)
+        if previous is None:
+            return None
+        holder = await self.connection(previous).get(f'{self.prefix}:lease:{name}')
+        return holder.decode('utf8') if holder is not None else None
+
+    async def claim_lease(self, name, owner, ttl):
+        """Take lease ``name`` for ``ttl`` seconds unless it is held; returns the holder."""
+        holder = await self._previous_lease_holder(name)
+        if holder is not None:
+            return holder
+        key, connection = self._lease(name)
+        holder = await connection.eval(CLAIM_SCRIPT, 1, key, owner, int(ttl * 1000))
+        return holder.decode('utf8') if isinstance(holder, bytes) else holder
+
+    async def renew_lease(self, name, owner, ttl):
+        """Extend a lease held by ``owner``; returns False if someone else holds it."""
+        if await self._previous_lease_holder(name) not in (None, owner):
+            return False
+        key, connection = self._lease(name)
+        renewed = bool(await connection.eval(RENEW_SCRIPT, 1, key, owner, int(ttl * 1000)))
+        if renewed and self.previous_hash(name) is not None:
+            # Moved to the current shard: drop the old copy
+            await self.connection(self.previous_hash(name)).eval(RELEASE_SCRIPT, 1, key, owner)
+        return renewed
+
+    async def release_lease(self, name, owner):
+        key, connection = self._lease(name)
+        await connection.eval(RELEASE_SCRIPT, 1, key, owner)
+        previous = self.previous_hash(name)
+        if previous is not None:
+            await self.connection(previous).eval(RELEASE_SCRIPT, 1, key, owner)
+
+    async def lease_holder(self, name):
+        holder = await self._previous_lease_holder(name)
+        if holder is not None:
+            return holder
+        key, connection = self._lease(name)
+        holder = await connection.get(key)
+        return holder.decode('utf8') if holder is not None else None
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    """Deliver to this process's channels in memory and to the rest via Redis.
+
+    Group memberships are still written to Redis so that other nodes reach
+    our channels, but ``group_send`` only publishes for members on other
+    nodes. Local receivers share the message's nested values, which
+    consumers treat as read-only.
+
+    Messages from Redis are read by one reader task per process channel
+    prefix, which fills the same receive buffers as local deliveries, so a
+    receiver never waits on Redis while a local message is queued for it.
+
+    A node that sends to a group registers in the group's tracker set and
+    reads its members once. Nodes adding or discarding members send every
+    tracker a membership message through its Redis channel, ahead of
+    anything else they send it, so a tracker knows of a member before it
+    can see messages from it. Until it has none left on other nodes,
+    ``group_send`` goes through Redis as before. Tracking needs this
+    process's reader running, which it is once a consumer receives.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.local_groups = defaultdict(set)
+        self.local_suffix = f'.{self.client_prefix}!'
+        self.membership_channel = f'specific{self.local_suffix}layer'
+        # Non-local channel name -> task moving its Redis messages into receive_buffer
+        self.readers = {}
+        # Tracked group -> its members on other nodes, and when to re-read them
+        self.remote_members = {}
+        self.tracking_expires = {}
+        self.tracking_loop = None
+
+    def is_local(self, channel):
+        return '!' in channel and self.non_local_name(channel).endswith(self.local_suffix)
+
+    def deliver_local(self, channel, message):
+        queue = self.receive_buffer[channel]
+        if queue.full():
+            raise ChannelFull()
+        queue.put_nowait(dict(message))
+
+    async def send(self, channel, message):
+        if not self.is_local(channel):
+            return await super().send(channel, message)
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        self.deliver_local(channel, message)
+
+    async def receive(self, channel):
+        if '!' not in channel:
+            return await super().receive(channel)
+        assert self.valid_channel_name(channel)
+        assert self.is_local(channel), "Wrong client prefix"
+        self.start_reader(self.non_local_name(channel))
+
+        queue = self.receive_buffer[channel]
+        try:
+            message = await queue.get()
+        except asyncio.CancelledError:
+            if queue.empty() and self.receive_buffer.get(channel) is queue:
+                del self.receive_buffer[channel]
+            raise
+        if queue.empty() and self.receive_buffer.get(channel) is queue:
+            del self.receive_buffer[channel]
+        return message
+
+    def start_reader(self, real_channel):
+        loop = asyncio.get_running_loop()
+        reader = self.readers.get(real_channel)
+        if reader is None or reader.done() or reader.get_loop() is not loop:
+            self.readers[real_channel] = loop.create_task(self.read_remote(real_channel))
+
+    async def read_remote(self, real_channel):
+        while True:
+            try:
+                message_channel, message = await self.receive_single(real_channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error receiving from Redis for %s, retrying", real_channel)
+                await asyncio.sleep(1)
+                continue
+            if not isinstance(message_channel, list):
+                message_channel = [message_channel]
+            for channel in message_channel:
+                if channel == self.membership_channel:
+                    self.apply_membership(message)
+                else:
+                    self.receive_buffer[channel].put_nowait(message)
+
+    # Membership of other nodes
+
+    def _trackers_key(self, group):
+        return f'{self.prefix}:trackers:{group}'
+
+    def can_track(self):
+        """Whether membership messages for this process are being read."""
+        loop = asyncio.get_running_loop()
+        reader = self.readers.get(self.non_local_name(self.membership_channel))
+        if reader is None or reader.done() or reader.get_loop() is not loop:
+            return False
+        if self.tracking_loop is not loop:
+            # Changes may have been read by a reader on another loop
+            self.remote_members.clear()
+            self.tracking_expires.clear()
+            self.tracking_loop = loop
+        return True
+
+    async def track(self, group):
+        """Register as a tracker of ``group`` and read its members on other nodes."""
+        await self.migrate_group(group)
+        connection = self.connection(self.consistent_hash(group))
+        key = self._trackers_key(group)
+        await connection.sadd(key, self.membership_channel)
+        await connection.expire(key, self.group_expiry)
+        # Changes from now on are sent to us, and the ones before are in the group
+        members = await connection.zrange(self._group_key(group), 0, -1)
+        members = (member.decode('utf8') for member in members)
+        self.remote_members[group] = {member for member in members if not self.is_local(member)}
+        self.tracking_expires[group] = time.monotonic() + TRACKING_REFRESH
+
+    async def notify_trackers(self, group, change, channel):
+        """Tell the nodes tracking ``group`` that ``channel`` joined or left it."""
+        message = {'type': MEMBERSHIP_TYPE, 'change': change, 'group': group, 'channel': channel}
+        self.apply_membership(message)
+        trackers = await self.connection(self.consistent_hash(group)).smembers(self._trackers_key(group))
+        previous = self.previous_hash(group)
+        if previous is not None:
+            # Nodes that registered before the shards changed
+            trackers |= await self.connection(previous).smembers(self._trackers_key(group))
+        for tracker in trackers:
+            tracker = tracker.decode('utf8')
+            if tracker == self.membership_channel:
+                continue
+            try:
+                await self.send(tracker, message)
+            except ChannelFull:
+                # It catches up when it re-reads the group
+                logger.warning("Tracker %s of group %s is over capacity", tracker, group)
+
+    def apply_membership(self, message):
+        members = self.remote_members.get(message['group'])
+        channel = message['channel']
+        if members is None or self.is_local(channel):
+            return
+        if message['change'] == 'add':
+            members.add(channel)
+        else:
+            members.discard(channel)
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        if self.is_local(channel):
+            self.local_groups[group].add(channel)
+        await self.notify_trackers(group, 'add', channel)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        members = self.local_groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.local_groups[group]
+        await self.notify_trackers(group, 'discard', channel)
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        exclude = message.get(EXCLUDE_KEY) or ()
+        over_capacity = 0
+        for channel in self.local_groups.get(group, ()):
+            if channel in exclude:
+                continue
+            try:
+                self.deliver_local(channel, message)
+            except ChannelFull:
+                over_capacity += 1
+        if over_capacity:
+            logger.info("%s local channels over capacity in group %s", over_capacity, group)
+
+        if self.can_track():
+            if self.tracking_expires.get(group, 0) <= time.monotonic():
+                await self.track(group)
+            if self.remote_members[group].issubset(exclude):
+                # Every member is on this node
+                return
+        await super().group_send(group, message)
+
+    def _map_channel_keys_to_connection(self, channel_names, message):
+        # Local members were served by group_send() already
+        channel_names = [name for name in channel_names if not self.is_local(name)]
+        return super()._map_channel_keys_to_connection(channel_names, message)
+
+    async def close_pools(self):
+        readers = [reader for reader in self.readers.values() if not reader.done()]
+        self.readers.clear()
+        self.remote_members.clear()
+        self.tracking_expires.clear()
+        for reader in readers:
+            reader.cancel()
+        if readers:
+            await asyncio.wait(readers)
+        await super().close_pools()
+
+    async def flush(self):
+        self.local_groups.clear()
+        self.receive_buffer.clear()
+        self.remote_members.clear()
+        self.tracking_expires.clear()
+        await super().flush()
+
+
+class InMemoryChannelLayer(BaseInMemoryChannelLayer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Lease name -> (holder, expiry on the monotonic clock)
+        self.leases = {}
+
+    async def claim_lease(self, name, owner, ttl):
+        holder = await self.lease_holder(name)
+        if holder is None:
+            self.leases[name] = (owner, time.monotonic() + ttl)
+            holder = owner
+        return holder
+
+    async def renew_lease(self, name, owner, ttl):
+        if await self.lease_holder(name) not in (None, owner):
+            return False
+        self.leases[name] = (owner, time.monotonic() + ttl)
+        return True
+
+    async def release_lease(self, name, owner):
+        if await self.lease_holder(name) == owner:
+            del self.leases[name]
+
+    async def lease_holder(self, name):
+        holder, expires = self.leases.get(name, (None, 0))
+        if expires <= time.monotonic():
+            self.leases.pop(name, None)
+            return None
+        return holder
+
+    async def flush(self):
+        self.leases.clear()
+        await super().flush()
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        self._clean_expired()
+        exclude = message.get(EXCLUDE_KEY) or ()
+        for channel in self.groups.get(group, set()):
+            if channel in exclude:
+                continue
+            try:
+                await self.send(channel, message)
+            except ChannelFull:
+                pass
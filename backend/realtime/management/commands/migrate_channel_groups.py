@@ -0,0 +1,17 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    """Move channel layer groups to their shard after Redis shards changed."""
+    help = ('Move every group stored on a Redis shard it no longer maps to, after '
+            'REDIS_SHARDS changed and REDIS_PREVIOUS_SHARDS lists the old shards. '
+            'Once it ran on every deployment, REDIS_PREVIOUS_SHARDS can be removed.')
+
+    def handle(self, *args, **options):
+        channel_layer = get_channel_layer()
+        if getattr(channel_layer, 'previous_ring', None) is None:
+            raise CommandError('Set REDIS_PREVIOUS_SHARDS to the shards before the change first.')
+        moved = async_to_sync(channel_layer.migrate_groups)()
+        self.stdout.write(self.style.SUCCESS(f'Moved {moved} groups to their new shard.'))
@@ -0,0 +1,37 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+from rest_framework.exceptions import AuthenticationFailed
+
+
+@database_sync_to_async
+def get_user_for_token(raw_token):
+    """Resolve a JWT access token to a user, or AnonymousUser if invalid."""
+    authentication = JWTAuthentication()
+    try:
+        validated_token = authentication.get_validated_token(raw_token)
+        return authentication.get_user(validated_token)
+    except (InvalidToken, TokenError, AuthenticationFailed):
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Populates scope["user"] from a ``token`` query string parameter.
+
+    Browsers cannot set an Authorization header on WebSocket handshakes, so
+    the frontend passes its JWT access token as ``?token=<access>`` instead.
+    Connections without a token keep the session user set by AuthMiddleware.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        query = parse_qs(scope.get('query_string', b'').decode())
+        token = query.get('token')
+        if token:
+            scope['user'] = await get_user_for_token(token[0])
+        return await super().__call__(scope, receive, send)
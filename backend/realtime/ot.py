@@ -0,0 +1,190 @@
+"""
+Positional operational transform for plain-text documents.
+
+An operation is a dict of one of two shapes:
+
+    {'type': 'insert', 'position': <int>, 'text': <str>}
+    {'type': 'delete', 'position': <int>, 'length': <int>}
+
+Positions are character offsets. A change is an ordered list of operations,
+each one expressed against the document produced by the previous one.
+"""
+
+
+class OperationError(ValueError):
+    """Raised when an operation is malformed or does not fit the document."""
+
+
+def normalize(ops):
+    """Validate a list of operations received from a client.
+
+    Returns a new list of clean operation dicts with no-op entries dropped.
+    """
+    if not isinstance(ops, list):
+        raise OperationError('ops must be a list')
+
+    result = []
+    for op in ops:
+        if not isinstance(op, dict):
+            raise OperationError('Each op must be an object')
+        op_type = op.get('type')
+        position = op.get('position')
+        if not isinstance(position, int) or isinstance(position, bool) or position < 0:
+            raise OperationError('Op position must be a non-negative integer')
+
+        if op_type == 'insert':
+            text = op.get('text')
+            if not isinstance(text, str):
+                raise OperationError('Insert op requires text')
+            if text:
+                result.append(insert(position, text))
+        elif op_type == 'delete':
+            length = op.get('length')
+            if not isinstance(length, int) or isinstance(length, bool) or length < 0:
+                raise OperationError('Delete op length must be a non-negative integer')
+            if length:
+                result.append(delete(position, length))
+        else:
+            raise OperationError(f"Unknown op type '{op_type}'")
+    return result
+
+
+def insert(position, text):
+    return {'type': 'insert', 'position': position, 'text': text}
+
+
+def delete(position, length):
+    return {'type': 'delete', 'position': position, 'length': length}
+
+
+def size(ops):
+    """Number of characters a change inserts and deletes."""
+    return sum(len(op['text']) if op['type'] == 'insert' else op['length'] for op in ops)
+
+
+def apply(text, ops):
+    """Apply a change to a document and return the new text."""
+    for op in ops:
+        position = op['position']
+        if position > len(text):
+            raise OperationError('Op position is past the end of the document')
+        if op['type'] == 'insert':
+            text = text[:position] + op['text'] + text[position:]
+        else:
+            end = position + op['length']
+            if end > len(text):
+                raise OperationError('Delete op runs past the end of the document')
+            text = text[:position] + text[end:]
+    return text
+
+
+def diff(old, new):
+    """Build a change turning ``old`` into ``new``.
+
+    Only the common prefix and suffix are trimmed, which is enough for the
+    single contiguous edits that full-content updates usually carry.
+    """
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+
+    old_end, new_end = len(old), len(new)
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+
+    ops = []
+    if old_end > start:
+        ops.append(delete(start, old_end - start))
+    if new_end > start:
+        ops.append(insert(start, new[start:new_end]))
+    return ops
+
+
+def transform(ops, against, ops_win_ties=False):
+    """Transform a change so it applies after a concurrent change.
+
+    Both changes must have been generated against the same document.
+    ``ops_win_ties`` decides which insert goes first when two inserts
+    land on the same position; the server always passes False for the
+    incoming change so that already-accepted history keeps its place.
+    """
+    transformed, _ = _transform_lists(ops, against, ops_win_ties)
+    return transformed
+
+
+def _transform_lists(left, right, left_wins):
+    """Transform two concurrent changes against each other.
+
+    Returns ``(left', right')`` where ``left'`` applies after ``right`` and
+    ``right'`` applies after ``left``.
+    """
+    if not left or not right:
+        return left, right
+
+    if len(left) == 1 and len(right) == 1:
+        return (
+            _transform_op(left[0], right[0], left_wins),
+            _transform_op(right[0], left[0], not left_wins),
+        )
+
+    if len(left) > 1:
+        head, right = _transform_lists(left[:1], right, left_wins)
+        tail, right = _transform_lists(left[1:], right, left_wins)
+        return head + tail, right
+
+    left, head = _transform_lists(left, right[:1], left_wins)
+    left, tail = _transform_lists(left, right[1:], left_wins)
+    return left, head + tail
+
+
+def _transform_op(op, against, op_wins_ties):
+    """Transform a single operation against a single concurrent operation.
+
+    Returns a list because a delete may be split in two by an insert that
+    lands inside the deleted range.
+    """
+    position = op['position']
+    other = against['position']
+
+    if op['type'] == 'insert':
+        if against['type'] == 'insert':
+            if position < other or (position == other and op_wins_ties):
+                return [op]
+            return [insert(position + len(against['text']), op['text'])]
+
+        # Insert against delete
+        if position <= other:
+            return [op]
+        if position >= other + against['length']:
+            return [insert(position - against['length'], op['text'])]
+        return [insert(other, op['text'])]
+
+    length = op['length']
+    end = position + length
+
+    if against['type'] == 'insert':
+        inserted = len(against['text'])
+        if other <= position:
+            return [delete(position + inserted, length)]
+        if other >= end:
+            return [op]
+        # The insert landed inside the deleted range: delete around it
+        before = other - position
+        return [
+            delete(position, before),
+            delete(position + inserted, length - before),
+        ]
+
+    # Delete against delete
+    other_end = other + against['length']
+    if end <= other:
+        return [op]
+    if position >= other_end:
+        return [delete(position - against['length'], length)]
+    overlap = min(end, other_end) - max(position, other)
+    remaining = length - overlap
+    if not remaining:
+        return []
+    return [delete(min(position, other), remaining)]
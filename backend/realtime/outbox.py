@@ -0,0 +1,271 @@
+"""
+Bounded outbound queues for realtime connections.
+
+Consumers don't write room messages to the socket from the handler that
+received them from the channel layer. They put them on the connection's
+``Outbox`` and a separate task writes them out, so a client on a slow link
+never holds up its consumer and, behind it, its channel layer queue (which
+channels_redis lets overflow and drop from silently). The writer goes at the
+pace the client reads: under Daphne, whose ``send`` returns before anything
+was written, it waits on the transport's flow control (``realtime.flow``)
+after each frame.
+
+While a connection is behind, superseded messages are coalesced:
+
+* a full-content frame (``file_update``, ``sync``) replaces the content
+  updates and ops still queued for the same file;
+* cursor batches queued for the same file are merged into one.
+
+If the queue still reaches ``REALTIME_OUTBOX_LIMIT`` messages, the queued
+room frames are dropped and replaced by a single resync: a fresh ``sync``
+for every file that lost frames and a ``tree`` resync for project events.
+Replies addressed to this connection alone (``file_ops_ack``, errors, save
+results) are never dropped: a sync can't stand in for them, and a client
+that lost its ack would have to throw its unsent edits away.
+A connection that needs more than ``REALTIME_OUTBOX_MAX_RESYNCS`` resyncs
+within ``REALTIME_OUTBOX_RESYNC_WINDOW`` seconds is closed with code 4408.
+
+``stats()`` reports the current queue depth and the coalesced, dropped,
+resync and disconnect counts per room for this process, and how many
+connections are waiting for their transport to drain.
+"""
+import asyncio
+import logging
+import time
+import weakref
+from collections import Counter, defaultdict, deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Message kinds with coalescing or resync rules
+CONTENT = 'content'
+OPS = 'ops'
+CURSORS = 'cursors'
+TREE = 'tree'
+RESYNC = 'resync'
+
+# Room frames a resync can replace; anything else is a reply to this connection
+RESYNCABLE = (CONTENT, OPS, CURSORS)
+
+# Close code for connections that keep falling behind
+CLOSE_LAGGING = 4408
+
+# Room name -> Counter of coalesced/dropped/resyncs/disconnects
+_counters = defaultdict(Counter)
+_outboxes = weakref.WeakSet()
+
+
+class Entry:
+    __slots__ = ('data', 'kind', 'file')
+
+    def __init__(self, data, kind=None, file=None):
+        self.data = data
+        self.kind = kind
+        self.file = file
+
+    @property
+    def droppable(self):
+        """Whether a resync can stand in for this message."""
+        return (self.file is not None and self.kind in RESYNCABLE) or self.kind == TREE
+
+
+class Outbox:
+    """Outbound message queue of one connection."""
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        # Set when the server's send doesn't wait for the client (Daphne)
+        self.flow = consumer.scope.get('flow_control')
+        self.queue = deque()
+        self.limit = settings.REALTIME_OUTBOX_LIMIT
+        self.ready = asyncio.Event()
+        self.task = None
+        self.closing = None
+        self.closed = False
+
+        # What the queued resync has to restore
+        self.resync_files = set()
+        self.resync_tree = False
+        self.resync_times = deque()
+        _outboxes.add(self)
+
+    def room_name(self, entry):
+        if entry.file is not None:
+            return f'file_{entry.file}'
+        if entry.kind == TREE:
+            return getattr(self.consumer, 'project_group_name', None)
+        return None
+
+    def count(self, entry, counter, amount=1):
+        room = self.room_name(entry)
+        if room is not None:
+            _counters[room][counter] += amount
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        self.closed = True
+        self.queue.clear()
+        _outboxes.discard(self)
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def put(self, data, kind=None, file=None):
+        """Queue an encoded frame; ``kind`` and ``file`` drive coalescing."""
+        if self.closed:
+            return
+        entry = Entry(data, kind, file)
+
+        if kind == CURSORS and self._merge_cursors(entry):
+            return
+        if kind == CONTENT:
+            self._supersede(entry.file)
+
+        if len(self.queue) >= self.limit:
+            self._overflow()
+            if self.closed:
+                return
+            if entry.droppable:
+                # The queued resync covers it
+                self._mark_for_resync(entry)
+                return
+
+        self.queue.append(entry)
+        self.ready.set()
+
+    def _supersede(self, file):
+        kept = deque()
+        for queued in self.queue:
+            if queued.file == file and queued.kind in (CONTENT, OPS):
+                self.count(queued, 'coalesced')
+            else:
+                kept.append(queued)
+        self.queue = kept
+
+    def _merge_cursors(self, entry):
+        for queued in reversed(self.queue):
+            if queued.file == entry.file and queued.kind == CURSORS:
+                break
+        else:
+            return False
+
+        codec = self.consumer.codec
+        older, newer = codec.decode(queued.data), codec.decode(entry.data)
+        cursors = {cursor['connection']: cursor for cursor in older['cursors']}
+        for event in newer['presence']:
+            if event['action'] == 'leave':
+                cursors.pop(event['connection'], None)
+        for cursor in newer['cursors']:
+            cursors[cursor['connection']] = cursor
+        queued.data = codec.encode({
+            **newer,
+            'presence': older['presence'] + newer['presence'],
+            'cursors': list(cursors.values()),
+        })
+        self.count(entry, 'coalesced')
+        return True
+
+    def _mark_for_resync(self, entry):
+        self.count(entry, 'dropped')
+        if entry.file is not None:
+            self.resync_files.add(entry.file)
+        else:
+            self.resync_tree = True
+
+    def _overflow(self):
+        now = time.monotonic()
+        window = settings.REALTIME_OUTBOX_RESYNC_WINDOW
+        while self.resync_times and self.resync_times[0] < now - window:
+            self.resync_times.popleft()
+
+        kept = deque()
+        for queued in self.queue:
+            if queued.droppable:
+                self._mark_for_resync(queued)
+            elif queued.kind != RESYNC:
+                kept.append(queued)
+        self.queue = kept
+
+        self.resync_times.append(now)
+        rooms = {f'file_{file}' for file in self.resync_files}
+        if self.resync_tree:
+            rooms.add(getattr(self.consumer, 'project_group_name', None))
+        rooms.discard(None)
+
+        if len(self.resync_times) > settings.REALTIME_OUTBOX_MAX_RESYNCS:
+            for room in rooms:
+                _counters[room]['disconnects'] += 1
+            logger.info('Closing realtime connection %s: too far behind', self.consumer.channel_name)
+            self._disconnect()
+            return
+
+        for room in rooms:
+            _counters[room]['resyncs'] += 1
+        self.queue.append(Entry(None, RESYNC))
+
+    def _disconnect(self):
+        self.closed = True
+        self.queue.clear()
+        if self.task is not None:
+            self.task.cancel()
+        self.closing = asyncio.get_running_loop().create_task(
+            self.consumer.close(code=CLOSE_LAGGING)
+        )
+
+    async def _run(self):
+        try:
+            while True:
+                while not self.queue:
+                    self.ready.clear()
+                    await self.ready.wait()
+                entry = self.queue.popleft()
+                if entry.kind == RESYNC:
+                    files, tree = self.resync_files, self.resync_tree
+                    self.resync_files, self.resync_tree = set(), False
+                    # The syncs are built now, so they include what is still queued
+                    for file in files:
+                        self._supersede(file)
+                    await self.consumer.resync(files, tree)
+                else:
+                    await self.consumer.send_encoded(entry.data)
+                if self.flow is not None:
+                    # Keep further frames here, where they are coalesced and
+                    # bounded, until the client read what was written
+                    await self.flow.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Realtime outbox writer failed for %s', self.consumer.channel_name)
+
+
+def stats():
+    """Queue depth and drop counters per room for this process."""
+    rooms = defaultdict(lambda: {
+        'queued': 0, 'max_queued': 0,
+        'coalesced': 0, 'dropped': 0, 'resyncs': 0, 'disconnects': 0,
+    })
+    for room, counter in _counters.items():
+        rooms[room].update(counter)
+
+    connections = list(_outboxes)
+    for outbox in connections:
+        depth = Counter(outbox.room_name(entry) for entry in outbox.queue)
+        for room, queued in depth.items():
+            if room is None:
+                continue
+            rooms[room]['queued'] += queued
+            rooms[room]['max_queued'] = max(rooms[room]['max_queued'], queued)
+
+    return {
+        'connections': len(connections),
+        'paused': sum(1 for outbox in connections if outbox.flow is not None and outbox.flow.paused),
+        'queued': sum(len(outbox.queue) for outbox in connections),
+        'rooms': dict(rooms),
+    }
@@ -0,0 +1,122 @@
+"""
+Write-behind persistence of room documents to ``File.content``.
+
+Rooms are marked dirty as edits arrive. A single background task per event
+loop wakes up every ``REALTIME_FLUSH_INTERVAL`` seconds, collects the rooms
+whose changes are due (see ``Room.is_due``) and writes them back in one
+batched UPDATE, so the database sees one write per file per interval rather
+than one per save.
+
+Versions are not taken per write either. A flush records the document as
+of the room's last checkpoint as a ``Version`` once enough characters
+changed or enough time passed since it (``VERSION_AUTOSAVE_DISTANCE`` /
+``VERSION_AUTOSAVE_INTERVAL``). Consumers also flush with ``checkpoint``
+when an editing session ends or a client asks to save, which always
+records a version if the document changed.
+"""
+import asyncio
+import logging
+import time
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from files.models import File, content_metadata
+from projects.models import ProjectStats
+from versions.models import Version
+from . import rooms
+
+logger = logging.getLogger(__name__)
+
+AUTOSAVE_DESCRIPTION = 'Auto-snapshot before live edits'
+
+_loop = None
+_task = None
+
+
+def schedule():
+    """Make sure the flusher task is running on the current event loop."""
+    global _loop, _task
+    loop = asyncio.get_running_loop()
+    if _task is None or _task.done() or _loop is not loop:
+        _loop = loop
+        _task = loop.create_task(_run())
+
+
+async def _run():
+    while True:
+        await asyncio.sleep(settings.REALTIME_FLUSH_INTERVAL)
+        now = time.monotonic()
+        live_rooms = rooms.all_rooms()
+        await flush([room for room in live_rooms if room.is_due(now)])
+        if not any(room.dirty for room in live_rooms):
+            break
+
+
+async def flush(room_list, checkpoint=False):
+    """Persist the given rooms' documents in a single batch.
+
+    With ``checkpoint``, every room whose document changed since its last
+    version gets one. Returns False if the write failed and will be retried.
+    """
+    now = time.monotonic()
+    batch = []
+    for room in room_list:
+        version = room.version_due(now, force=checkpoint)
+        if room.dirty or version:
+            batch.append((room, room.take_snapshot(version=version)))
+    if not batch:
+        return True
+
+    try:
+        await database_sync_to_async(write_snapshots)([snapshot for _, snapshot in batch])
+    except Exception:
+        logger.exception('Failed to persist %d room document(s)', len(batch))
+        # Keep the changes around so the next tick retries them
+        for room, snapshot in batch:
+            room.restore_snapshot(snapshot)
+        schedule()
+        return False
+    return True
+
+
+@transaction.atomic
+def write_snapshots(snapshots):
+    """Write captured room documents to their File rows with one bulk UPDATE."""
+    files = File.objects.only('id', 'project', 'encoding', 'updated_by').in_bulk(
+        [snapshot.file_id for snapshot in snapshots]
+    )
+    now = timezone.now()
+    changed = []
+    for snapshot in snapshots:
+        file = files.get(snapshot.file_id)
+        if file is None:
+            # File was deleted while the room was open
+            continue
+        file.content = snapshot.content
+        for field, value in content_metadata(snapshot.content, file.encoding).items():
+            setattr(file, field, value)
+        file.updated_at = now
+        if snapshot.editor_id is not None:
+            file.updated_by_id = snapshot.editor_id
+        changed.append(file)
+
+    File.objects.bulk_update(
+        changed,
+        ['content', 'size', 'line_count', 'content_hash', 'updated_at', 'updated_by'],
+    )
+    if changed:
+        ProjectStats.invalidate(*{file.project_id for file in changed})
+
+    for snapshot in snapshots:
+        file = files.get(snapshot.file_id)
+        if file is not None and snapshot.version_content is not None:
+            Version.objects.create_snapshot(
+                file=file,
+                content=snapshot.version_content,
+                created_by_id=snapshot.editor_id,
+                description=AUTOSAVE_DESCRIPTION,
+                kind=Version.KIND_AUTO,
+            )
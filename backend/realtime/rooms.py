@@ -0,0 +1,286 @@
+"""
+In-process state for collaborative editing rooms.
+
+Each open file has one ``Room``, held by the server process that owns the
+room (see ``realtime.hosting``); the registry here only contains the rooms
+this process owns. The room holds the authoritative copy of the document
+while anyone is editing it, plus the revision counter and a bounded history
+of accepted changes so that operations sent against an older revision can
+be transformed before they are applied and broadcast. Dirty rooms are
+written back to ``File.content`` by ``realtime.persistence``.
+"""
+import asyncio
+import time
+from collections import deque
+
+from django.conf import settings
+
+from . import ot
+
+
+class StaleRevision(ot.OperationError):
+    """Raised when a change is based on a revision the room no longer holds."""
+
+
+class Snapshot:
+    """Document state captured for a write-behind flush.
+
+    ``version_content`` is the document as of the previous checkpoint when
+    the flush should record it as a version, else None.
+    """
+
+    def __init__(self, file_id, content, editor_id, version_content=None, distance=0):
+        self.file_id = file_id
+        self.content = content
+        self.editor_id = editor_id
+        self.version_content = version_content
+        self.distance = distance
+
+
+class Room:
+    """Editing session state for a single file."""
+
+    def __init__(self, file_id, history_limit=None):
+        self.file_id = file_id
+        self.content = None
+        self.revision = 0
+        self.history = deque(maxlen=history_limit or settings.REALTIME_HISTORY_LIMIT)
+        self.members = set()
+
+        # Users who announced themselves, by connection id, with their latest cursor
+        self.present = {}
+        # Presence events and cursor moves waiting for the next batched broadcast
+        self.pending_presence = []
+        self.pending_cursors = {}
+
+        # Write-behind bookkeeping
+        self.dirty = False
+        self.pending_changes = 0
+        self.first_change_at = None
+        self.last_change_at = None
+        self.last_editor_id = None
+        self._load_lock = asyncio.Lock()
+
+        # Last state recorded as a version (or loaded), and the characters changed since
+        self.checkpoint_content = None
+        self.checkpoint_at = None
+        self.checkpoint_distance = 0
+
+    @property
+    def loaded(self):
+        return self.content is not None
+
+    async def load(self, loader):
+        """Fill the document buffer once, using ``loader`` to read it."""
+        async with self._load_lock:
+            if self.content is None:
+                self.content = await loader()
+                self.set_checkpoint()
+
+    def apply_ops(self, ops, base_revision, editor_id=None):
+        """Accept a change made against ``base_revision``.
+
+        Returns the change transformed against everything accepted since
+        ``base_revision``, which is what peers need to apply.
+        """
+        if not isinstance(base_revision, int) or base_revision > self.revision:
+            raise StaleRevision('Unknown base revision')
+
+        behind = self.revision - base_revision
+        if behind > len(self.history):
+            raise StaleRevision('Base revision is too old, resync required')
+
+        if behind:
+            for concurrent in list(self.history)[-behind:]:
+                ops = ot.transform(ops, concurrent)
+
+        # Raises OperationError before anything is committed if ops don't fit
+        content = ot.apply(self.content, ops)
+        self._commit(content, ops, editor_id)
+        return ops
+
+    def replace_content(self, content, editor_id=None):
+        """Replace the whole document, recording the difference as one change."""
+        ops = ot.diff(self.content or '', content)
+        self._commit(content, ops, editor_id)
+
+    def adopt_saved(self, content, force=False):
+        """Take on content that was written to the database outside the room.
+
+        Unsaved live edits win over an ordinary save unless ``force`` is set
+        (e.g. a revert). Returns True if the document changed.
+        """
+        if content == self.content:
+            return False
+        if self.dirty and not force:
+            return False
+        self.replace_content(content)
+        self.mark_clean()
+        # The save that wrote it took its own version
+        self.set_checkpoint()
+        return True
+
+    def _commit(self, content, ops, editor_id):
+        self.content = content
+        self.history.append(ops)
+        self.revision += 1
+        self.checkpoint_distance += ot.size(ops)
+
+        now = time.monotonic()
+        if not self.dirty:
+            self.dirty = True
+            self.first_change_at = now
+        self.pending_changes += 1
+        self.last_change_at = now
+        if editor_id is not None:
+            self.last_editor_id = editor_id
+
+    def join_presence(self, connection, username):
+        self.present[connection] = {'username': username, 'position': None}
+        self.pending_presence.append({'connection': connection, 'action': 'join', 'username': username})
+
+    def leave_presence(self, connection):
+        """Forget a connection's presence and cursor. Returns False if it wasn't present."""
+        entry = self.present.pop(connection, None)
+        self.pending_cursors.pop(connection, None)
+        if entry is None:
+            return False
+        self.pending_presence.append({
+            'connection': connection, 'action': 'leave', 'username': entry['username'],
+        })
+        return True
+
+    def move_cursor(self, connection, username, position):
+        """Record a cursor move; only the latest one per connection is broadcast."""
+        entry = self.present.setdefault(connection, {'username': username, 'position': None})
+        entry['position'] = position
+        self.pending_cursors[connection] = {
+            'connection': connection, 'username': username, 'position': position,
+        }
+
+    def present_users(self):
+        """Announced users with their latest cursors, for the join snapshot."""
+        return [
+            {'connection': connection, 'username': entry['username'], 'position': entry['position']}
+            for connection, entry in self.present.items()
+        ]
+
+    @property
+    def has_pending_updates(self):
+        return bool(self.pending_presence or self.pending_cursors)
+
+    def take_updates(self):
+        """Return and clear the queued ``(presence, cursors)`` updates."""
+        presence, cursors = self.pending_presence, list(self.pending_cursors.values())
+        self.pending_presence = []
+        self.pending_cursors = {}
+        return presence, cursors
+
+    def mark_clean(self):
+        self.dirty = False
+        self.pending_changes = 0
+        self.first_change_at = None
+
+    def is_due(self, now):
+        """Whether the room's unsaved changes should be flushed now."""
+        if not self.dirty:
+            return False
+        return (
+            now - self.last_change_at >= settings.REALTIME_FLUSH_DEBOUNCE
+            or now - self.first_change_at >= settings.REALTIME_FLUSH_MAX_DELAY
+            or self.pending_changes >= settings.REALTIME_FLUSH_MAX_CHANGES
+        )
+
+    def set_checkpoint(self):
+        self.checkpoint_content = self.content
+        self.checkpoint_at = time.monotonic()
+        self.checkpoint_distance = 0
+
+    def version_due(self, now, force=False):
+        """Whether the next flush should record the previous checkpoint as a version.
+
+        That is once enough characters changed or enough time passed since
+        the checkpoint, or with ``force`` whenever the document changed.
+        """
+        if self.checkpoint_content is None or self.checkpoint_content == self.content:
+            return False
+        return (
+            force
+            or self.checkpoint_distance >= settings.VERSION_AUTOSAVE_DISTANCE
+            or now - self.checkpoint_at >= settings.VERSION_AUTOSAVE_INTERVAL
+        )
+
+    def take_snapshot(self, version=False):
+        """Capture the current document for persistence and mark the room clean."""
+        snapshot = Snapshot(self.file_id, self.content, self.last_editor_id)
+        if version:
+            snapshot.version_content = self.checkpoint_content
+            snapshot.distance = self.checkpoint_distance
+            self.set_checkpoint()
+        self.mark_clean()
+        return snapshot
+
+    def restore_snapshot(self, snapshot):
+        """Mark a snapshot that failed to persist as unsaved again."""
+        if not self.dirty:
+            self.dirty = True
+            self.first_change_at = self.last_change_at = time.monotonic()
+            self.pending_changes = 1
+        if snapshot.version_content is not None:
+            self.checkpoint_content = snapshot.version_content
+            self.checkpoint_distance += snapshot.distance
+
+
+_rooms = {}
+
+
+def lease_name(file_id):
+    """Name of the channel layer lease held by the owner of a file's room."""
+    return f'room_{file_id}'
+
+
+def owner_group(file_id):
+    """Group whose only member is the node channel of the room's owner."""
+    return f'file_{file_id}.owner'
+
+
+def join(file_id, channel_name):
+    """Register a channel as a member of a file's room, creating it if needed."""
+    room = _rooms.get(file_id)
+    if room is None:
+        room = _rooms[file_id] = Room(file_id)
+    room.members.add(channel_name)
+    return room
+
+
+def leave(file_id, channel_name):
+    """Remove a channel from a room. Returns the room, which may now be empty."""
+    room = _rooms.get(file_id)
+    if room is not None:
+        room.members.discard(channel_name)
+    return room
+
+
+def discard(room):
+    """Drop a room from the registry if nobody rejoined it in the meantime.
+
+    Returns True if the room was dropped.
+    """
+    if not room.members and _rooms.get(room.file_id) is room:
+        del _rooms[room.file_id]
+        return True
+    return False
+
+
+def drop(room):
+    """Drop a room from the registry whoever is still in it."""
+    if _rooms.get(room.file_id) is room:
+        del _rooms[room.file_id]
+
+
+def get(file_id):
+    return _rooms.get(file_id)
+
+
+def all_rooms():
+    return list(_rooms.values())
@@ -2,5 +2,6 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
-    re_path(r'ws/file/(?P<file_id>\w+)/$', consumers.FileConsumer.as_asgi()),
+    re_path(r'ws/file/(?P<file_id>\d+)/$', consumers.FileConsumer.as_asgi()),
+    re_path(r'ws/project/(?P<project_id>\d+)/$', consumers.ProjectConsumer.as_asgi()),
 ]
@@ -0,0 +1,57 @@
+"""
+Consistent hashing of channel layer keys onto Redis shards.
+
+channels_redis picks the shard for a group or channel by splitting the CRC
+space into equal ranges, one per host, so adding a host moves most groups
+to a different shard. ``HashRing`` places every shard at many points on a
+hash ring instead: a key belongs to the next shard point clockwise from its
+own hash, and adding a shard only takes over roughly ``1/N`` of the keys.
+"""
+import bisect
+import hashlib
+
+# Points per shard on the ring; more points give a more even spread
+DEFAULT_REPLICAS = 160
+
+
+def hash_key(value):
+    if isinstance(value, str):
+        value = value.encode('utf8')
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), 'big')
+
+
+def shard_name(host):
+    """Stable identity of a channels_redis host entry, independent of its position."""
+    if 'address' in host:
+        return str(host['address'])
+    if 'master_name' in host:
+        return f"sentinel:{host['master_name']}"
+    return f"{host.get('host', 'localhost')}:{host.get('port', 6379)}:{host.get('db', 0)}"
+
+
+class HashRing:
+    """Map keys to the index of one of ``nodes`` by consistent hashing."""
+
+    def __init__(self, nodes, replicas=DEFAULT_REPLICAS):
+        self.nodes = list(nodes)
+        if len(set(self.nodes)) != len(self.nodes):
+            raise ValueError('Shard names must be unique')
+        points = sorted(
+            (hash_key(f'{node}#{replica}'), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._indexes = [index for _, index in points]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def index_for(self, key):
+        if len(self.nodes) == 1:
+            return 0
+        position = bisect.bisect(self._hashes, hash_key(key)) % len(self._hashes)
+        return self._indexes[position]
+
+    def node_for(self, key):
+        return self.nodes[self.index_for(key)]
@@ -0,0 +1,810 @@
+import asyncio
+import functools
+import random
+import threading
+import unittest
+from unittest import mock
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from files.models import File
+from projects.models import Project
+from versions.models import Version
+from . import codecs, flow, hosting, ot, outbox, persistence, rooms
+from .consumers import RoomConsumer
+from .layers import HybridChannelLayer, RedisChannelLayer
+from .middleware import JWTAuthMiddleware
+from .routing import websocket_urlpatterns
+
+MEMORY_LAYER = {'default': {'BACKEND': 'realtime.layers.InMemoryChannelLayer'}}
+
+application = URLRouter(websocket_urlpatterns)
+
+try:
+    from fakeredis import TcpFakeServer
+except ImportError:
+    TcpFakeServer = None
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER, REALTIME_ROOM_LEASE=0.3)
+class RealtimeTestCase(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.project = Project.objects.create(name='p', owner=self.user)
+        self.file = File.objects.create(project=self.project, name='a.py', content='hello', created_by=self.user)
+        rooms._rooms.clear()
+        self.layer = get_channel_layer()
+
+    async def connect(self, path=None):
+        communicator = WebsocketCommunicator(application, path or f'/ws/file/{self.file.pk}/')
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator, message_type, timeout=2):
+        """Skip frames until one of ``message_type`` arrives."""
+        while True:
+            message = await communicator.receive_json_from(timeout=timeout)
+            if message['type'] == message_type:
+                return message
+
+    async def receive_on(self, channel, message_type, timeout=2):
+        while True:
+            message = await asyncio.wait_for(self.layer.receive(channel), timeout)
+            if message['type'] == message_type:
+                return message
+
+
+class OwnershipTests(RealtimeTestCase):
+    async def test_first_member_owns_the_room(self):
+        client = await self.connect()
+        sync = await self.receive(client, 'sync')
+        self.assertEqual((sync['content'], sync['revision']), ('hello', 0))
+
+        node = await hosting.get_node()
+        lease = rooms.lease_name(self.file.pk)
+        self.assertEqual(await self.layer.lease_holder(lease), node.channel)
+        await client.disconnect()
+        self.assertIsNone(rooms.get(self.file.pk))
+        self.assertIsNone(await self.layer.lease_holder(lease))
+
+    async def test_members_elsewhere_forward_to_the_owner(self):
+        # Another process owns the room
+        owner = await self.layer.new_channel('rooms')
+        await self.layer.claim_lease(rooms.lease_name(self.file.pk), owner, 60)
+
+        client = await self.connect()
+        join = await self.receive_on(owner, 'room.request')
+        self.assertEqual(join['action'], 'join')
+        self.assertIsNone(rooms.get(self.file.pk))
+
+        member = join['member']['channel']
+        await self.layer.send(member, {
+            'type': 'room_reply', 'file': self.file.pk, 'kind': 'content',
+            'payload': {'type': 'sync', 'file': self.file.pk, 'content': 'remote', 'revision': 7},
+        })
+        self.assertEqual((await self.receive(client, 'sync'))['content'], 'remote')
+
+        ops = [{'type': 'insert', 'position': 6, 'text': 'x'}]
+        await client.send_json_to({'type': 'file_ops', 'ops': ops, 'revision': 7})
+        request = await self.receive_on(owner, 'room.request')
+        self.assertEqual(
+            (request['action'], request['message_type'], request['data']['ops']),
+            ('message', 'file_ops', ops),
+        )
+
+        await client.disconnect()
+        self.assertEqual((await self.receive_on(owner, 'room.request'))['action'], 'leave')
+
+    async def test_owner_serves_members_elsewhere(self):
+        client = await self.connect()
+        await self.receive(client, 'sync')
+        node = await hosting.get_node()
+
+        remote = await self.layer.new_channel()
+        await self.layer.group_add(f'file_{self.file.pk}', remote)
+        member = hosting.Member(remote, 'remote-connection', self.user.pk)
+        await node.forward(node.channel, self.file.pk, 'join', member)
+        reply = await self.receive_on(remote, 'room_reply')
+        self.assertEqual((reply['payload']['type'], reply['payload']['content']), ('sync', 'hello'))
+
+        ops = [{'type': 'insert', 'position': 5, 'text': '!'}]
+        await node.forward(node.channel, self.file.pk, 'message', member,
+                           message_type='file_ops', data={'ops': ops, 'revision': 0})
+        ack = await self.receive_on(remote, 'ops_message')
+        self.assertEqual(ack['sender_channel_name'], remote)
+        broadcast = await self.receive(client, 'file_ops')
+        self.assertEqual((broadcast['ops'], broadcast['revision']), (ops, 1))
+        self.assertEqual(rooms.get(self.file.pk).content, 'hello!')
+
+        # The room stays open while the remote member is in it
+        await client.disconnect()
+        self.assertIsNotNone(rooms.get(self.file.pk))
+        await node.forward(node.channel, self.file.pk, 'leave', member)
+        for _ in range(50):
+            if rooms.get(self.file.pk) is None:
+                break
+            await asyncio.sleep(0.02)
+        self.assertIsNone(rooms.get(self.file.pk))
+        content = await File.objects.values_list('content', flat=True).aget(pk=self.file.pk)
+        self.assertEqual(content, 'hello!')
+
+    async def test_room_moves_when_the_owner_stops_renewing(self):
+        owner = await self.layer.new_channel('rooms')
+        await self.layer.claim_lease(rooms.lease_name(self.file.pk), owner, 0.2)
+
+        client = await self.connect()
+        await self.receive_on(owner, 'room.request')
+        # The lease lapses, the session rejoins and takes the room over
+        sync = await self.receive(client, 'sync')
+        self.assertEqual(sync['content'], 'hello')
+        node = await hosting.get_node()
+        self.assertEqual(await self.layer.lease_holder(rooms.lease_name(self.file.pk)), node.channel)
+        self.assertIsNotNone(rooms.get(self.file.pk))
+        await client.disconnect()
+
+    async def test_owner_drops_a_room_taken_over_elsewhere(self):
+        client = await self.connect()
+        await self.receive(client, 'sync')
+
+        other = await self.layer.new_channel('rooms')
+        self.layer.leases[rooms.lease_name(self.file.pk)] = (other, float('inf'))
+        join = await self.receive_on(other, 'room.request')
+        self.assertEqual(join['action'], 'join')
+        self.assertIsNone(rooms.get(self.file.pk))
+        await client.disconnect()
+
+
+def random_change(rng, text, count):
+    """``count`` random ops, each applying to the document left by the previous one."""
+    ops = []
+    for _ in range(count):
+        position = rng.randint(0, len(text))
+        if text and rng.random() < 0.5:
+            position = min(position, len(text) - 1)
+            op = ot.delete(position, rng.randint(1, len(text) - position))
+        else:
+            op = ot.insert(position, rng.choice(['x', 'yz', '\n', '\U0001f600']))
+        text = ot.apply(text, [op])
+        ops.append(op)
+    return ops
+
+
+class TransformTests(SimpleTestCase):
+    def assertConverges(self, text, left, right):
+        left_after, right_after = ot._transform_lists(left, right, True)
+        self.assertEqual(
+            ot.apply(ot.apply(text, left), right_after),
+            ot.apply(ot.apply(text, right), left_after),
+        )
+
+    def test_concurrent_inserts_at_the_same_position(self):
+        left, right = [ot.insert(2, 'A')], [ot.insert(2, 'B')]
+        self.assertEqual(ot.apply(ot.apply('abcd', right), ot.transform(left, right)), 'abBAcd')
+        self.assertConverges('abcd', left, right)
+
+    def test_insert_inside_a_deleted_range_splits_the_delete(self):
+        delete, insert = [ot.delete(1, 4)], [ot.insert(3, 'X')]
+        self.assertEqual(
+            ot.transform(delete, insert),
+            [ot.delete(1, 2), ot.delete(2, 2)],
+        )
+        self.assertEqual(ot.apply(ot.apply('abcdefg', insert), ot.transform(delete, insert)), 'aXfg')
+        self.assertConverges('abcdefg', delete, insert)
+
+    def test_overlapping_deletes(self):
+        self.assertEqual(ot.transform([ot.delete(1, 4)], [ot.delete(3, 4)]), [ot.delete(1, 2)])
+        self.assertEqual(ot.transform([ot.delete(2, 2)], [ot.delete(1, 4)]), [])
+        self.assertConverges('abcdefgh', [ot.delete(1, 4)], [ot.delete(3, 4)])
+
+    def test_random_concurrent_changes_converge(self):
+        rng = random.Random(1)
+        for _ in range(2000):
+            text = ''.join(rng.choice('ab\u00e9\U0001f600') for _ in range(rng.randint(0, 8)))
+            left = random_change(rng, text, rng.randint(1, 3))
+            right = random_change(rng, text, rng.randint(1, 3))
+            with self.subTest(text=text, left=left, right=right):
+                self.assertConverges(text, left, right)
+
+
+class RoomTests(SimpleTestCase):
+    def setUp(self):
+        self.room = rooms.Room(1, history_limit=3)
+        self.room.content = 'abc'
+
+    def test_stale_change_is_transformed_against_history(self):
+        self.room.apply_ops([ot.insert(0, '>')], 0)
+        self.room.apply_ops([ot.delete(3, 1)], 1)
+        # Made against revision 0, before both changes above
+        ops = self.room.apply_ops([ot.insert(3, '!')], 0)
+        self.assertEqual(ops, [ot.insert(3, '!')])
+        self.assertEqual((self.room.content, self.room.revision), ('>ab!', 3))
+
+    def test_random_concurrent_clients_converge(self):
+        rng = random.Random(2)
+        room = rooms.Room(1, history_limit=100)
+        room.content = 'hello'
+        # Clients keep at most one change in flight, as the editor does: the
+        # server gets it as sent, while the client transforms its own copy
+        # against peer changes to apply those locally
+        clients = [{'text': 'hello', 'revision': 0, 'sent': None} for _ in range(3)]
+
+        def accept(client):
+            ops, base = client['sent']
+            accepted = room.apply_ops(ops, base)
+            client['sent'] = client['local'] = None
+            client['revision'] = room.revision
+            for other in clients:
+                if other is client:
+                    continue
+                incoming = accepted
+                if other['sent'] is not None:
+                    other['local'], incoming = ot._transform_lists(other['local'], incoming, False)
+                other['text'] = ot.apply(other['text'], incoming)
+                other['revision'] = room.revision
+
+        for _ in range(300):
+            client = rng.choice(clients)
+            if client['sent'] is None:
+                ops = random_change(rng, client['text'], rng.randint(1, 2))
+                client['sent'], client['local'] = (ops, client['revision']), ops
+                client['text'] = ot.apply(client['text'], ops)
+            else:
+                accept(client)
+        for client in clients:
+            if client['sent'] is not None:
+                accept(client)
+        self.assertGreater(room.revision, 50)
+        self.assertEqual([client['text'] for client in clients], [room.content] * 3)
+
+    def test_unknown_base_revision(self):
+        with self.assertRaisesMessage(rooms.StaleRevision, 'Unknown base revision'):
+            self.room.apply_ops([ot.insert(0, 'x')], 1)
+        with self.assertRaisesMessage(rooms.StaleRevision, 'Unknown base revision'):
+            self.room.apply_ops([ot.insert(0, 'x')], '0')
+
+    def test_base_revision_older_than_history(self):
+        for revision in range(4):
+            self.room.apply_ops([ot.insert(0, 'x')], revision)
+        with self.assertRaisesMessage(rooms.StaleRevision, 'too old'):
+            self.room.apply_ops([ot.insert(0, 'y')], 0)
+        self.assertEqual(self.room.revision, 4)
+        self.room.apply_ops([ot.insert(0, 'y')], 1)
+        # Accepted inserts at the same position keep their place
+        self.assertEqual(self.room.content, 'xxxyxabc')
+
+
+class FileOpsTests(RealtimeTestCase):
+    async def test_concurrent_changes_converge(self):
+        alice, bob = await self.connect(), await self.connect()
+        await self.receive(alice, 'sync')
+        await self.receive(bob, 'sync')
+
+        # Both edit revision 0
+        await alice.send_json_to({'type': 'file_ops', 'ops': [ot.insert(0, 'A')], 'revision': 0})
+        await bob.send_json_to({'type': 'file_ops', 'ops': [ot.delete(1, 3)], 'revision': 0})
+
+        self.assertEqual((await self.receive(alice, 'file_ops_ack'))['revision'], 1)
+        peer = await self.receive(alice, 'file_ops')
+        self.assertEqual((peer['ops'], peer['revision']), ([ot.delete(2, 3)], 2))
+        self.assertEqual((await self.receive(bob, 'file_ops'))['ops'], [ot.insert(0, 'A')])
+        self.assertEqual((await self.receive(bob, 'file_ops_ack'))['revision'], 2)
+
+        self.assertEqual(ot.apply('Ahello', peer['ops']), 'Aho')
+        self.assertEqual(rooms.get(self.file.pk).content, 'Aho')
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_rejected_changes_get_an_error(self):
+        client = await self.connect()
+        await self.receive(client, 'sync')
+        await client.send_json_to({'type': 'file_ops', 'ops': [ot.insert(0, 'x')], 'revision': 0})
+        await self.receive(client, 'file_ops_ack')
+
+        for ops, revision, error in [
+            ([ot.insert(0, 'x')], 5, 'Unknown base revision'),
+            ([ot.insert(99, 'x')], 1, 'past the end'),
+            ([{'type': 'move', 'position': 0}], 1, 'Unknown op type'),
+        ]:
+            await client.send_json_to({'type': 'file_ops', 'ops': ops, 'revision': revision})
+            message = await self.receive(client, 'file_ops_error')
+            self.assertIn(error, message['error'])
+            self.assertEqual(message['revision'], 1)
+        self.assertEqual(rooms.get(self.file.pk).content, 'xhello')
+        await client.disconnect()
+
+
+class BroadcastTests(RealtimeTestCase):
+    async def test_sender_is_skipped_and_the_frame_encoded_once(self):
+        clients = [await self.connect() for _ in range(3)]
+        for client in clients:
+            await self.receive(client, 'sync')
+        members = set(rooms.get(self.file.pk).members)
+        delivered = []
+        original = RoomConsumer.broadcast
+
+        async def broadcast(consumer, event):
+            delivered.append(consumer.channel_name)
+            await original(consumer, event)
+
+        encode = codecs.DEFAULT.encode
+        with mock.patch.object(RoomConsumer, 'broadcast', broadcast), \
+                mock.patch.object(codecs.DEFAULT, 'encode', wraps=encode) as encoded:
+            await clients[0].send_json_to({'type': 'file_update', 'content': 'replaced'})
+            for client in clients[1:]:
+                message = await self.receive(client, 'file_update')
+                self.assertEqual(message['content'], 'replaced')
+            self.assertTrue(await clients[0].receive_nothing(0.1))
+
+        updates = [call for call in encoded.call_args_list if call.args[0]['type'] == 'file_update']
+        self.assertEqual(len(updates), 1)
+        # The layer never handed the frame to the sender's consumer
+        self.assertEqual(len(delivered), 2)
+        self.assertEqual(len(members - set(delivered)), 1)
+        for client in clients:
+            await client.disconnect()
+
+
+@override_settings(REALTIME_CURSOR_RATE=5)
+class CursorBatchTests(RealtimeTestCase):
+    async def test_moves_within_a_window_become_one_batch(self):
+        alice, bob = await self.connect(), await self.connect()
+        connection = (await self.receive(alice, 'sync'))['connection']
+        await self.receive(bob, 'sync')
+
+        await alice.send_json_to({'type': 'presence_join', 'username': 'alice'})
+        for column in range(1, 6):
+            await alice.send_json_to({
+                'type': 'cursor_update', 'username': 'alice',
+                'position': {'lineNumber': 1, 'column': column},
+            })
+        batch = await self.receive(bob, 'cursor_batch')
+        self.assertEqual(batch['presence'], [{'connection': connection, 'action': 'join', 'username': 'alice'}])
+        self.assertEqual(batch['cursors'], [{
+            'connection': connection, 'username': 'alice', 'position': {'lineNumber': 1, 'column': 5},
+        }])
+        self.assertTrue(await bob.receive_nothing(0.4))
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+@override_settings(
+    REALTIME_FLUSH_INTERVAL=0.02, REALTIME_FLUSH_DEBOUNCE=0.1, REALTIME_FLUSH_MAX_DELAY=10,
+    VERSION_AUTOSAVE_DISTANCE=1000, VERSION_AUTOSAVE_INTERVAL=600,
+)
+class AutosaveTests(RealtimeTestCase):
+    async def stored(self):
+        return await File.objects.values_list('content', flat=True).aget(pk=self.file.pk)
+
+    async def versions(self):
+        return [
+            (version.content, version.kind)
+            async for version in Version.objects.filter(file=self.file).order_by('created_at', 'id')
+        ]
+
+    async def until_stored(self, content):
+        for _ in range(100):
+            if await self.stored() == content:
+                return
+            await asyncio.sleep(0.02)
+        self.fail(f'{content!r} was not written')
+
+    async def edit(self, client, revision, text='x'):
+        await client.send_json_to({'type': 'file_ops', 'ops': [ot.insert(0, text)], 'revision': revision})
+        await self.receive(client, 'file_ops_ack')
+
+    async def test_burst_is_written_once_after_it_goes_idle(self):
+        client = await self.connect()
+        await self.receive(client, 'sync')
+        with mock.patch.object(persistence, 'write_snapshots', wraps=persistence.write_snapshots) as write:
+            for revision in range(5):
+                await self.edit(client, revision)
+            self.assertEqual(await self.stored(), 'hello')
+            await self.until_stored('xxxxxhello')
+            await asyncio.sleep(0.15)
+        self.assertEqual(write.call_count, 1)
+        # Below the version policy's distance and interval: no version yet
+        self.assertEqual(await self.versions(), [])
+        await client.disconnect()
+
+    @override_settings(REALTIME_FLUSH_DEBOUNCE=10, REALTIME_FLUSH_MAX_DELAY=0.2)
+    async def test_continuous_edits_are_written_after_the_max_delay(self):
+        client = await self.connect()
+        await self.receive(client, 'sync')
+        for revision in range(20):
+            await self.edit(client, revision)
+            await asyncio.sleep(0.02)
+            if await self.stored() != 'hello':
+                break
+        else:
+            self.fail('Nothing was written while edits kept coming')
+        self.assertLess(revision, 19)
+        await client.disconnect()
+
+    @override_settings(VERSION_AUTOSAVE_DISTANCE=3)
+    async def test_versions_follow_the_edit_distance(self):
+        client = await self.connect()
+        await self.receive(client, 'sync')
+        await self.edit(client, 0, 'ab')
+        await self.until_stored('abhello')
+        self.assertEqual(await self.versions(), [])
+
+        await self.edit(client, 1, 'c')
+        await self.until_stored('cabhello')
+        # The version holds the document as of the previous checkpoint
+        self.assertEqual(await self.versions(), [('hello', Version.KIND_AUTO)])
+        await client.disconnect()
+
+    @override_settings(VERSION_AUTOSAVE_INTERVAL=0)
+    async def test_versions_follow_the_interval(self):
+        client = await self.connect()
+        await self.receive(client, 'sync')
+        await self.edit(client, 0)
+        await self.until_stored('xhello')
+        self.assertEqual(await self.versions(), [('hello', Version.KIND_AUTO)])
+        await client.disconnect()
+
+    async def test_save_message_persists_and_records_a_version(self):
+        client = await self.connect()
+        await self.receive(client, 'sync')
+        await self.edit(client, 0, '#')
+        await client.send_json_to({'type': 'save'})
+        saved = await self.receive(client, 'saved')
+        self.assertEqual((saved['file'], saved['revision']), (self.file.pk, 1))
+        self.assertEqual(await self.stored(), '#hello')
+        version = await Version.objects.aget(file=self.file)
+        self.assertEqual((version.content, version.description), ('hello', persistence.AUTOSAVE_DESCRIPTION))
+        await client.disconnect()
+
+    async def test_unchanged_document_gets_no_version(self):
+        client = await self.connect()
+        await self.receive(client, 'sync')
+        await self.edit(client, 0)
+        await client.send_json_to({'type': 'file_ops', 'ops': [ot.delete(0, 1)], 'revision': 1})
+        await self.receive(client, 'file_ops_ack')
+        await client.send_json_to({'type': 'save'})
+        await self.receive(client, 'saved')
+        # Nor does ending the session
+        await client.disconnect()
+        self.assertEqual(await self.versions(), [])
+        self.assertEqual(await self.stored(), 'hello')
+
+    async def test_last_editor_leaving_flushes(self):
+        client = await self.connect()
+        await self.receive(client, 'sync')
+        await self.edit(client, 0)
+        self.assertEqual(await self.stored(), 'hello')
+        await client.disconnect()
+        self.assertEqual(await self.stored(), 'xhello')
+        self.assertEqual(await self.versions(), [('hello', Version.KIND_AUTO)])
+
+
+class ProjectSocketTests(RealtimeTestCase):
+    async def connect_with_token(self, token):
+        path = f'/ws/project/{self.project.pk}/?token={token}'
+        communicator = WebsocketCommunicator(JWTAuthMiddleware(application), path)
+        connected, code = await communicator.connect()
+        return communicator, connected, code
+
+    async def test_token_authenticates_and_tree_events_arrive(self):
+        token = str(AccessToken.for_user(self.user))
+        communicator, connected, _ = await self.connect_with_token(token)
+        self.assertTrue(connected)
+        self.assertEqual((await self.receive(communicator, 'connected'))['project'], self.project.pk)
+
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = await sync_to_async(client.post)(
+            '/api/files/', {'project': self.project.pk, 'name': 'b.py', 'content': ''},
+        )
+        self.assertEqual(response.status_code, 201)
+        event = await self.receive(communicator, 'tree')
+        self.assertEqual((event['action'], event['kind'], event['data']['name']), ('created', 'file', 'b.py'))
+
+        await communicator.send_json_to({'type': 'subscribe', 'file': self.file.pk})
+        sync = await self.receive(communicator, 'sync')
+        self.assertEqual((sync['file'], sync['content']), (self.file.pk, 'hello'))
+        await communicator.disconnect()
+
+    async def test_invalid_token_is_rejected(self):
+        communicator, connected, code = await self.connect_with_token('not-a-token')
+        self.assertEqual((connected, code), (False, 4403))
+
+
+class FakeTransport:
+    """The producer side of a Twisted transport."""
+
+    def __init__(self, producer=None):
+        self.producer = producer
+        self.producerPaused = False
+
+    def registerProducer(self, producer, streaming):
+        assert self.producer is None and streaming
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class FakeProducer:
+    def __init__(self):
+        self.calls = []
+
+    def pauseProducing(self):
+        self.calls.append('pause')
+
+    def resumeProducing(self):
+        self.calls.append('resume')
+
+    def stopProducing(self):
+        self.calls.append('stop')
+
+
+class FlowControlTests(SimpleTestCase):
+    async def test_middleware_registers_with_daphne_transports(self):
+        class Protocol:
+            transport = FakeTransport(FakeProducer())
+
+        scopes = []
+
+        async def inner(scope, receive, send):
+            scopes.append(scope)
+
+        async def handle_reply(protocol, message):
+            pass
+
+        middleware = flow.FlowControlMiddleware(inner)
+        await middleware({'type': 'websocket'}, None, functools.partial(handle_reply, Protocol()))
+        await middleware({'type': 'websocket'}, None, handle_reply)
+        control = scopes[0]['flow_control']
+        self.assertNotIn('flow_control', scopes[1])
+
+        # The HTTP channel registered before keeps getting the calls
+        self.assertIs(Protocol.transport.producer, control)
+        control.pauseProducing()
+        self.assertTrue(control.paused)
+        control.resumeProducing()
+        control.stopProducing()
+        self.assertFalse(control.paused)
+        self.assertEqual(control.previous.calls, ['pause', 'resume', 'stop'])
+
+
+@override_settings(REALTIME_OUTBOX_LIMIT=5, REALTIME_OUTBOX_MAX_RESYNCS=10)
+class SlowClientTests(RealtimeTestCase):
+    async def test_frames_wait_in_the_outbox_while_the_transport_is_full(self):
+        control = flow.TransportFlow(FakeTransport())
+        alice = WebsocketCommunicator(application, f'/ws/file/{self.file.pk}/')
+        alice.scope.update(user=self.user, flow_control=control)
+        await alice.connect()
+        await self.receive(alice, 'sync')
+        bob = await self.connect()
+        await self.receive(bob, 'sync')
+
+        # Alice stops reading: Twisted pauses the producer once its buffer is full
+        control.pauseProducing()
+        for revision in range(12):
+            await bob.send_json_to({'type': 'file_ops', 'ops': [ot.insert(0, 'x')], 'revision': revision})
+        while (await self.receive(bob, 'file_ops_ack'))['revision'] < 12:
+            pass
+
+        # The frame written before the pause got through, the rest waited
+        self.assertEqual((await self.receive(alice, 'file_ops'))['revision'], 1)
+        self.assertTrue(await alice.receive_nothing(0.1))
+        stats = outbox.stats()
+        self.assertEqual(stats['paused'], 1)
+        self.assertGreater(stats['rooms'][f'file_{self.file.pk}']['resyncs'], 0)
+
+        # Once the buffer drained, the dropped ops come back as one sync
+        control.resumeProducing()
+        message = await alice.receive_json_from()
+        while message['type'] == 'file_ops':
+            message = await alice.receive_json_from()
+        self.assertEqual(message['type'], 'sync')
+        self.assertEqual((message['content'], message['revision']), ('x' * 12 + 'hello', 12))
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_overflow_keeps_the_senders_ack(self):
+        control = flow.TransportFlow(FakeTransport())
+        alice = WebsocketCommunicator(application, f'/ws/file/{self.file.pk}/')
+        alice.scope.update(user=self.user, flow_control=control)
+        await alice.connect()
+        await self.receive(alice, 'sync')
+        bob = await self.connect()
+        await self.receive(bob, 'sync')
+
+        control.pauseProducing()
+        for revision in range(2):
+            await bob.send_json_to({'type': 'file_ops', 'ops': [ot.insert(0, 'x')], 'revision': revision})
+        while (await self.receive(bob, 'file_ops_ack'))['revision'] < 2:
+            pass
+        await alice.send_json_to({'type': 'file_ops', 'ops': [ot.insert(0, 'a')], 'revision': 2})
+        await self.receive(bob, 'file_ops')
+        # Flood alice's outbox past its limit while her ack is queued
+        for revision in range(3, 13):
+            await bob.send_json_to({'type': 'file_ops', 'ops': [ot.insert(0, 'x')], 'revision': revision})
+        while (await self.receive(bob, 'file_ops_ack'))['revision'] < 13:
+            pass
+        self.assertGreater(outbox.stats()['rooms'][f'file_{self.file.pk}']['dropped'], 0)
+
+        control.resumeProducing()
+        received = []
+        while not received or received[-1]['type'] != 'sync':
+            received.append(await alice.receive_json_from())
+        self.assertIn(('file_ops_ack', 3), [(message['type'], message['revision']) for message in received])
+        self.assertEqual(received[-1]['revision'], 13)
+        await alice.disconnect()
+        await bob.disconnect()
+
+
+class CodecTests(RealtimeTestCase):
+    def test_broadcasts_are_encoded_once_per_codec_in_use(self):
+        payload = {'type': 'file_ops', 'file': 1, 'ops': [ot.insert(0, 'x')], 'revision': 1}
+        frames = codecs.encode_broadcast(payload)
+        self.assertEqual(list(frames), [codecs.DEFAULT.name])
+
+        msgpack_codec = codecs.CODECS['msgpack']
+        frame = codecs.frame_for(frames, msgpack_codec)
+        self.assertEqual(msgpack_codec.decode(frame), payload)
+        # Other receivers in the process reuse it
+        self.assertIs(codecs.frame_for(dict(frames), msgpack_codec), frame)
+        self.assertIs(codecs.frame_for(frames, codecs.DEFAULT), frames['json'])
+
+    async def test_msgpack_connections_get_binary_frames(self):
+        binary = WebsocketCommunicator(application, f'/ws/file/{self.file.pk}/', subprotocols=['msgpack'])
+        binary.scope['user'] = self.user
+        connected, subprotocol = await binary.connect()
+        self.assertEqual((connected, subprotocol), (True, 'msgpack'))
+        decode = codecs.CODECS['msgpack'].decode
+        self.assertEqual(decode(await binary.receive_from())['type'], 'sync')
+
+        text = await self.connect()
+        await self.receive(text, 'sync')
+        await text.send_json_to({'type': 'file_ops', 'ops': [ot.insert(5, '!')], 'revision': 0})
+        while (message := decode(await binary.receive_from()))['type'] != 'file_ops':
+            pass
+        self.assertEqual((message['ops'], message['revision']), ([ot.insert(5, '!')], 1))
+
+        await binary.send_to(bytes_data=codecs.CODECS['msgpack'].encode(
+            {'type': 'file_ops', 'ops': [ot.insert(0, '>')], 'revision': 1},
+        ))
+        self.assertEqual((await self.receive(text, 'file_ops'))['ops'], [ot.insert(0, '>')])
+        await binary.disconnect()
+        await text.disconnect()
+
+
+def fake_redis_hosts(test, count):
+    """Start ``count`` fakeredis servers for the duration of ``test``."""
+    hosts = []
+    for _ in range(count):
+        server = TcpFakeServer(('127.0.0.1', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        test.addCleanup(server.server_close)
+        test.addCleanup(server.shutdown)
+        hosts.append(f'redis://127.0.0.1:{server.server_address[1]}')
+    return hosts
+
+
+@unittest.skipUnless(TcpFakeServer, 'fakeredis is not installed')
+class ShardChangeTests(SimpleTestCase):
+    """Groups and leases on Redis stay reachable when a shard is added."""
+
+    def setUp(self):
+        self.hosts = fake_redis_hosts(self, 4)
+        self.old_hosts = self.hosts[:3]
+
+    def moved_names(self, prefix, count=50):
+        """Names whose shard changes when the fourth shard is added."""
+        old = RedisChannelLayer(hosts=self.old_hosts)
+        new = RedisChannelLayer(hosts=self.hosts)
+        names = [f'{prefix}{number}' for number in range(count)]
+        moved = [name for name in names if old.consistent_hash(name) != new.consistent_hash(name)]
+        self.assertTrue(moved)
+        return moved
+
+    async def test_members_joined_before_the_change_get_messages(self):
+        old = RedisChannelLayer(hosts=self.old_hosts)
+        groups = self.moved_names('file_')
+        channel = await old.new_channel()
+        for group in groups:
+            await old.group_add(group, channel)
+
+        grown = RedisChannelLayer(hosts=self.hosts, previous_hosts=self.old_hosts)
+        for group in groups:
+            await grown.group_send(group, {'type': 'broadcast', 'group': group})
+        for group in groups:
+            message = await asyncio.wait_for(old.receive(channel), timeout=2)
+            self.assertEqual(message['group'], group)
+        await old.close_pools()
+        await grown.close_pools()
+
+    async def test_migrate_groups_moves_groups_to_their_new_shard(self):
+        old = RedisChannelLayer(hosts=self.old_hosts)
+        groups = self.moved_names('file_')
+        for group in groups:
+            await old.group_add(group, 'specific.test!member')
+
+        grown = RedisChannelLayer(hosts=self.hosts, previous_hosts=self.old_hosts)
+        self.assertEqual(await grown.migrate_groups(), len(groups))
+        self.assertEqual(await grown.migrate_groups(), 0)
+        plain = RedisChannelLayer(hosts=self.hosts)
+        for group in groups:
+            connection = plain.connection(plain.consistent_hash(group))
+            members = await connection.zrange(plain._group_key(group), 0, -1)
+            self.assertEqual(members, [b'specific.test!member'])
+        for layer in (old, grown, plain):
+            await layer.close_pools()
+
+    async def test_leases_held_on_the_old_shard_are_respected(self):
+        old = RedisChannelLayer(hosts=self.old_hosts)
+        name = self.moved_names('room_')[0]
+        self.assertEqual(await old.claim_lease(name, 'first', 10), 'first')
+
+        grown = RedisChannelLayer(hosts=self.hosts, previous_hosts=self.old_hosts)
+        self.assertEqual(await grown.claim_lease(name, 'second', 10), 'first')
+        self.assertEqual(await grown.lease_holder(name), 'first')
+        self.assertFalse(await grown.renew_lease(name, 'second', 10))
+        # The holder moves it over when it renews with the new list
+        self.assertTrue(await grown.renew_lease(name, 'first', 10))
+        self.assertIsNone(await old.lease_holder(name))
+        self.assertEqual(await grown.lease_holder(name), 'first')
+        for layer in (old, grown):
+            await layer.close_pools()
+
+
+@unittest.skipUnless(TcpFakeServer, 'fakeredis is not installed')
+class HybridLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.hosts = fake_redis_hosts(self, 1)
+
+    async def until(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("Condition not met")
+
+    async def test_group_with_only_local_members_skips_redis(self):
+        node = HybridChannelLayer(hosts=self.hosts)
+        other = HybridChannelLayer(hosts=self.hosts)
+        local = await node.new_channel()
+        await node.group_add('file_1', local)
+        # A consumer waiting for messages starts the node's reader
+        receiving = asyncio.ensure_future(node.receive(local))
+        await asyncio.sleep(0)
+
+        with mock.patch.object(RedisChannelLayer, 'group_send', autospec=True) as redis_send:
+            await node.group_send('file_1', {'type': 'broadcast', 'number': 1})
+            self.assertEqual((await receiving)['number'], 1)
+            self.assertFalse(redis_send.called)
+
+        # A member on another node joins: its node tells us before anything else
+        remote = await other.new_channel()
+        await other.group_add('file_1', remote)
+        await self.until(lambda: node.remote_members['file_1'])
+        receiving = asyncio.ensure_future(node.receive(local))
+        await node.group_send('file_1', {'type': 'broadcast', 'number': 2})
+        self.assertEqual((await receiving)['number'], 2)
+        message = await asyncio.wait_for(other.receive(remote), timeout=2)
+        self.assertEqual(message['number'], 2)
+
+        # Sent through Redis unless the remote member is excluded
+        with mock.patch.object(RedisChannelLayer, 'group_send', autospec=True) as redis_send:
+            await node.group_send('file_1', {'type': 'broadcast', 'exclude': [remote]})
+            self.assertFalse(redis_send.called)
+            await node.group_send('file_1', {'type': 'broadcast'})
+            self.assertTrue(redis_send.called)
+
+        await other.group_discard('file_1', remote)
+        await self.until(lambda: not node.remote_members['file_1'])
+        await node.flush()
+        await node.close_pools()
+        await other.close_pools()
@@ -0,0 +1,6 @@
+from django.urls import path
+from .views import outbox_stats_view
+
+urlpatterns = [
+    path('stats/', outbox_stats_view, name='realtime_stats'),
+]
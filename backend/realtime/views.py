@@ -0,0 +1,12 @@
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+from rest_framework.response import Response
+
+from . import outbox
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def outbox_stats_view(request):
+    """Outbound queue depth and dropped messages per room, for this server process."""
+    return Response(outbox.stats())
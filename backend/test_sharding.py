@@ -0,0 +1,224 @@
+"""
+Test harness for the sharded channel layer.
+Run: python test_sharding.py [--shards 3] [--rooms 2000]
+
+1. Checks how file_<id> room groups spread over the shards and how many
+   move when a shard is added, compared with channels_redis' default.
+2. Starts one local Redis per shard (redis-server, or fakeredis if that is
+   not installed) and checks that every room receives its group messages,
+   before and after a shard is added, for members that joined before it.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import redis
+from channels_redis.utils import _consistent_hash
+
+from realtime.layers import RedisChannelLayer
+from realtime.sharding import HashRing
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def shard_urls(ports):
+    return [f'redis://127.0.0.1:{port}' for port in ports]
+
+
+def check_distribution(shards, rooms):
+    """Compare room placement of the hash ring with channels_redis' default."""
+    print(f"Checking distribution of {rooms} rooms over {shards} -> {shards + 1} shards...")
+    groups = [f'file_{room}' for room in range(1, rooms + 1)]
+    before = HashRing(shard_urls(range(shards)))
+    after = HashRing(shard_urls(range(shards + 1)))
+
+    placement = Counter(before.node_for(group) for group in groups)
+    mean = rooms / shards
+    spread = max(abs(count - mean) / mean for count in placement.values())
+    print(f"   Rooms per shard: {sorted(placement.values())} (max deviation {spread:.0%})")
+
+    moved = sum(before.node_for(group) != after.node_for(group) for group in groups) / rooms
+    default_moved = sum(
+        _consistent_hash(group, shards) != _consistent_hash(group, shards + 1) for group in groups
+    ) / rooms
+    print(f"   Moved when adding a shard: {moved:.0%} "
+          f"(ideal {1 / (shards + 1):.0%}, channels_redis default {default_moved:.0%})")
+
+    ok = spread < 0.3 and moved < 2 / (shards + 1)
+    print("✅ Rooms are spread evenly and few move" if ok else "❌ Unexpected distribution")
+    return ok
+
+
+async def join_all(layer, rooms):
+    """Join one channel of ``layer`` to every room's group."""
+    channels = {}
+    for room in range(1, rooms + 1):
+        channels[room] = await layer.new_channel()
+        await layer.group_add(f'file_{room}', channels[room])
+    return channels
+
+
+async def deliver(sender, receiver, channels):
+    """Send every room a message through ``sender``; count those ``receiver`` gets."""
+    for room in channels:
+        await sender.group_send(f'file_{room}', {'type': 'broadcast', 'room': room})
+
+    async def receive(room, channel):
+        try:
+            message = await asyncio.wait_for(receiver.receive(channel), timeout=5)
+        except asyncio.TimeoutError:
+            return False
+        return message['room'] == room
+
+    results = await asyncio.gather(*(receive(room, channel) for room, channel in channels.items()))
+    return sum(results)
+
+
+def group_counts(ports):
+    counts = []
+    for port in ports:
+        client = redis.Redis(port=port)
+        counts.append(sum(1 for _ in client.scan_iter(match='asgi:group:*', count=1000)))
+        client.close()
+    return counts
+
+
+def misplaced_groups(layer, ports):
+    """Count groups stored on a shard other than the one ``layer`` maps them to."""
+    misplaced = 0
+    for index, port in enumerate(ports):
+        client = redis.Redis(port=port)
+        for key in client.scan_iter(match='asgi:group:*', count=1000):
+            misplaced += layer.consistent_hash(key.decode('utf8')[len('asgi:group:'):]) != index
+        client.close()
+    return misplaced
+
+
+async def check_live(ports, rooms):
+    shards = len(ports) - 1
+    old_hosts = shard_urls(ports[:-1])
+    print(f"Checking delivery for {rooms} rooms on {shards} local Redis shards...")
+    # Channels of one process share a Redis list, so it must hold every room's message
+    layer = RedisChannelLayer(hosts=old_hosts, capacity=rooms)
+    channels = await join_all(layer, rooms)
+    delivered = await deliver(layer, layer, channels)
+    print(f"   Delivered {delivered}/{rooms}, groups per shard: {group_counts(ports[:-1])}")
+
+    print(f"Adding shard {shards + 1}, members joined before the change stay in their groups...")
+    plain = RedisChannelLayer(hosts=shard_urls(ports), capacity=rooms)
+    kept = sum(
+        layer.consistent_hash(f'file_{room}') == plain.consistent_hash(f'file_{room}')
+        for room in range(1, rooms + 1)
+    )
+    print(f"   {kept}/{rooms} rooms keep their shard")
+    lost = 0
+    for room in range(1, rooms + 1):
+        group = f'file_{room}'
+        lost += not await plain.connection(plain.consistent_hash(group)).zcard(plain._group_key(group))
+    print(f"   Without previous_hosts: {lost}/{rooms} rooms lose their members")
+
+    grown = RedisChannelLayer(hosts=shard_urls(ports), previous_hosts=old_hosts, capacity=rooms)
+    delivered_grown = await deliver(grown, layer, channels)
+    print(f"   With previous_hosts: delivered {delivered_grown}/{rooms}, "
+          f"groups per shard: {group_counts(ports)}")
+
+    # Groups nobody sent to since the change are left to migrate_groups()
+    idle = await layer.new_channel()
+    for number in range(1, 21):
+        await layer.group_add(f'idle_{number}', idle)
+    moved = await grown.migrate_groups()
+    misplaced = misplaced_groups(grown, ports)
+    delivered_migrated = await deliver(grown, layer, channels)
+    print(f"   migrate_groups() moved {moved} groups, {misplaced} left on the wrong shard, "
+          f"delivered {delivered_migrated}/{rooms}")
+    await grown.flush()
+
+    ok = delivered == delivered_grown == delivered_migrated == rooms and moved and not misplaced
+    print("✅ All rooms delivered before and after adding a shard" if ok else "❌ Messages were lost")
+    return ok
+
+
+def start_redis(ports, workdir):
+    processes = []
+    for port in ports:
+        processes.append(subprocess.Popen(
+            ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no',
+             '--dir', workdir],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        ))
+    deadline = time.monotonic() + 5
+    for port in ports:
+        while True:
+            try:
+                redis.Redis(port=port, socket_connect_timeout=0.2).ping()
+                break
+            except redis.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+    return processes
+
+
+def start_fake_redis(ports):
+    """In-process stand-ins for redis-server, one per port."""
+    from fakeredis import TcpFakeServer
+
+    servers = []
+    for port in ports:
+        server = TcpFakeServer(('127.0.0.1', port))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--rooms', type=int, default=2000)
+    args = parser.parse_args()
+
+    success = check_distribution(args.shards, args.rooms)
+    ports = [free_port() for _ in range(args.shards + 1)]
+    rooms = min(args.rooms, 500)
+
+    if shutil.which('redis-server'):
+        with tempfile.TemporaryDirectory() as workdir:
+            processes = start_redis(ports, workdir)
+            try:
+                success = asyncio.run(check_live(ports, rooms)) and success
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.wait()
+        return success
+
+    try:
+        servers = start_fake_redis(ports)
+    except ImportError:
+        print("⚠️  Neither redis-server nor fakeredis found, skipping the live delivery check")
+        return success
+    print("⚠️  redis-server not found, using fakeredis")
+    try:
+        success = asyncio.run(check_live(ports, rooms)) and success
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+    return success
+
+
+if __name__ == "__main__":
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    sys.exit(0 if main() else 1)
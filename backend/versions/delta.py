@@ -0,0 +1,68 @@
+"""
+Line-based deltas used to store version snapshots compactly.
+
+A delta is a JSON list whose items are either ``[start, end]`` (copy lines
+``start:end`` of the base text) or a string (literal text to insert). Lines
+keep their line endings, so applying a delta reproduces the target exactly.
+
+``SequenceMatcher`` can take quadratic time on large, repetitive texts, so
+``encode`` takes limits on the combined line count and on the time spent
+matching, and raises ``TooCostly`` past either; the caller then stores the
+text in full.
+"""
+import json
+import time
+from difflib import SequenceMatcher
+
+
+class TooCostly(Exception):
+    """The texts are too large, or took too long, to diff."""
+
+
+class BoundedMatcher(SequenceMatcher):
+    """``SequenceMatcher`` that gives up once ``deadline`` (monotonic) passed."""
+
+    def __init__(self, *args, deadline=None, **kwargs):
+        self.deadline = deadline
+        super().__init__(*args, **kwargs)
+
+    def find_longest_match(self, *args, **kwargs):
+        # Called once per region left to match, so the check runs throughout
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise TooCostly
+        return super().find_longest_match(*args, **kwargs)
+
+
+def encode(base, target, max_lines=None, timeout=None):
+    """Return a delta that turns ``base`` into ``target``.
+
+    Raises ``TooCostly`` if both have more than ``max_lines`` lines together,
+    or matching them takes longer than ``timeout`` seconds.
+    """
+    base_lines = base.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    if max_lines is not None and len(base_lines) + len(target_lines) > max_lines:
+        raise TooCostly
+    deadline = None if timeout is None else time.monotonic() + timeout
+    matcher = BoundedMatcher(None, base_lines, target_lines, autojunk=False, deadline=deadline)
+
+    items = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            items.append([i1, i2])
+        elif tag in ('replace', 'insert'):
+            items.append(''.join(target_lines[j1:j2]))
+    return json.dumps(items, separators=(',', ':'))
+
+
+def apply(base, delta):
+    """Rebuild the target text from ``base`` and a delta made by ``encode``."""
+    base_lines = base.splitlines(keepends=True)
+    parts = []
+    for item in json.loads(delta):
+        if isinstance(item, str):
+            parts.append(item)
+        else:
+            start, end = item
+            parts.extend(base_lines[start:end])
+    return ''.join(parts)
@@ -0,0 +1,343 @@
+"""
+Line diffs between version snapshots, computed server-side.
+
+Lines are interned to integers first, so the diff compares small ints
+instead of strings, and lines that only occur on one side are set aside
+before running Myers' O(ND) algorithm on what is left (they can never be
+part of a match). Myers gets a budget of ``VERSION_DIFF_MAX_COST`` steps;
+texts that need more (large, heavily reordered files) fall back to a
+patience diff, which anchors on lines unique to both sides and runs the
+bounded search only in the gaps between anchors. Gaps left over once the
+budget is spent are reported as replaced, so a diff can be less minimal
+than it could be but its cost stays bounded.
+
+The resulting opcodes are kept in an LRU cache keyed by the SHA-256
+digests of both texts, and rendered lazily as hunks, so large diffs can be
+streamed out hunk by hunk.
+"""
+import bisect
+import hashlib
+import threading
+from collections import Counter, OrderedDict
+
+from django.conf import settings
+
+
+def digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class TooCostly(Exception):
+    """The search ran out of its step budget."""
+
+
+class Budget:
+    """Search steps left; shared by the searches of one diff."""
+
+    def __init__(self, steps):
+        self.steps = steps
+
+
+def _myers(a, b, budget):
+    """Matching (i, j) pairs of ``a`` and ``b`` along a shortest edit path, last first."""
+    n, m = len(a), len(b)
+    v = {1: 0}
+    # trace[d] holds the furthest x of diagonals -(d-1), -(d-1)+2, ... d-1 after step d-1
+    trace = []
+    # Counted locally and written back, the search loop is hot
+    steps = budget.steps
+    for d in range(n + m + 1):
+        steps -= 2 * d + 1
+        if steps < 0:
+            budget.steps = steps
+            raise TooCostly
+        trace.append([v[k] for k in range(1 - d, d, 2)])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            start = x
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            steps -= x - start
+            v[k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    budget.steps = steps
+
+    pairs = []
+    x, y = n, m
+    for d in range(len(trace) - 1, 0, -1):
+        previous = trace[d]
+
+        def furthest(k):
+            return previous[(k + d - 1) // 2]
+
+        k = x - y
+        if k == -d or (k != d and furthest(k - 1) < furthest(k + 1)):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = furthest(prev_k)
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            pairs.append((x, y))
+        x, y = prev_x, prev_y
+    # The snake of step 0, from the start
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        pairs.append((x, y))
+    return pairs
+
+
+def _increasing_run(pairs):
+    """Longest subsequence of ``pairs`` (sorted by i) whose j also increases."""
+    tails, tail_index, previous = [], [], [None] * len(pairs)
+    for index, (i, j) in enumerate(pairs):
+        position = bisect.bisect_left(tails, j)
+        if position:
+            previous[index] = tail_index[position - 1]
+        if position == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[position] = j
+            tail_index[position] = index
+    run = []
+    index = tail_index[-1] if tail_index else None
+    while index is not None:
+        run.append(pairs[index])
+        index = previous[index]
+    return run[::-1]
+
+
+def _patience(a, b, budget):
+    """Matching pairs anchored on lines unique to both sides, searching only between anchors."""
+    count_a, count_b = Counter(a), Counter(b)
+    b_unique = {line: j for j, line in enumerate(b) if count_b[line] == 1}
+    anchors = _increasing_run([
+        (i, b_unique[line]) for i, line in enumerate(a)
+        if count_a[line] == 1 and line in b_unique
+    ])
+
+    pairs = []
+    i0 = j0 = 0
+    for i, j in [*anchors, (len(a), len(b))]:
+        try:
+            gap = _myers(a[i0:i], b[j0:j], budget)
+        except TooCostly:
+            # Out of budget: the gap counts as replaced
+            gap = []
+        pairs.extend((i0 + x, j0 + y) for x, y in gap)
+        if i < len(a):
+            pairs.append((i, j))
+        i0, j0 = i + 1, j + 1
+    return pairs
+
+
+def matching_blocks(a, b):
+    """Return ``[(i, j, size), ...]`` runs of equal lines, ending with ``(len(a), len(b), 0)``."""
+    # Intern lines so equal lines compare as equal ints
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+
+    # Common prefix and suffix need no search
+    start = 0
+    end_a, end_b = len(a_ids), len(b_ids)
+    while start < end_a and start < end_b and a_ids[start] == b_ids[start]:
+        start += 1
+    while end_a > start and end_b > start and a_ids[end_a - 1] == b_ids[end_b - 1]:
+        end_a -= 1
+        end_b -= 1
+
+    # Lines missing from the other side can't match; leave them out of the search
+    in_a, in_b = set(a_ids[start:end_a]), set(b_ids[start:end_b])
+    a_index = [i for i in range(start, end_a) if a_ids[i] in in_b]
+    b_index = [j for j in range(start, end_b) if b_ids[j] in in_a]
+    a_search = [a_ids[i] for i in a_index]
+    b_search = [b_ids[j] for j in b_index]
+    try:
+        matches = _myers(a_search, b_search, Budget(settings.VERSION_DIFF_MAX_COST))
+    except TooCostly:
+        matches = _patience(a_search, b_search, Budget(settings.VERSION_DIFF_MAX_COST))
+    pairs = sorted((a_index[x], b_index[y]) for x, y in matches)
+
+    blocks = []
+    if start:
+        blocks.append([0, 0, start])
+    for i, j in pairs:
+        if blocks and blocks[-1][0] + blocks[-1][2] == i and blocks[-1][1] + blocks[-1][2] == j:
+            blocks[-1][2] += 1
+        else:
+            blocks.append([i, j, 1])
+    suffix = len(a_ids) - end_a
+    if suffix:
+        if blocks and blocks[-1][0] + blocks[-1][2] == end_a and blocks[-1][1] + blocks[-1][2] == end_b:
+            blocks[-1][2] += suffix
+        else:
+            blocks.append([end_a, end_b, suffix])
+    blocks.append([len(a_ids), len(b_ids), 0])
+    return [tuple(block) for block in blocks]
+
+
+def opcodes(a, b):
+    """``difflib``-style ``(tag, i1, i2, j1, j2)`` opcodes turning ``a`` into ``b``."""
+    codes = []
+    i = j = 0
+    for block_i, block_j, size in matching_blocks(a, b):
+        if i < block_i and j < block_j:
+            codes.append(('replace', i, block_i, j, block_j))
+        elif i < block_i:
+            codes.append(('delete', i, block_i, j, block_j))
+        elif j < block_j:
+            codes.append(('insert', i, block_i, j, block_j))
+        i, j = block_i + size, block_j + size
+        if size:
+            codes.append(('equal', block_i, i, block_j, j))
+    return codes
+
+
+class DiffCache:
+    """Thread-safe LRU of opcodes keyed by the digests of both texts."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            codes = self.entries.get(key)
+            if codes is not None:
+                self.entries.move_to_end(key)
+            return codes
+
+    def set(self, key, codes):
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = codes
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+cache = DiffCache(settings.VERSION_DIFF_CACHE_SIZE)
+
+
+class Diff:
+    """Diff between two texts; hunks and the unified rendering are generated lazily."""
+
+    def __init__(self, old, new, old_digest=None, new_digest=None, context=3):
+        self.old_lines = old.splitlines(keepends=True)
+        self.new_lines = new.splitlines(keepends=True)
+        self.context = max(context, 0)
+
+        key = (old_digest or digest(old), new_digest or digest(new))
+        self.opcodes = cache.get(key)
+        if self.opcodes is None:
+            self.opcodes = opcodes(self.old_lines, self.new_lines)
+            cache.set(key, self.opcodes)
+
+    @property
+    def line_count(self):
+        return len(self.old_lines) + len(self.new_lines)
+
+    def stats(self):
+        added = removed = 0
+        for tag, i1, i2, j1, j2 in self.opcodes:
+            if tag != 'equal':
+                removed += i2 - i1
+                added += j2 - j1
+        return {'added': added, 'removed': removed}
+
+    def groups(self):
+        """Opcodes grouped into hunks with ``context`` equal lines around changes."""
+        codes = self.opcodes
+        if not codes:
+            return
+        n = self.context
+        # Trim the context before the first and after the last change
+        if codes[0][0] == 'equal':
+            tag, i1, i2, j1, j2 = codes[0]
+            codes = [(tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2)] + codes[1:]
+        if codes[-1][0] == 'equal':
+            tag, i1, i2, j1, j2 = codes[-1]
+            codes = codes[:-1] + [(tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n))]
+
+        group = []
+        for tag, i1, i2, j1, j2 in codes:
+            # Split unchanged runs longer than both contexts into separate hunks
+            if tag == 'equal' and i2 - i1 > 2 * n:
+                group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+                yield group
+                group = []
+                i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+            group.append((tag, i1, i2, j1, j2))
+        if group and not (len(group) == 1 and group[0][0] == 'equal'):
+            yield group
+
+    def hunks(self):
+        """Structured hunks: line ranges (1-based) and ``[op, text]`` lines."""
+        for group in self.groups():
+            first, last = group[0], group[-1]
+            lines = []
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    lines.extend([' ', line.rstrip('\r\n')] for line in self.old_lines[i1:i2])
+                    continue
+                lines.extend(['-', line.rstrip('\r\n')] for line in self.old_lines[i1:i2])
+                lines.extend(['+', line.rstrip('\r\n')] for line in self.new_lines[j1:j2])
+            yield {
+                'old_start': first[1] + 1, 'old_lines': last[2] - first[1],
+                'new_start': first[3] + 1, 'new_lines': last[4] - first[3],
+                'lines': lines,
+            }
+
+    def unified(self, fromfile='', tofile=''):
+        """Unified diff text, one line at a time."""
+        started = False
+        for group in self.groups():
+            if not started:
+                yield f'--- {fromfile}\n'
+                yield f'+++ {tofile}\n'
+                started = True
+            first, last = group[0], group[-1]
+            yield '@@ -{} +{} @@\n'.format(
+                _range(first[1], last[2]), _range(first[3], last[4])
+            )
+            for tag, i1, i2, j1, j2 in group:
+                if tag == 'equal':
+                    for line in self.old_lines[i1:i2]:
+                        yield _line(' ', line)
+                    continue
+                for line in self.old_lines[i1:i2]:
+                    yield _line('-', line)
+                for line in self.new_lines[j1:j2]:
+                    yield _line('+', line)
+
+
+def _range(start, stop):
+    """Hunk range in unified format, e.g. ``3,4`` (1-based start, line count)."""
+    length = stop - start
+    if length == 1:
+        return str(start + 1)
+    if not length:
+        start -= 1  # Empty ranges point at the line before
+    return f'{start + 1},{length}'
+
+
+def _line(prefix, line):
+    if line.endswith('\n'):
+        return prefix + line
+    return f'{prefix}{line}\n\\ No newline at end of file\n'
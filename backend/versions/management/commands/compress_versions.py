@@ -0,0 +1,75 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from versions.models import Version
+
+
+class Command(BaseCommand):
+    """Convert stored version snapshots between full and delta storage."""
+    help = 'Re-encode existing versions as keyframes plus deltas (or expand them back to full content).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keyframe-interval', type=int, default=settings.VERSION_KEYFRAME_INTERVAL,
+            help='Store a full keyframe every N versions of a file.',
+        )
+        parser.add_argument(
+            '--expand', action='store_true',
+            help='Store every version in full again instead of compressing.',
+        )
+        parser.add_argument('--file', type=int, help='Only convert versions of this file id.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report the size change without writing anything.',
+        )
+
+    def handle(self, *args, **options):
+        interval = max(options['keyframe_interval'], 1)
+        file_ids = Version.objects.values_list('file_id', flat=True).distinct().order_by('file_id')
+        if options['file']:
+            file_ids = file_ids.filter(file_id=options['file'])
+
+        before_total = after_total = 0
+        for file_id in file_ids.iterator():
+            before, after = self.convert_file(file_id, interval, options['expand'], options['dry_run'])
+            before_total += before
+            after_total += after
+
+        verb = 'Would store' if options['dry_run'] else 'Stored'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {after_total} characters of version data (was {before_total}).'
+        ))
+
+    def convert_file(self, file_id, interval, expand, dry_run):
+        """Lay out one file's versions and return (size before, size after)."""
+        with transaction.atomic():
+            versions = list(
+                Version.objects.filter(file_id=file_id)
+                .select_for_update()
+                .prefetch_related('keyframe')
+                .order_by('created_at', 'id')
+            )
+            before = sum(len(version.data) for version in versions)
+
+            # Materialize every snapshot before any keyframe is rewritten
+            contents = [version.content for version in versions]
+
+            keyframe = None
+            since_keyframe = 0
+            for version, content in zip(versions, contents):
+                version.content = content
+                if expand:
+                    continue
+                if keyframe is not None and since_keyframe < interval - 1:
+                    version.compress_against(keyframe)
+                if version.storage == Version.STORAGE_FULL:
+                    keyframe = version
+                    since_keyframe = 0
+                else:
+                    since_keyframe += 1
+
+            after = sum(len(version.data) for version in versions)
+            if not dry_run:
+                Version.objects.bulk_update(versions, ['data', 'storage', 'keyframe'])
+        return before, after
@@ -0,0 +1,43 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from versions import retention
+
+
+class Command(BaseCommand):
+    """Thin out automatic version snapshots according to the retention policy."""
+    help = ('Delete automatic snapshots past the retention policy: all are kept for '
+            'VERSION_RETENTION_KEEP_ALL_HOURS, then one per hour, then one per day. '
+            'Manual snapshots are always kept.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', type=int, help='Only prune versions of this file id.')
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.VERSION_RETENTION_BATCH_SIZE,
+            help='Delete at most N versions per transaction.',
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Report what would be deleted without deleting anything.',
+        )
+        parser.add_argument(
+            '--loop', action='store_true',
+            help='Keep running, pruning every VERSION_RETENTION_INTERVAL seconds.',
+        )
+
+    def handle(self, *args, **options):
+        file_ids = [options['file']] if options['file'] else None
+        while True:
+            result = retention.prune(
+                file_ids, batch_size=options['batch_size'], dry_run=options['dry_run'],
+            )
+            verb = 'Would delete' if options['dry_run'] else 'Deleted'
+            self.stdout.write(self.style.SUCCESS(
+                f'{verb} {result.deleted} versions, reclaiming {result.reclaimed} characters '
+                f'of version data ({result.content_bytes} bytes of snapshot content).'
+            ))
+            if not options['loop']:
+                break
+            time.sleep(settings.VERSION_RETENTION_INTERVAL)
@@ -0,0 +1,37 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('versions', '0001_initial'),
+    ]
+
+    operations = [
+        # The column keeps its name; only the model attribute changes
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name='version',
+                    old_name='content',
+                    new_name='data',
+                ),
+                migrations.AlterField(
+                    model_name='version',
+                    name='data',
+                    field=models.TextField(db_column='content'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='version',
+            name='storage',
+            field=models.CharField(choices=[('full', 'Full content'), ('delta', 'Delta against keyframe')], default='full', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='version',
+            name='keyframe',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.RESTRICT, related_name='deltas', to='versions.version'),
+        ),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:45
+
+import json
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+# Delta format and metadata as of this migration (see versions.delta and
+# files.models.content_metadata for the live copies)
+def apply_delta(base, delta):
+    base_lines = base.splitlines(keepends=True)
+    parts = []
+    for item in json.loads(delta):
+        if isinstance(item, str):
+            parts.append(item)
+        else:
+            start, end = item
+            parts.extend(base_lines[start:end])
+    return ''.join(parts)
+
+
+def content_metadata(content):
+    return {'size': len(content.encode('utf-8')), 'line_count': len(content.splitlines())}
+
+
+def backfill_metadata(apps, schema_editor):
+    """Fill in size, line count and line delta of existing versions, file by file."""
+    Version = apps.get_model('versions', 'Version')
+    file_ids = Version.objects.values_list('file_id', flat=True).distinct().order_by('file_id')
+    for file_id in file_ids.iterator():
+        versions = list(Version.objects.filter(file_id=file_id).order_by('created_at', 'id'))
+        keyframes = {version.pk: version.data for version in versions if version.storage == 'full'}
+        previous_lines = None
+        for version in versions:
+            content = version.data
+            if version.storage == 'delta':
+                content = apply_delta(keyframes[version.keyframe_id], version.data)
+            metadata = content_metadata(content)
+            version.size = metadata['size']
+            version.line_count = metadata['line_count']
+            version.line_delta = 0 if previous_lines is None else version.line_count - previous_lines
+            previous_lines = version.line_count
+        Version.objects.bulk_update(versions, ['size', 'line_count', 'line_delta'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0005_file_search_index'),
+        ('versions', '0002_version_delta_storage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='version',
+            name='line_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='version',
+            name='line_delta',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='version',
+            name='size',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='version',
+            index=models.Index(fields=['file', '-created_at', '-id'], name='version_file_created_idx'),
+        ),
+        migrations.RunPython(backfill_metadata, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-18 16:50
+
+from django.db import migrations, models
+from django.db.models import Q
+
+# Descriptions used so far by the automatic snapshot call sites
+AUTO_DESCRIPTIONS = ['Auto-snapshot before save', 'Auto-snapshot before live edits']
+AUTO_PREFIX = 'Auto-save before revert'
+
+
+def mark_automatic(apps, schema_editor):
+    Version = apps.get_model('versions', 'Version')
+    Version.objects.filter(
+        Q(description__in=AUTO_DESCRIPTIONS) | Q(description__startswith=AUTO_PREFIX)
+    ).update(kind='auto')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('versions', '0003_version_metadata_and_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='version',
+            name='kind',
+            field=models.CharField(choices=[('manual', 'Manual snapshot'), ('auto', 'Automatic snapshot')], default='manual', max_length=10),
+        ),
+        migrations.RunPython(mark_automatic, migrations.RunPython.noop),
+    ]
@@ -1,16 +1,160 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
-from files.models import File
+from files.models import File, content_metadata
+from . import delta
+
+
+class VersionManager(models.Manager):
+    """Manager that decides how each new snapshot is stored."""
+
+    def create_snapshot(self, file, content, **kwargs):
+        """Create a snapshot of ``content`` for ``file``.
+
+        With ``VERSION_STORAGE = 'delta'`` the snapshot is stored as a diff
+        against the file's latest keyframe, and a new full keyframe is written
+        every ``VERSION_KEYFRAME_INTERVAL`` versions or whenever the diff
+        would not be smaller than the content itself.
+        """
+        version = self.model(file=file, content=content, **kwargs)
+
+        if settings.VERSION_STORAGE == Version.STORAGE_DELTA:
+            keyframe = (
+                self.filter(file=file, storage=Version.STORAGE_FULL)
+                .order_by('-created_at', '-id')
+                .first()
+            )
+            if keyframe and keyframe.deltas.count() < settings.VERSION_KEYFRAME_INTERVAL - 1:
+                version.compress_against(keyframe)
+
+        version.save(force_insert=True)
+        return version
+
 
 class Version(models.Model):
+    STORAGE_FULL = 'full'
+    STORAGE_DELTA = 'delta'
+    STORAGE_CHOICES = [
+        (STORAGE_FULL, 'Full content'),
+        (STORAGE_DELTA, 'Delta against keyframe'),
+    ]
+    KIND_MANUAL = 'manual'
+    KIND_AUTO = 'auto'
+    KIND_CHOICES = [
+        (KIND_MANUAL, 'Manual snapshot'),
+        (KIND_AUTO, 'Automatic snapshot'),
+    ]
+
     file = models.ForeignKey(File, on_delete=models.CASCADE, related_name='versions')
-    content = models.TextField()
+    # Full content for keyframes, an encoded delta for delta versions.
+    # Read and write ``content`` instead, which handles both transparently.
+    data = models.TextField(db_column='content')
+    storage = models.CharField(max_length=10, choices=STORAGE_CHOICES, default=STORAGE_FULL)
+    keyframe = models.ForeignKey('self', on_delete=models.RESTRICT, null=True, blank=True,
+                                 related_name='deltas')
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     description = models.CharField(max_length=255, blank=True)
+    # Automatic snapshots are thinned out by the retention policy, manual ones are kept
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=KIND_MANUAL)
+
+    # Metadata of the snapshot content, so history listings never load it
+    size = models.PositiveIntegerField(default=0)  # bytes, UTF-8
+    line_count = models.PositiveIntegerField(default=0)
+    # Change in line count from the file's previous version
+    line_delta = models.IntegerField(default=0)
+
+    objects = VersionManager()
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # History of a file, newest first (listing and keyset pagination)
+            models.Index(fields=['file', '-created_at', '-id'], name='version_file_created_idx'),
+        ]
 
     def __str__(self):
         return f"{self.file.name} - {self.created_at}"
+
+    @property
+    def content(self):
+        """Full snapshot content, reconstructed from the keyframe if needed."""
+        if not hasattr(self, '_content'):
+            if self.storage == self.STORAGE_DELTA:
+                self._content = delta.apply(self.keyframe.content, self.data)
+            else:
+                self._content = self.data
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self.data = value
+        self.storage = self.STORAGE_FULL
+        self.keyframe = None
+        self._metadata_stale = True
+
+    def save(self, *args, **kwargs):
+        if getattr(self, '_metadata_stale', False):
+            metadata = content_metadata(self._content)
+            self.size, self.line_count = metadata['size'], metadata['line_count']
+            if self._state.adding:
+                previous = (
+                    Version.objects.filter(file_id=self.file_id)
+                    .order_by('-created_at', '-id')
+                    .values_list('line_count', flat=True)
+                    .first()
+                )
+                self.line_delta = 0 if previous is None else self.line_count - previous
+            self._metadata_stale = False
+        return super().save(*args, **kwargs)
+
+    def compress_against(self, keyframe):
+        """Store this version as a delta against ``keyframe`` if that is smaller.
+
+        Texts too large or too slow to diff are stored in full, which makes
+        this version a keyframe.
+        """
+        content = self.content
+        try:
+            encoded = delta.encode(
+                keyframe.content, content,
+                max_lines=settings.VERSION_DELTA_MAX_LINES, timeout=settings.VERSION_DELTA_TIMEOUT,
+            )
+        except delta.TooCostly:
+            encoded = content
+        if len(encoded) < len(content):
+            self.data = encoded
+            self.storage = self.STORAGE_DELTA
+            self.keyframe = keyframe
+        else:
+            self.content = content
+
+    def delete(self, *args, **kwargs):
+        """Promote dependent deltas before deleting a keyframe."""
+        if self.storage == self.STORAGE_FULL:
+            rebase_deltas(self)
+        return super().delete(*args, **kwargs)
+
+
+def rebase_deltas(keyframe):
+    """Detach the deltas that depend on ``keyframe``.
+
+    The oldest delta becomes the new keyframe and the remaining ones are
+    re-encoded against it, so ``keyframe`` can be deleted safely.
+    """
+    dependents = list(keyframe.deltas.order_by('created_at', 'id'))
+    if not dependents:
+        return
+
+    for version in dependents:
+        # Reuse the loaded keyframe instead of fetching it once per delta
+        version.keyframe = keyframe
+
+    new_keyframe = dependents[0]
+    new_keyframe.content = new_keyframe.content
+    for version in dependents[1:]:
+        version.compress_against(new_keyframe)
+
+    new_keyframe.save(update_fields=['data', 'storage', 'keyframe'])
+    Version.objects.bulk_update(dependents[1:], ['data', 'storage', 'keyframe'])
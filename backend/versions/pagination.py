@@ -0,0 +1,13 @@
+from config.pagination import KeysetPagination
+
+
+class VersionCursorPagination(KeysetPagination):
+    """
+    Keyset pagination over version history, newest first (-created_at, -id).
+
+    Pages are served by the (file, -created_at, -id) index, so a file with
+    thousands of snapshots is listed one page at a time at constant cost.
+    """
+    page_size = 50
+    max_page_size = 200
+    ordering = ('-created_at', '-id')
@@ -0,0 +1,141 @@
+"""
+Retention policy for automatic version snapshots.
+
+Every automatic snapshot is kept for ``VERSION_RETENTION_KEEP_ALL_HOURS``.
+After that only the newest one per hour survives, and past
+``VERSION_RETENTION_HOURLY_DAYS`` only the newest one per day. Manual
+snapshots (``Version.KIND_MANUAL``) are never pruned.
+
+Pruning decides from version metadata only and deletes in transactions of
+at most ``VERSION_RETENTION_BATCH_SIZE`` rows. Deltas are deleted before
+their keyframes, and a keyframe that still has surviving deltas hands them
+over with ``rebase_deltas`` before it goes.
+"""
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import Length
+from django.utils import timezone
+
+from .models import Version, rebase_deltas
+
+
+@dataclass
+class Result:
+    deleted: int = 0
+    # Characters of stored version data freed, after deltas were rebased
+    reclaimed: int = 0
+    # Bytes of snapshot content the deleted versions represented
+    content_bytes: int = 0
+
+    def __iadd__(self, other):
+        self.deleted += other.deleted
+        self.reclaimed += other.reclaimed
+        self.content_bytes += other.content_bytes
+        return self
+
+
+def bucket(created_at, now):
+    """Retention bucket of a snapshot, or None while every snapshot is kept."""
+    age = now - created_at
+    if age <= timedelta(hours=settings.VERSION_RETENTION_KEEP_ALL_HOURS):
+        return None
+    if age <= timedelta(days=settings.VERSION_RETENTION_HOURLY_DAYS):
+        return 'hour', created_at.replace(minute=0, second=0, microsecond=0)
+    return 'day', created_at.date()
+
+
+def expired(file_id, now):
+    """Return the rows of ``file_id`` the policy drops, newest first."""
+    rows = (
+        Version.objects.filter(file_id=file_id)
+        .order_by('-created_at', '-id')
+        .values('id', 'created_at', 'kind', 'storage', 'size')
+    )
+    seen = set()
+    dropped = []
+    for row in rows.iterator():
+        if row['kind'] != Version.KIND_AUTO:
+            continue
+        key = bucket(row['created_at'], now)
+        if key is None:
+            continue
+        if key in seen:
+            dropped.append(row)
+        else:
+            # The newest snapshot of each bucket stands for it
+            seen.add(key)
+    return dropped
+
+
+def stored_size(file_id):
+    return Version.objects.filter(file_id=file_id).aggregate(total=Sum(Length('data')))['total'] or 0
+
+
+def prune_file(file_id, now=None, batch_size=None, dry_run=False):
+    """Apply the retention policy to the versions of one file."""
+    now = now or timezone.now()
+    batch_size = max(batch_size or settings.VERSION_RETENTION_BATCH_SIZE, 1)
+    dropped = expired(file_id, now)
+    if not dropped:
+        return Result()
+
+    content_bytes = sum(row['size'] for row in dropped)
+    if dry_run:
+        reclaimed = (
+            Version.objects.filter(pk__in=[row['id'] for row in dropped])
+            .aggregate(total=Sum(Length('data')))['total'] or 0
+        )
+        return Result(len(dropped), reclaimed, content_bytes)
+
+    before = stored_size(file_id)
+    # Deltas first, so a keyframe only has surviving deltas left to rebase
+    deltas = [row['id'] for row in dropped if row['storage'] == Version.STORAGE_DELTA]
+    keyframes = [row['id'] for row in dropped if row['storage'] == Version.STORAGE_FULL]
+    for start in range(0, len(deltas), batch_size):
+        with transaction.atomic():
+            Version.objects.filter(pk__in=deltas[start:start + batch_size]).delete()
+    for start in range(0, len(keyframes), batch_size):
+        with transaction.atomic():
+            batch = Version.objects.filter(pk__in=keyframes[start:start + batch_size])
+            for keyframe in batch.select_for_update():
+                rebase_deltas(keyframe)
+            batch.delete()
+
+    update_line_deltas(file_id)
+    return Result(len(dropped), before - stored_size(file_id), content_bytes)
+
+
+def update_line_deltas(file_id):
+    """Recompute line deltas against each surviving version's new predecessor."""
+    versions = list(
+        Version.objects.filter(file_id=file_id)
+        .order_by('created_at', 'id')
+        .only('id', 'line_count', 'line_delta')
+    )
+    changed = []
+    previous = None
+    for version in versions:
+        line_delta = 0 if previous is None else version.line_count - previous
+        if version.line_delta != line_delta:
+            version.line_delta = line_delta
+            changed.append(version)
+        previous = version.line_count
+    Version.objects.bulk_update(changed, ['line_delta'], batch_size=500)
+
+
+def prune(file_ids=None, now=None, batch_size=None, dry_run=False):
+    """Apply the retention policy to every file with automatic snapshots."""
+    now = now or timezone.now()
+    if file_ids is None:
+        file_ids = list(
+            Version.objects.filter(kind=Version.KIND_AUTO)
+            .values_list('file_id', flat=True).distinct().order_by('file_id')
+        )
+    total = Result()
+    for file_id in file_ids:
+        total += prune_file(file_id, now, batch_size, dry_run)
+    return total
@@ -1,10 +1,30 @@
 from rest_framework import serializers
-from .models import Version
+from .models import Version, rebase_deltas
 
 class VersionSerializer(serializers.ModelSerializer):
     created_by_username = serializers.CharField(source='created_by.username', read_only=True)
+    # Reconstructed from the keyframe when the version is stored as a delta
+    content = serializers.CharField(allow_blank=True, trim_whitespace=False)
 
     class Meta:
         model = Version
-        fields = ['id', 'file', 'content', 'created_by', 'created_by_username', 'created_at', 'description']
-        read_only_fields = ['created_at', 'created_by']
+        fields = ['id', 'file', 'content', 'created_by', 'created_by_username', 'created_at', 'description',
+                  'kind', 'size', 'line_count', 'line_delta']
+        read_only_fields = ['created_at', 'created_by', 'kind', 'size', 'line_count', 'line_delta']
+
+    def update(self, instance, validated_data):
+        """Detach dependent deltas before a keyframe's content is replaced."""
+        if 'content' in validated_data and instance.storage == Version.STORAGE_FULL:
+            rebase_deltas(instance)
+        return super().update(instance, validated_data)
+
+
+class VersionListSerializer(serializers.ModelSerializer):
+    """History entry without the snapshot content."""
+    created_by_username = serializers.CharField(source='created_by.username', read_only=True)
+
+    class Meta:
+        model = Version
+        fields = ['id', 'file', 'created_by', 'created_by_username', 'created_at', 'description',
+                  'kind', 'size', 'line_count', 'line_delta']
+        read_only_fields = fields
@@ -1,3 +1,271 @@
-from django.test import TestCase
+import difflib
+import random
+import time
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from files.models import File
+from projects.models import Project
+from . import delta, diff, retention
+from .models import Version
+
+MEMORY_LAYER = {'default': {'BACKEND': 'realtime.layers.InMemoryChannelLayer'}}
+
+
+def lines(*items):
+    return [f'{item}\n' for item in items]
+
+
+def apply_opcodes(a, b, codes):
+    """Rebuild ``b`` from ``a`` and opcodes, checking that equal runs really match."""
+    out = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal':
+            assert a[i1:i2] == b[j1:j2]
+            out += a[i1:i2]
+        else:
+            out += b[j1:j2]
+    return out
+
+
+class DiffTests(TestCase):
+    def test_opcodes_rebuild_target(self):
+        a = lines('a', 'b', 'c', 'd', 'e', 'b', 'c')
+        b = lines('b', 'x', 'c', 'd', 'a', 'c', 'e')
+        self.assertEqual(apply_opcodes(a, b, diff.opcodes(a, b)), b)
+
+    def test_finds_a_longest_common_subsequence(self):
+        a = lines('a', 'b', 'c', 'a', 'b', 'b', 'a')
+        b = lines('c', 'b', 'a', 'b', 'a', 'c')
+        matched = sum(size for _, _, size in diff.matching_blocks(a, b))
+        reference = sum(block.size for block in difflib.SequenceMatcher(None, a, b, autojunk=False).get_matching_blocks())
+        self.assertGreaterEqual(matched, reference)
+
+    def test_unified_matches_difflib(self):
+        a = ''.join(f'line {i}\n' for i in range(20))
+        b = a.replace('line 5\n', 'line five\n').replace('line 15\n', '')
+        ours = ''.join(diff.Diff(a, b).unified('old', 'new'))
+        expected = ''.join(difflib.unified_diff(a.splitlines(True), b.splitlines(True), 'old', 'new'))
+        self.assertEqual(ours, expected)
+
+    def test_missing_final_newline_is_marked(self):
+        text = ''.join(diff.Diff('a\n', 'a\nb').unified())
+        self.assertTrue(text.endswith('+b\n\\ No newline at end of file\n'))
+
+    def test_hunks_and_stats(self):
+        result = diff.Diff('a\nb\nc\n', 'a\nB\nc\nd\n', context=1)
+        self.assertEqual(result.stats(), {'added': 2, 'removed': 1})
+        self.assertEqual(list(result.hunks()), [{
+            'old_start': 1, 'old_lines': 3, 'new_start': 1, 'new_lines': 4,
+            'lines': [[' ', 'a'], ['-', 'b'], ['+', 'B'], [' ', 'c'], ['+', 'd']],
+        }])
+
+    def test_identical_texts_have_no_hunks(self):
+        self.assertEqual(list(diff.Diff('same\n', 'same\n').hunks()), [])
+
+    @override_settings(VERSION_DIFF_MAX_COST=200)
+    def test_falls_back_when_over_budget(self):
+        a = lines(*range(300))
+        b = lines('new', *range(100, 300), *range(100))
+        codes = diff.opcodes(a, b)
+        self.assertEqual(apply_opcodes(a, b, codes), b)
+        # The patience anchors still find the moved block
+        self.assertGreaterEqual(sum(i2 - i1 for tag, i1, i2, _, _ in codes if tag == 'equal'), 200)
+
+    def test_reordered_file_is_bounded(self):
+        a = lines(*range(4000))
+        b = a[::-1]
+        started = time.perf_counter()
+        codes = diff.opcodes(a, b)
+        self.assertLess(time.perf_counter() - started, 5)
+        self.assertEqual(apply_opcodes(a, b, codes), b)
+
+    def test_cache_is_keyed_by_digests(self):
+        cache = diff.DiffCache(2)
+        cache.set(('a', 'b'), [1])
+        cache.set(('c', 'd'), [2])
+        cache.get(('a', 'b'))
+        cache.set(('e', 'f'), [3])
+        self.assertIsNone(cache.get(('c', 'd')))
+        self.assertEqual(cache.get(('a', 'b')), [1])
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER)
+class DiffEndpointTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.client.force_authenticate(self.user)
+        project = Project.objects.create(name='p', owner=self.user)
+        self.file = File.objects.create(project=project, name='a.py', content='a\nb\nc\n', created_by=self.user)
+        self.version = Version.objects.create_snapshot(file=self.file, content='a\nb\nc\n', created_by=self.user)
+        self.file.content = 'a\nB\nc\n'
+        self.file.save()
+
+    def test_structured_against_current(self):
+        response = self.client.get(f'/api/versions/{self.version.pk}/diff/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['against'], 'current')
+        self.assertEqual((response.data['added'], response.data['removed']), (1, 1))
+        self.assertEqual(response.data['hunks'][0]['lines'][1], ['-', 'b'])
+
+    def test_unified_against_version(self):
+        other = Version.objects.create_snapshot(file=self.file, content='a\nB\nc\n', created_by=self.user)
+        response = self.client.get(f'/api/versions/{self.version.pk}/diff/?against={other.pk}&style=unified')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'-b\n+B\n', response.content)
+
+    @override_settings(VERSION_DIFF_STREAM_LINES=2)
+    def test_large_diffs_stream(self):
+        response = self.client.get(f'/api/versions/{self.version.pk}/diff/')
+        self.assertTrue(response.streaming)
+        self.assertIn(b'"hunks": [', b''.join(response.streaming_content))
+
+    def test_invalid_parameters(self):
+        url = f'/api/versions/{self.version.pk}/diff/'
+        self.assertEqual(self.client.get(url + '?against=999').status_code, 404)
+        self.assertEqual(self.client.get(url + '?against=abc').status_code, 404)
+        self.assertEqual(self.client.get(url + '?style=html').status_code, 400)
+        self.assertEqual(self.client.get(url + '?context=x').status_code, 400)
+
+    def test_other_users_versions_are_not_found(self):
+        bob = User.objects.create_user('bob', password='pw12345678')
+        self.client.force_authenticate(bob)
+        url = f'/api/versions/{self.version.pk}/'
+        for path in (url, url + 'diff/', url + 'diff/?against=current'):
+            with self.subTest(path=path):
+                self.assertEqual(self.client.get(path).status_code, 404)
+        self.assertEqual(self.client.post(url + 'revert/').status_code, 404)
+        self.assertEqual(self.client.get(f'/api/versions/?file_id={self.file.pk}').data, [])
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER)
+class VersionListTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        self.client.force_authenticate(self.user)
+        project = Project.objects.create(name='p', owner=self.user)
+        self.file = File.objects.create(project=project, name='a.py', content='', created_by=self.user)
+        self.versions = [
+            Version.objects.create_snapshot(file=self.file, content=f'v{number}\n', created_by=self.user)
+            for number in range(5)
+        ]
+        # Two snapshots in the same instant are told apart by id
+        Version.objects.filter(pk__in=[v.pk for v in self.versions[1:3]]).update(
+            created_at=self.versions[1].created_at,
+        )
+
+    def list(self, **params):
+        return self.client.get('/api/versions/', {'file_id': self.file.pk, **params})
+
+    def test_plain_list_without_pagination_parameters(self):
+        response = self.list()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([v['id'] for v in response.data], [v.pk for v in reversed(self.versions)])
+
+    def test_pages_follow_each_other_newest_first(self):
+        ids, response = [], self.list(page_size=2)
+        while True:
+            ids += [v['id'] for v in response.data['results']]
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(ids, [v.pk for v in reversed(self.versions)])
+
+    def test_invalid_cursor(self):
+        for cursor in ['nope', 'WzEsMl0=', 'WyJ4IiwgMV0=']:
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.list(cursor=cursor).status_code, 404)
+
+
+class DeltaTests(SimpleTestCase):
+    def test_round_trips(self):
+        rng = random.Random(7)
+        words = ['a\n', 'b\n', 'ü\n', 'c\r\n', '\n', 'tail', 'x y\n']
+        for _ in range(300):
+            base = ''.join(rng.choices(words, k=rng.randint(0, 12)))
+            target = ''.join(rng.choices(words, k=rng.randint(0, 12)))
+            self.assertEqual(delta.apply(base, delta.encode(base, target)), target)
+
+    def test_limits(self):
+        base, target = 'a\nb\nc\n', 'a\nB\nc\n'
+        self.assertEqual(delta.apply(base, delta.encode(base, target, max_lines=6, timeout=5)), target)
+        with self.assertRaises(delta.TooCostly):
+            delta.encode(base, target, max_lines=5)
+        with self.assertRaises(delta.TooCostly):
+            delta.encode(base, target, timeout=-1)
+
+
+def revisions(count):
+    """Contents that each change one line of the previous one and add another."""
+    text = [f'line {number}\n' for number in range(20)]
+    contents = []
+    for number in range(count):
+        text[number % len(text)] = f'changed {number}\n'
+        text.append(f'added {number}\n')
+        contents.append(''.join(text))
+    return contents
+
+
+@override_settings(CHANNEL_LAYERS=MEMORY_LAYER, VERSION_STORAGE='delta', VERSION_KEYFRAME_INTERVAL=3)
+class SnapshotStorageTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='pw12345678')
+        project = Project.objects.create(name='p', owner=self.user)
+        self.file = File.objects.create(project=project, name='a.py', content='', created_by=self.user)
+
+    def snapshot(self, content, **kwargs):
+        return Version.objects.create_snapshot(file=self.file, content=content, created_by=self.user, **kwargs)
+
+    def assertContents(self, versions, contents):
+        for version, content in zip(versions, contents):
+            self.assertEqual(Version.objects.get(pk=version.pk).content, content)
+
+    def test_deltas_between_keyframes(self):
+        contents = revisions(7)
+        versions = [self.snapshot(content) for content in contents]
+        self.assertEqual(
+            [version.storage for version in versions],
+            ['full', 'delta', 'delta', 'full', 'delta', 'delta', 'full'],
+        )
+        self.assertEqual(versions[2].keyframe_id, versions[0].pk)
+        self.assertLess(len(versions[1].data), len(contents[1]))
+        self.assertContents(versions, contents)
+
+    @override_settings(VERSION_DELTA_MAX_LINES=60)
+    def test_large_snapshots_become_keyframes(self):
+        contents = revisions(2)
+        contents.append(contents[-1] * 3)
+        versions = [self.snapshot(content) for content in contents]
+        self.assertEqual([version.storage for version in versions], ['full', 'delta', 'full'])
+        self.assertContents(versions, contents)
+
+    def test_deleting_a_keyframe_rebases_its_deltas(self):
+        contents = revisions(3)
+        versions = [self.snapshot(content) for content in contents]
+        versions[0].delete()
+        rebased = Version.objects.get(pk=versions[1].pk)
+        self.assertEqual((rebased.storage, rebased.keyframe_id), ('full', None))
+        self.assertEqual(Version.objects.get(pk=versions[2].pk).keyframe_id, rebased.pk)
+        self.assertContents(versions[1:], contents[1:])
+
+    def test_retention_keeps_one_auto_snapshot_per_day(self):
+        contents = revisions(5)
+        kinds = [Version.KIND_AUTO, Version.KIND_AUTO, Version.KIND_MANUAL, Version.KIND_AUTO, Version.KIND_AUTO]
+        versions = [self.snapshot(content, kind=kind) for content, kind in zip(contents, kinds)]
+        now = timezone.now()
+        day = (now - timedelta(days=30)).replace(hour=0)
+        for hour, version in enumerate(versions[:4], start=1):
+            Version.objects.filter(pk=version.pk).update(created_at=day + timedelta(hours=hour))
+
+        result = retention.prune_file(self.file.pk, now=now)
+        self.assertEqual(result.deleted, 2)
+        survivors = list(Version.objects.filter(file=self.file).order_by('created_at', 'id'))
+        self.assertEqual([v.pk for v in survivors], [v.pk for v in versions[2:]])
+        # The manual snapshot was a delta of the pruned keyframe
+        self.assertEqual(survivors[0].storage, 'full')
+        self.assertContents(survivors, contents[2:])
+        self.assertEqual([v.line_delta for v in survivors], [0, 1, 1])
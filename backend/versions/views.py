@@ -1,17 +1,41 @@
+import json
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
+from .diff import Diff, digest
 from .models import Version
-from .serializers import VersionSerializer
+from .pagination import VersionCursorPagination
+from .serializers import VersionListSerializer, VersionSerializer
 from files.models import File
+from realtime import events
 
 class VersionViewSet(viewsets.ModelViewSet):
     serializer_class = VersionSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = VersionCursorPagination
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return VersionListSerializer
+        return VersionSerializer
 
     def get_queryset(self):
+        # Only versions of files in the user's projects, as for files themselves
+        queryset = (
+            Version.objects.filter(file__project__owner=self.request.user)
+            .select_related('created_by').order_by('-created_at', '-id')
+        )
+        if self.action == 'list':
+            # The listing only shows metadata, content is fetched per version
+            queryset = queryset.defer('data')
+        else:
+            # Keyframes are prefetched so each one is loaded once per page of deltas
+            queryset = queryset.prefetch_related('keyframe')
         # Filter versions by file if 'file_id' is provided in query params
-        queryset = Version.objects.all()
         file_id = self.request.query_params.get('file_id')
         if file_id:
             queryset = queryset.filter(file_id=file_id)
@@ -26,15 +50,69 @@ class VersionViewSet(viewsets.ModelViewSet):
         file = version.file
         
         # Create a new version of the current state before reverting (safety)
-        Version.objects.create(
+        Version.objects.create_snapshot(
             file=file,
             content=file.content,
             created_by=request.user,
-            description=f"Auto-save before revert to {version.created_at}"
+            description=f"Auto-save before revert to {version.created_at}",
+            kind=Version.KIND_AUTO,
         )
 
         # Update file content
         file.content = version.content
         file.save()
+        events.file_saved(file, force=True)
 
         return Response({'status': 'reverted', 'content': file.content})
+
+    @action(detail=True, methods=['get'])
+    def diff(self, request, pk=None):
+        """Line diff from this version to ``against`` (another version id, or ``current``).
+
+        ``style=structured`` (default) returns JSON hunks, ``style=unified``
+        a unified diff; ``context`` sets the unchanged lines around changes.
+        Diffs of more than ``VERSION_DIFF_STREAM_LINES`` lines are streamed.
+        """
+        version = self.get_object()
+        style = request.query_params.get('style', 'structured')
+        if style not in ('structured', 'unified'):
+            raise ValidationError({'style': 'Must be "structured" or "unified".'})
+        try:
+            context = int(request.query_params.get('context', 3))
+        except ValueError:
+            raise ValidationError({'context': 'Must be an integer.'})
+
+        against = request.query_params.get('against', 'current')
+        if against == 'current':
+            file = version.file
+            new_content, new_digest = file.content, file.content_hash
+        else:
+            try:
+                other = self.get_queryset().get(pk=int(against), file_id=version.file_id)
+            except (ValueError, Version.DoesNotExist):
+                raise NotFound('No version of this file to compare against.')
+            new_content, against = other.content, other.pk
+            new_digest = digest(new_content)
+
+        diff = Diff(version.content, new_content, digest(version.content), new_digest, context)
+        stream = diff.line_count > settings.VERSION_DIFF_STREAM_LINES
+
+        if style == 'unified':
+            tofile = 'current' if against == 'current' else f'version {against}'
+            lines = diff.unified(f'version {version.pk}', tofile)
+            if stream:
+                return StreamingHttpResponse(lines, content_type='text/x-diff; charset=utf-8')
+            return HttpResponse(''.join(lines), content_type='text/x-diff; charset=utf-8')
+
+        header = {'from': version.pk, 'against': against, **diff.stats()}
+        if not stream:
+            return Response({**header, 'hunks': list(diff.hunks())})
+        return StreamingHttpResponse(stream_hunks(header, diff.hunks()), content_type='application/json')
+
+
+def stream_hunks(header, hunks):
+    """Encode ``{**header, "hunks": [...]}`` one hunk at a time."""
+    yield json.dumps(header)[:-1] + ', "hunks": ['
+    for index, hunk in enumerate(hunks):
+        yield (', ' if index else '') + json.dumps(hunk)
+    yield ']}'
@@ -0,0 +1,257 @@
+// Positional operational transform for the editor, mirroring backend/realtime/ot.py.
+//
+// Ops are {type: 'insert', position, text} or {type: 'delete', position, length}.
+// Positions and lengths count Unicode code points, as the server does, while
+// JavaScript strings and Monaco offsets count UTF-16 units.
+
+const SURROGATES = /[\uD800-\uDFFF]/;
+
+export const insert = (position, text) => ({ type: 'insert', position, text });
+export const remove = (position, length) => ({ type: 'delete', position, length });
+
+// Length of a string in code points
+export const length = (text) => (SURROGATES.test(text) ? [...text].length : text.length);
+
+// UTF-16 offset of a code point position in ``text``
+export const toOffset = (text, position) => {
+    if (!SURROGATES.test(text)) return position;
+    let offset = 0;
+    for (let count = 0; count < position && offset < text.length; count += 1) {
+        const code = text.charCodeAt(offset);
+        offset += code >= 0xd800 && code <= 0xdbff ? 2 : 1;
+    }
+    return offset;
+};
+
+export const apply = (text, ops) => ops.reduce((doc, op) => {
+    const start = toOffset(doc, op.position);
+    if (op.type === 'insert') {
+        return doc.slice(0, start) + op.text + doc.slice(start);
+    }
+    const end = start + toOffset(doc.slice(start), op.length);
+    return doc.slice(0, start) + doc.slice(end);
+}, text);
+
+const transformOp = (op, against, opWinsTies) => {
+    const position = op.position;
+    const other = against.position;
+
+    if (op.type === 'insert') {
+        if (against.type === 'insert') {
+            if (position < other || (position === other && opWinsTies)) return [op];
+            return [insert(position + length(against.text), op.text)];
+        }
+        if (position <= other) return [op];
+        if (position >= other + against.length) return [insert(position - against.length, op.text)];
+        return [insert(other, op.text)];
+    }
+
+    const end = position + op.length;
+    if (against.type === 'insert') {
+        const inserted = length(against.text);
+        if (other <= position) return [remove(position + inserted, op.length)];
+        if (other >= end) return [op];
+        // The insert landed inside the deleted range: delete around it
+        const before = other - position;
+        return [remove(position, before), remove(position + inserted, op.length - before)];
+    }
+
+    const otherEnd = other + against.length;
+    if (end <= other) return [op];
+    if (position >= otherEnd) return [remove(position - against.length, op.length)];
+    const overlap = Math.min(end, otherEnd) - Math.max(position, other);
+    const remaining = op.length - overlap;
+    return remaining ? [remove(Math.min(position, other), remaining)] : [];
+};
+
+// Transform two concurrent changes against each other: returns [left', right']
+// where left' applies after right and right' applies after left
+export const transformLists = (left, right, leftWins) => {
+    if (!left.length || !right.length) return [left, right];
+    if (left.length === 1 && right.length === 1) {
+        return [
+            transformOp(left[0], right[0], leftWins),
+            transformOp(right[0], left[0], !leftWins),
+        ];
+    }
+    if (left.length > 1) {
+        const [head, rightAfterHead] = transformLists(left.slice(0, 1), right, leftWins);
+        const [tail, rightAfterTail] = transformLists(left.slice(1), rightAfterHead, leftWins);
+        return [[...head, ...tail], rightAfterTail];
+    }
+    const [leftAfterHead, head] = transformLists(left, right.slice(0, 1), leftWins);
+    const [leftAfterTail, tail] = transformLists(leftAfterHead, right.slice(1), leftWins);
+    return [leftAfterTail, [...head, ...tail]];
+};
+
+// Ops for a Monaco content change event, expressed against ``text``
+// (the document before the event). Returns [ops, new text].
+export const fromChanges = (text, changes) => {
+    const ops = [];
+    let doc = text;
+    // Offsets refer to the document before the event; going from the end
+    // keeps the ones still to come valid
+    [...changes].sort((a, b) => b.rangeOffset - a.rangeOffset).forEach((change) => {
+        const start = change.rangeOffset;
+        const end = start + change.rangeLength;
+        const position = length(doc.slice(0, start));
+        if (change.rangeLength) ops.push(remove(position, length(doc.slice(start, end))));
+        if (change.text) ops.push(insert(position, change.text));
+        doc = doc.slice(0, start) + change.text + doc.slice(end);
+    });
+    return [ops, doc];
+};
+
+// Change turning ``old`` into ``next``, as ot.diff builds it on the server
+// (so a full-content update becomes the same ops on both sides): only the
+// common prefix and suffix are trimmed.
+export const diff = (old, next) => {
+    const before = [...old];
+    const after = [...next];
+    const limit = Math.min(before.length, after.length);
+    let start = 0;
+    while (start < limit && before[start] === after[start]) start += 1;
+
+    let oldEnd = before.length;
+    let newEnd = after.length;
+    while (oldEnd > start && newEnd > start && before[oldEnd - 1] === after[newEnd - 1]) {
+        oldEnd -= 1;
+        newEnd -= 1;
+    }
+
+    const ops = [];
+    if (oldEnd > start) ops.push(remove(start, oldEnd - start));
+    if (newEnd > start) ops.push(insert(start, after.slice(start, newEnd).join('')));
+    return ops;
+};
+
+// Client side of the file_ops protocol. At most one change is in flight;
+// edits made while it waits for its ack are buffered and sent as one change
+// after it. Changes from the server are transformed against both, so the
+// editor can apply them as they come.
+//
+// When the client has to start over from a snapshot of the server document
+// (a sync, or a full-content update it can't place), unsent edits are kept
+// and rebased onto the snapshot. A snapshot that arrives while a change is
+// in flight is held until that change's ack or error says whether the
+// snapshot already contains it.
+export class Client {
+    // ``requestSync`` asks the server for a fresh snapshot
+    constructor(revision, document, send, requestSync) {
+        this.revision = revision;
+        this.document = document; // the server's document at ``revision``
+        this.send = send;
+        this.requestSync = requestSync;
+        this.inflight = null;
+        this.buffer = null;
+        this.waiting = false; // for a snapshot; nothing is sent meanwhile
+        this.snapshot = null; // held until the in-flight change is settled
+        this.later = []; // [ops, revision] of changes that came after it
+    }
+
+    local(ops) {
+        if (!ops.length) return;
+        if (this.inflight || this.waiting) {
+            this.buffer = [...(this.buffer || []), ...ops];
+            return;
+        }
+        this.inflight = ops;
+        this.send(ops, this.revision);
+    }
+
+    // Returns the rebased document if a held snapshot could be taken on
+    // now, otherwise null
+    ack(revision) {
+        const acked = this.inflight;
+        this.document = apply(this.document, acked || []);
+        this.revision = revision;
+        this.inflight = null;
+        if (!this.waiting) {
+            if (this.buffer) {
+                this.inflight = this.buffer;
+                this.buffer = null;
+                this.send(this.inflight, this.revision);
+            }
+            return null;
+        }
+        const snapshot = this.snapshot;
+        this.snapshot = null;
+        if (snapshot && revision <= snapshot.revision) {
+            return this.rebase(snapshot.content, snapshot.revision);
+        }
+        // Applied after the held snapshot was taken: ask for one that has it.
+        // ``document`` now stands for the server's text plus our change only
+        // as the base the next snapshot is compared with.
+        this.later = [];
+        this.requestSync();
+        return null;
+    }
+
+    // The server rejected the in-flight change: it goes back in front of the
+    // buffer and everything is rebased onto a fresh snapshot
+    reject() {
+        this.buffer = [...(this.inflight || []), ...(this.buffer || [])];
+        this.inflight = null;
+        const snapshot = this.snapshot;
+        this.snapshot = null;
+        if (snapshot) {
+            return this.rebase(snapshot.content, snapshot.revision);
+        }
+        this.waiting = true;
+        this.requestSync();
+        return null;
+    }
+
+    // Returns the ops to apply to the editor, or null if the document
+    // already includes them (they predate the last sync)
+    remote(ops, revision) {
+        if (this.waiting) {
+            // Changes before the snapshot are in it; later ones are applied on top
+            if (this.snapshot && revision > this.snapshot.revision) this.later.push([ops, revision]);
+            return null;
+        }
+        if (revision <= this.revision) return null;
+        this.document = apply(this.document, ops);
+        this.revision = revision;
+        let incoming = ops;
+        // The server ordered the incoming change first, so it wins ties
+        if (this.inflight) [this.inflight, incoming] = transformLists(this.inflight, incoming, false);
+        if (this.buffer) [this.buffer, incoming] = transformLists(this.buffer, incoming, false);
+        return incoming;
+    }
+
+    // The whole document at ``revision``. Returns the editor's new document,
+    // or null if it is older than what we have or has to wait for an ack.
+    sync(content, revision) {
+        if (revision < this.revision || (revision === this.revision && !this.waiting)) return null;
+        if (this.inflight) {
+            this.waiting = true;
+            if (!this.snapshot || this.snapshot.revision < revision) {
+                this.snapshot = { content, revision };
+                this.later = this.later.filter(([, later]) => later > revision);
+            }
+            return null;
+        }
+        return this.rebase(content, revision);
+    }
+
+    // Start over from ``content``, keeping our unsent edits on top of it
+    rebase(content, revision) {
+        const pending = this.buffer || [];
+        const [rebased] = transformLists(pending, diff(this.document, content), false);
+        this.revision = revision;
+        this.document = content;
+        this.buffer = null;
+        this.waiting = false;
+        this.local(rebased);
+
+        let text = apply(content, rebased);
+        const later = this.later;
+        this.later = [];
+        later.forEach(([ops, laterRevision]) => {
+            const incoming = this.remote(ops, laterRevision);
+            if (incoming) text = apply(text, incoming);
+        });
+        return text;
+    }
+}
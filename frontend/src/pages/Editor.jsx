@@ -2,6 +2,7 @@ import React, { useEffect, useState, useRef } from 'react';
 import { useParams, Link } from 'react-router-dom';
 import Editor from '@monaco-editor/react';
 import api from '../api';
+import * as ot from '../ot';
 import { FileCode, Plus, ChevronLeft, Save, Trash2, Clock, FolderPlus } from 'lucide-react';
 
 const CodeEditor = () => {
@@ -16,11 +17,20 @@ const CodeEditor = () => {
     const [newFolderName, setNewFolderName] = useState('');
     const [versions, setVersions] = useState([]);
     const [loadingVersions, setLoadingVersions] = useState(false);
+    const [versionsNext, setVersionsNext] = useState(null); // cursor link to older versions
+    const [versionDiff, setVersionDiff] = useState(null); // { id, hunks } of the expanded version
     const [socket, setSocket] = useState(null);
+    const [socketReady, setSocketReady] = useState(false);
+    const [treeVersion, setTreeVersion] = useState(0); // bumped by tree change events
     const [activeUsers, setActiveUsers] = useState([]); // presence list
     const [remoteCursors, setRemoteCursors] = useState({}); // username -> position
     const editorRef = useRef(null);
     const isRemoteUpdate = useRef(false);
+    const connectionId = useRef(null); // lets us skip our own entries in cursor batches
+    const socketRef = useRef(null);
+    const selectedFileRef = useRef(null);
+    const docRef = useRef(''); // the document as the server knows it, plus our pending ops
+    const otClient = useRef(null); // revision and pending ops of the open file's room
 
     useEffect(() => {
         // Load current user once so we can identify presence/cursor updates
@@ -38,100 +48,198 @@ const CodeEditor = () => {
     useEffect(() => {
         fetchFiles(selectedFolderId);
         fetchFolders();
-    }, [projectId, selectedFolderId]);
+    }, [projectId, selectedFolderId, treeVersion]);
 
+    // One socket per project: it carries the open file's room and file tree changes
     useEffect(() => {
-        if (selectedFile) {
-            if (socket) {
-                socket.close();
+        const token = localStorage.getItem('access_token');
+        const newSocket = new WebSocket(`ws://localhost:8000/ws/project/${projectId}/?token=${token}`);
+
+        newSocket.onopen = () => {
+            console.log('✅ Connected to WebSocket (real-time sync enabled)');
+        };
+
+        newSocket.onerror = (error) => {
+            console.warn('⚠️ WebSocket connection error. Real-time sync disabled. (Redis may not be running)');
+            console.warn('You can still edit and save files normally.');
+            // No sync frame will arrive, so load the saved content instead
+            if (selectedFileRef.current) {
+                loadFileContent(selectedFileRef.current.id);
             }
+        };
 
-            const newSocket = new WebSocket(`ws://localhost:8000/ws/file/${selectedFile.id}/`);
+        newSocket.onclose = () => {
+            console.log('WebSocket disconnected');
+            setSocketReady(false);
+        };
 
-            newSocket.onopen = () => {
-                console.log('✅ Connected to WebSocket (real-time sync enabled)');
-                // Announce presence when we know who we are
-                if (currentUser?.username) {
-                    newSocket.send(JSON.stringify({
-                        type: 'presence_join',
-                        username: currentUser.username,
-                    }));
+        newSocket.onmessage = (event) => {
+            try {
+                const data = JSON.parse(event.data);
+                if (data.type === 'connected') {
+                    connectionId.current = data.connection;
+                    setSocketReady(true);
+                    return;
                 }
-            };
-
-            newSocket.onerror = (error) => {
-                console.warn('⚠️ WebSocket connection error. Real-time sync disabled. (Redis may not be running)');
-                console.warn('You can still edit and save files normally.');
-            };
-
-            newSocket.onclose = () => {
-                console.log('WebSocket disconnected');
-            };
-
-            newSocket.onmessage = (event) => {
-                try {
-                    const data = JSON.parse(event.data);
-                    if (data.type === 'file_update') {
-                        isRemoteUpdate.current = true;
-                        if (editorRef.current) {
-                            const model = editorRef.current.getModel();
-                            const currentPosition = editorRef.current.getPosition();
-                            model.setValue(data.content);
-                            editorRef.current.setPosition(currentPosition);
-                        }
-                        isRemoteUpdate.current = false;
-                    } else if (data.type === 'presence') {
-                        setActiveUsers((prev) => {
-                            const alreadyPresent = prev.includes(data.username);
-                            if (data.action === 'join' && !alreadyPresent) {
-                                return [...prev, data.username];
-                            }
-                            if (data.action === 'leave') {
-                                return prev.filter((u) => u !== data.username);
+                if (data.type === 'tree') {
+                    // A file or folder was created, renamed, moved or deleted
+                    if (data.kind === 'file' && data.action === 'deleted'
+                        && data.data.id === selectedFileRef.current?.id) {
+                        closeFile();
+                    }
+                    setTreeVersion((version) => version + 1);
+                    return;
+                }
+                // Everything else belongs to a file room; ignore files we already left
+                if (data.file !== selectedFileRef.current?.id) {
+                    return;
+                }
+                if (data.type === 'sync') {
+                    // Live document and presence snapshot sent by the server on join,
+                    // or again when we (or our connection's outbox) fell behind
+                    connectionId.current = data.connection;
+                    const client = otClient.current;
+                    if (client) {
+                        // Unsent edits are rebased onto the snapshot, not dropped
+                        const text = client.sync(data.content, data.revision);
+                        if (text !== null) setDocument(text);
+                    } else {
+                        otClient.current = new ot.Client(data.revision, data.content, sendOps, requestSync);
+                        setDocument(data.content);
+                    }
+                    const others = data.users.filter((user) => user.connection !== data.connection);
+                    setActiveUsers([...new Set(others.map((user) => user.username))]);
+                    setRemoteCursors(Object.fromEntries(
+                        others
+                            .filter((user) => user.position)
+                            .map((user) => [user.username, user.position])
+                    ));
+                } else if (data.type === 'file_ops') {
+                    // A peer's change, transformed by the server against everything before it
+                    const ops = otClient.current?.remote(data.ops, data.revision);
+                    if (ops) applyRemoteOps(ops);
+                } else if (data.type === 'file_ops_ack') {
+                    // Takes on a sync that was held until our change was settled
+                    const text = otClient.current?.ack(data.revision);
+                    if (text != null) setDocument(text);
+                } else if (data.type === 'file_ops_error') {
+                    // Our change was rejected (e.g. its revision is too old): it is
+                    // kept and sent again on top of a fresh sync
+                    console.warn('Change rejected, resyncing:', data.error);
+                    const text = otClient.current?.reject();
+                    if (text != null) setDocument(text);
+                } else if (data.type === 'file_update') {
+                    // The whole document was replaced (e.g. a revert). The server
+                    // records it as the diff from the previous revision, so when it
+                    // is the next change it merges like any other; otherwise it is
+                    // a snapshot our unsent edits are rebased onto.
+                    const client = otClient.current;
+                    if (!client) {
+                        setDocument(data.content);
+                    } else if (data.revision === client.revision + 1 && !client.waiting) {
+                        const ops = client.remote(ot.diff(client.document, data.content), data.revision);
+                        if (ops) applyRemoteOps(ops);
+                    } else {
+                        const text = client.sync(data.content, data.revision);
+                        if (text !== null) setDocument(text);
+                    }
+                } else if (data.type === 'cursor_batch') {
+                    // Presence changes and the latest cursor of each user, batched by the server
+                    const fromOthers = (entry) => entry.connection !== connectionId.current;
+                    const presence = data.presence.filter(fromOthers);
+                    const cursors = data.cursors.filter(fromOthers);
+                    const left = presence
+                        .filter((event) => event.action === 'leave')
+                        .map((event) => event.username);
+                    setActiveUsers((prev) => {
+                        let users = prev;
+                        presence.forEach((event) => {
+                            const alreadyPresent = users.includes(event.username);
+                            if (event.action === 'join' && !alreadyPresent) {
+                                users = [...users, event.username];
+                            } else if (event.action === 'leave') {
+                                users = users.filter((u) => u !== event.username);
                             }
-                            return prev;
                         });
-                    } else if (data.type === 'cursor_update') {
-                        setRemoteCursors((prev) => ({
-                            ...prev,
-                            [data.username]: data.position,
-                        }));
-                    }
-                } catch (error) {
-                    console.error('Error parsing WebSocket message:', error);
+                        return users;
+                    });
+                    setRemoteCursors((prev) => {
+                        const next = { ...prev };
+                        left.forEach((username) => delete next[username]);
+                        cursors.forEach((cursor) => {
+                            next[cursor.username] = cursor.position;
+                        });
+                        return next;
+                    });
+                } else if (data.type === 'saved') {
+                    // The server persisted the live document and took a version
+                    fetchVersions(data.file);
+                    showSaved();
+                } else if (data.type === 'save_error') {
+                    console.error('Failed to save file:', data.error);
+                    alert('Failed to save file');
                 }
-            };
+            } catch (error) {
+                console.error('Error parsing WebSocket message:', error);
+            }
+        };
 
-            setSocket(newSocket);
+        socketRef.current = newSocket;
+        setSocket(newSocket);
 
-            // Load version history whenever a new file is selected
-            fetchVersions(selectedFile.id);
+        return () => {
+            socketRef.current = null;
+            setSocketReady(false);
+            newSocket.close();
+        };
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+    }, [projectId]);
 
-            return () => {
-                if (newSocket.readyState === WebSocket.OPEN || newSocket.readyState === WebSocket.CONNECTING) {
-                    if (currentUser?.username) {
-                        newSocket.send(JSON.stringify({
-                            type: 'presence_leave',
-                            username: currentUser.username,
-                        }));
-                    }
-                    newSocket.close();
+    // Subscribe to the selected file's room over the project socket
+    useEffect(() => {
+        selectedFileRef.current = selectedFile;
+        otClient.current = null; // until the room's sync arrives
+        setActiveUsers([]);
+        setRemoteCursors({});
+        if (!selectedFile) return;
+
+        const ws = socketRef.current;
+        if (!ws || ws.readyState === WebSocket.CLOSING || ws.readyState === WebSocket.CLOSED) {
+            // Realtime is unavailable: fall back to the saved content
+            loadFileContent(selectedFile.id);
+            return;
+        }
+        if (!socketReady) return; // subscribes once the socket is connected
+
+        ws.send(JSON.stringify({ type: 'subscribe', file: selectedFile.id }));
+        if (currentUser?.username) {
+            ws.send(JSON.stringify({
+                type: 'presence_join',
+                file: selectedFile.id,
+                username: currentUser.username,
+            }));
+        }
+
+        return () => {
+            if (ws.readyState === WebSocket.OPEN) {
+                if (currentUser?.username) {
+                    ws.send(JSON.stringify({
+                        type: 'presence_leave',
+                        file: selectedFile.id,
+                        username: currentUser.username,
+                    }));
                 }
-            };
-        } else {
-            // Close socket when no file is selected
-            if (socket) {
-                socket.close();
-                setSocket(null);
+                ws.send(JSON.stringify({ type: 'unsubscribe', file: selectedFile.id }));
             }
-        }
+        };
     // eslint-disable-next-line react-hooks/exhaustive-deps
-    }, [selectedFile, currentUser]);
+    }, [selectedFile, socketReady, currentUser]);
 
     const fetchFiles = async (folderId = null) => {
         try {
             const folderParam = folderId ? `&folder=${folderId}` : '';
-            const res = await api.get(`files/?project=${projectId}${folderParam}`);
+            // Lean listing: file bodies are loaded on demand when a file is opened
+            const res = await api.get(`files/?project=${projectId}${folderParam}&lean=true`);
             setFiles(res.data.results || res.data); // Handle paginated or list response
         } catch (error) {
             console.error('Failed to fetch files:', error);
@@ -151,8 +259,9 @@ const CodeEditor = () => {
         if (!fileId) return;
         setLoadingVersions(true);
         try {
-            const res = await api.get(`versions/?file_id=${fileId}`);
+            const res = await api.get(`versions/?file_id=${fileId}&page_size=50`);
             setVersions(res.data.results || res.data || []);
+            setVersionsNext(res.data.next || null);
         } catch (error) {
             console.error('Failed to fetch versions:', error);
         } finally {
@@ -160,6 +269,30 @@ const CodeEditor = () => {
         }
     };
 
+    const toggleVersionDiff = async (versionId) => {
+        if (versionDiff?.id === versionId) {
+            setVersionDiff(null);
+            return;
+        }
+        try {
+            const res = await api.get(`versions/${versionId}/diff/?against=current`);
+            setVersionDiff({ id: versionId, hunks: res.data.hunks || [] });
+        } catch (error) {
+            console.error('Failed to fetch version diff:', error);
+        }
+    };
+
+    const fetchOlderVersions = async () => {
+        if (!versionsNext) return;
+        try {
+            const res = await api.get(versionsNext);
+            setVersions((current) => [...current, ...(res.data.results || [])]);
+            setVersionsNext(res.data.next || null);
+        } catch (error) {
+            console.error('Failed to fetch older versions:', error);
+        }
+    };
+
     const createFile = async () => {
         if (!newFileName.trim()) return;
         try {
@@ -201,8 +334,7 @@ const CodeEditor = () => {
         try {
             await api.delete(`files/${fileId}/`);
             if (selectedFile?.id === fileId) {
-                setSelectedFile(null);
-                setCode('// Select a file to start editing');
+                closeFile();
             }
             fetchFiles();
         } catch (error) {
@@ -211,24 +343,123 @@ const CodeEditor = () => {
         }
     };
 
+    const loadFileContent = async (fileId) => {
+        try {
+            const res = await api.get(`files/${fileId}/?fields=id,content`);
+            setDocument(res.data.content);
+        } catch (error) {
+            console.error('Failed to load file:', error);
+        }
+    };
+
+    // Content arrives in the WebSocket sync frame (see loadFileContent for the fallback)
     const handleFileClick = (file) => {
+        // Edits made before the new file's sync must not reach the old room
+        otClient.current = null;
         setSelectedFile(file);
-        setCode(file.content);
         fetchVersions(file.id);
     };
 
+    const closeFile = () => {
+        otClient.current = null;
+        setSelectedFile(null);
+        setCode('// Select a file to start editing');
+    };
+
     const handleEditorChange = (value) => {
         setCode(value);
-        if (socket && socket.readyState === WebSocket.OPEN && !isRemoteUpdate.current) {
-            socket.send(JSON.stringify({
-                type: 'file_update',
-                content: value
+    };
+
+    const sendOps = (ops, revision) => {
+        const ws = socketRef.current;
+        if (ws && ws.readyState === WebSocket.OPEN && selectedFileRef.current) {
+            ws.send(JSON.stringify({
+                type: 'file_ops',
+                file: selectedFileRef.current.id,
+                ops,
+                revision,
             }));
         }
     };
 
+    // Ask the room for a fresh sync; the client keeps its unsent edits meanwhile
+    const requestSync = () => {
+        const ws = socketRef.current;
+        if (ws && ws.readyState === WebSocket.OPEN && selectedFileRef.current) {
+            // Subscribing again makes the server send a fresh sync
+            ws.send(JSON.stringify({ type: 'subscribe', file: selectedFileRef.current.id }));
+        }
+    };
+
+    // Replace the whole document without treating it as a local edit
+    const setDocument = (content) => {
+        docRef.current = content;
+        const editor = editorRef.current;
+        const model = editor?.getModel();
+        if (model && model.getValue() !== content) {
+            const currentPosition = editor.getPosition();
+            isRemoteUpdate.current = true;
+            try {
+                model.setValue(content);
+            } finally {
+                isRemoteUpdate.current = false;
+            }
+            editor.setPosition(currentPosition);
+        }
+        setCode(content);
+    };
+
+    // Apply a peer's ops to the editor, keeping our cursor in place
+    const applyRemoteOps = (ops) => {
+        const model = editorRef.current?.getModel();
+        let doc = docRef.current;
+        isRemoteUpdate.current = true;
+        try {
+            ops.forEach((op) => {
+                const start = ot.toOffset(doc, op.position);
+                const end = op.type === 'insert' ? start : start + ot.toOffset(doc.slice(start), op.length);
+                const text = op.type === 'insert' ? op.text : '';
+                if (model) {
+                    const from = model.getPositionAt(start);
+                    const to = model.getPositionAt(end);
+                    model.applyEdits([{
+                        range: {
+                            startLineNumber: from.lineNumber,
+                            startColumn: from.column,
+                            endLineNumber: to.lineNumber,
+                            endColumn: to.column,
+                        },
+                        text,
+                    }]);
+                }
+                doc = doc.slice(0, start) + text + doc.slice(end);
+            });
+        } finally {
+            isRemoteUpdate.current = false;
+        }
+        docRef.current = doc;
+        setCode(doc);
+    };
+
+    const showSaved = () => {
+        const saveBtn = document.querySelector('.save-btn');
+        if (saveBtn) {
+            saveBtn.style.background = 'var(--success)';
+            setTimeout(() => {
+                saveBtn.style.background = '';
+            }, 1000);
+        }
+    };
+
     const saveFile = async () => {
         if (!selectedFile) return;
+        // Edits are autosaved by the server; a save just asks it to persist
+        // now and take a version. The REST save is only used without a socket.
+        const ws = socketRef.current;
+        if (ws && ws.readyState === WebSocket.OPEN) {
+            ws.send(JSON.stringify({ type: 'save', file: selectedFile.id }));
+            return;
+        }
         try {
             await api.patch(`files/${selectedFile.id}/`, {
                 content: code
@@ -236,14 +467,7 @@ const CodeEditor = () => {
 
             // Refresh versions after a successful save so the new snapshot appears
             fetchVersions(selectedFile.id);
-            // Show success feedback
-            const saveBtn = document.querySelector('.save-btn');
-            if (saveBtn) {
-                saveBtn.style.background = 'var(--success)';
-                setTimeout(() => {
-                    saveBtn.style.background = '';
-                }, 1000);
-            }
+            showSaved();
         } catch (error) {
             console.error('Failed to save file:', error);
             alert('Failed to save file');
@@ -253,14 +477,24 @@ const CodeEditor = () => {
     // Listen for cursor position changes and broadcast them
     const handleEditorMount = (editor) => {
         editorRef.current = editor;
+        docRef.current = editor.getValue();
+        // Local edits go to the room as ops, so concurrent edits merge instead of overwriting
+        editor.onDidChangeModelContent((e) => {
+            if (isRemoteUpdate.current) return;
+            const [ops, doc] = ot.fromChanges(docRef.current, e.changes);
+            docRef.current = doc;
+            otClient.current?.local(ops);
+        });
         editor.onDidChangeCursorPosition((e) => {
-            if (socket && socket.readyState === WebSocket.OPEN && currentUser?.username) {
+            const ws = socketRef.current;
+            if (ws && ws.readyState === WebSocket.OPEN && selectedFileRef.current && currentUser?.username) {
                 const position = {
                     lineNumber: e.position.lineNumber,
                     column: e.position.column,
                 };
-                socket.send(JSON.stringify({
+                ws.send(JSON.stringify({
                     type: 'cursor_update',
+                    file: selectedFileRef.current.id,
                     username: currentUser.username,
                     position,
                 }));
@@ -423,7 +657,7 @@ const CodeEditor = () => {
                         <div style={{ height: '48px', background: '#1e1e1e', display: 'flex', alignItems: 'center', padding: '0 1rem', borderBottom: '1px solid #333', gap: '1rem' }}>
                             <span style={{ color: '#ccc', fontSize: '0.9rem', fontWeight: '500' }}>{selectedFile.name}</span>
                             <span style={{ color: '#666', fontSize: '0.75rem' }}>{selectedFile.language || 'plaintext'}</span>
-                            <span style={{ color: '#666', fontSize: '0.75rem' }}>{selectedFile.line_count || 0} lines</span>
+                            <span style={{ color: '#666', fontSize: '0.75rem' }}>{code ? code.split('\n').length : 0} lines</span>
                             <span 
                                 style={{ 
                                     marginLeft: 'auto', 
@@ -531,12 +765,47 @@ const CodeEditor = () => {
                                                 </div>
                                                 <div style={{ fontSize: '0.75rem', color: 'var(--text-muted)', marginBottom: '0.25rem' }}>
                                                     {version.created_by_username || 'Unknown user'}
+                                                    {' · '}{version.line_count} lines
+                                                    {version.line_delta !== 0 && ` (${version.line_delta > 0 ? '+' : ''}${version.line_delta})`}
                                                 </div>
                                                 {version.description && (
                                                     <div style={{ fontSize: '0.7rem', color: 'var(--text-muted)', marginBottom: '0.25rem' }}>
                                                         {version.description}
                                                     </div>
                                                 )}
+                                                <button
+                                                    onClick={() => toggleVersionDiff(version.id)}
+                                                    style={{
+                                                        marginTop: '0.25rem',
+                                                        width: '100%',
+                                                        padding: '0.3rem 0.5rem',
+                                                        fontSize: '0.75rem',
+                                                        borderRadius: '4px',
+                                                        border: 'none',
+                                                        background: 'rgba(148, 163, 184, 0.15)',
+                                                        color: 'var(--text-muted)',
+                                                        cursor: 'pointer'
+                                                    }}
+                                                >
+                                                    {versionDiff?.id === version.id ? 'Hide changes' : 'Changes since'}
+                                                </button>
+                                                {versionDiff?.id === version.id && (
+                                                    <pre style={{ margin: '0.25rem 0', maxHeight: '240px', overflow: 'auto', fontSize: '0.7rem', lineHeight: 1.4 }}>
+                                                        {versionDiff.hunks.length === 0 ? 'No changes' : versionDiff.hunks.map((hunk) => (
+                                                            <div key={`${hunk.old_start}-${hunk.new_start}`}>
+                                                                <div style={{ color: 'var(--text-muted)' }}>@@ -{hunk.old_start} +{hunk.new_start} @@</div>
+                                                                {hunk.lines.map(([op, text], index) => (
+                                                                    <div
+                                                                        key={index}
+                                                                        style={{ color: op === '+' ? '#4ade80' : op === '-' ? '#f87171' : '#e5e7eb' }}
+                                                                    >
+                                                                        {op}{text}
+                                                                    </div>
+                                                                ))}
+                                                            </div>
+                                                        ))}
+                                                    </pre>
+                                                )}
                                                 <button
                                                     onClick={async () => {
                                                         if (!confirm('Revert to this version? A new snapshot of the current content will be created first.')) return;
@@ -569,6 +838,23 @@ const CodeEditor = () => {
                                             </div>
                                         ))
                                     )}
+                                    {!loadingVersions && versionsNext && (
+                                        <button
+                                            onClick={fetchOlderVersions}
+                                            style={{
+                                                width: '100%',
+                                                padding: '0.3rem 0.5rem',
+                                                fontSize: '0.75rem',
+                                                borderRadius: '4px',
+                                                border: '1px solid rgba(148, 163, 184, 0.3)',
+                                                background: 'transparent',
+                                                color: 'var(--text-muted)',
+                                                cursor: 'pointer'
+                                            }}
+                                        >
+                                            Load older versions
+                                        </button>
+                                    )}
                                 </div>
                             </div>
                         </div>